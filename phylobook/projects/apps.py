@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class TreesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'phylobook.projects'
+
+    def ready(self):
+        """ Size the highlighter cache from settings """
+
+        from phylobook.projects.utils.cache import highlighter_cache
+
+        if getattr(settings, "HIGHLIGHTER_CACHE_BYTES", None):
+            highlighter_cache.resize(settings.HIGHLIGHTER_CACHE_BYTES)
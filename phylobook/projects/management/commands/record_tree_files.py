@@ -0,0 +1,66 @@
+import logging
+log = logging.getLogger('app')
+
+from django.core.management.base import BaseCommand, CommandError
+
+from phylobook.projects.models import Project, TreeFile
+
+
+class Command(BaseCommand):
+    """ Record (or check the records of) the files of every tree in projects """
+
+    help = " Record the files (and their hashes) of every tree in projects (all projects if none are named), or check the records with --verify "
+    suppressed_base_arguments = ['--traceback', '--settings', '--pythonpath', '--skip-checks', '--no-color', '--version', '--force-color']
+
+    def add_arguments(self, parser):
+        parser.add_argument('projects', nargs='*', type=str, help='Names of the projects to record')
+        parser.add_argument('--verify', action='store_true', help='Check the records against the files (including their hashes) without changing them')
+
+    def handle(self, *args, **options):
+        """ Do the work of recording or verifying the tree files """
+
+        projects = Project.objects.all()
+
+        if options["projects"]:
+            projects = projects.filter(name__in=options["projects"])
+
+            if len(projects) != len(set(options["projects"])):
+                raise CommandError(f"Unknown project in {', '.join(options['projects'])}")
+
+        problems: int = 0
+
+        for project in projects:
+            print(f"Processing {project}")
+
+            for tree in project.trees.prefetch_related("files"):
+                if not options["verify"]:
+                    tree.record_files(hash=True)
+                    continue
+
+                stored: dict = tree.stored_files()
+
+                for role, _ in TreeFile.ROLE_CHOICES:
+                    if role in stored:
+                        problem: str = stored[role].verify(contents=True)
+
+                        if not problem and tree.find_file_name(role) != stored[role].file_name:
+                            problem = f"{stored[role].path} is no longer the {role} file found in the project directory"
+
+                    elif tree.find_file_name(role):
+                        problem: str = f"{role} file {tree.find_file_name(role)} is not recorded"
+
+                    else:
+                        problem: str = None
+
+                    if problem:
+                        problems += 1
+                        self.stdout.write(self.style.ERROR(f"{project} - {tree.name}: {problem}"))
+
+        if options["verify"]:
+            if problems:
+                raise CommandError(f"{problems} tree file record(s) don't match the project directories")
+
+            self.stdout.write(self.style.SUCCESS(f'Tree file records verified'))
+
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Tree files recorded'))
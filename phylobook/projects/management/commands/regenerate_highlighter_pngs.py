@@ -0,0 +1,39 @@
+import logging
+log = logging.getLogger('app')
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from phylobook.projects.models import Project
+
+
+class Command(BaseCommand):
+    """ Redraw the highlighter PNGs for projects with the raster backend """
+
+    help = " Redraw the highlighter PNGs for projects (all projects if none are named) "
+    suppressed_base_arguments = ['--traceback', '--settings', '--pythonpath', '--skip-checks', '--no-color', '--version', '--force-color']
+
+    def add_arguments(self, parser):
+        parser.add_argument('projects', nargs='*', type=str, help='Names of the projects to redraw')
+        parser.add_argument('--width', type=int, help='Width of the marks in the plot', default=settings.HIGHLIGHTER_MARK_WIDTH)
+        parser.add_argument('--scale', type=float, help='Scale of the PNG (288 dpi at 1, use less for thumbnails)', default=1)
+
+    def handle(self, *args, **options):
+        """ Do the work of redrawing the highlighter PNGs """
+
+        projects = Project.objects.all()
+
+        if options["projects"]:
+            projects = projects.filter(name__in=options["projects"])
+
+            if len(projects) != len(set(options["projects"])):
+                raise CommandError(f"Unknown project in {', '.join(options['projects'])}")
+
+        for project in projects:
+            print(f"Processing {project}")
+
+            for tree in project.trees.all():
+                if not tree.draw_png_highlighter(width=options["width"], scale=options["scale"], session=tree.highlighter_session(processes=int(settings.MAX_FASTA_PROCESSORS))):
+                    self.stdout.write(self.style.ERROR(f"Error drawing PNG for {project} - {tree.name}\n\tOrigional Fasta: {tree.original_fasta_file_name}\n\tTree: {tree.tree_file_name}"))
+
+        self.stdout.write(self.style.SUCCESS(f'Highlighter PNGs redrawn'))
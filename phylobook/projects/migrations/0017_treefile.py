@@ -0,0 +1,30 @@
+# Generated by Django 3.2.25 on 2026-10-18 12:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0016_auto_20240530_2032'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TreeFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.CharField(choices=[('svg', 'SVG'), ('fasta', 'FASTA'), ('original_fasta', 'Original FASTA'), ('dist', 'Distance'), ('tree', 'Tree'), ('name', 'Name')], max_length=256)),
+                ('path', models.CharField(max_length=1024)),
+                ('size', models.BigIntegerField()),
+                ('mtime', models.FloatField()),
+                ('hash', models.CharField(blank=True, max_length=32, null=True)),
+                ('tree', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='files', to='projects.tree')),
+            ],
+            options={
+                'ordering': ['tree', 'role'],
+                'unique_together': {('tree', 'role')},
+            },
+        ),
+    ]
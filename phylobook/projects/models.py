@@ -1,8 +1,7 @@
 import logging
 log = logging.getLogger('app')
 
-import io, zipfile, shutil, datetime, os, glob, psutil, subprocess
-from functools import cache
+import io, zipfile, shutil, datetime, os, psutil, subprocess
 
 import Bio
 from Bio import AlignIO, Phylo, SeqIO
@@ -15,7 +14,7 @@ from typing import Union
 
 from django.contrib.auth.models import User
 from django.db import models
-from django.db.models import Q
+from django.db.models import Count, Max, Q
 from django.conf import settings as django_settings
 from django.core.exceptions import ValidationError
 from django.contrib.contenttypes.models import ContentType
@@ -146,9 +145,7 @@ class Project(models.Model):
             group_object_permission.save()
 
         for tree in Tree.objects.filter(project=original_id):
-            tree.project=self
-            tree.id=None
-            tree.save()
+            tree.copy_to(self)
 
         return self
     
@@ -176,6 +173,11 @@ class Project(models.Model):
         """ Returns a list of files in the project directory """
 
         return os.listdir(self.files_path)
+
+    def manifest(self) -> "ProjectManifest":
+        """ Returns the index of files in the project directory, which is scanned again only when the directory changes """
+
+        return project_manifest(self.files_path)
     
     @property
     def content_type_id(self) -> int:
@@ -184,19 +186,26 @@ class Project(models.Model):
         return ContentType.objects.get_for_model(self).id
     
     def pages(self) -> list[tuple[str, str]]:
-        """ Returns a list of pages for the project """
+        """ Returns a list of pages for the project, as ("first tree - last tree", "first-last")
+        built from one query of the tree names, and kept until a tree is added to or removed from the project
+        a cached menu still costs one aggregate query to check the project's trees haven't changed """
+
+        version: dict = self.trees.aggregate(count=Count("pk"), last=Max("pk"))
+        key: tuple = (self.pk, version["count"], version["last"], django_settings.TREES_PER_PAGE)
 
-        pages: list[tuple[str, str]] = []
+        found, pages = project_pages_cache.lookup(key)
+        if found:
+            return pages
 
-        trees = self.trees.all()
+        names: list[str] = list(self.trees.values_list("name", flat=True))
+        pages = []
 
-        for page in range(int((trees.count()-1) / django_settings.TREES_PER_PAGE) + 1):
-            first_tree_index: int = page * django_settings.TREES_PER_PAGE
-            last_tree_index: int = (page + 1) * django_settings.TREES_PER_PAGE - 1
-            if last_tree_index >= trees.count():
-                last_tree_index = trees.count() - 1
+        for first_tree_index in range(0, len(names), django_settings.TREES_PER_PAGE):
+            last_tree_index: int = min(first_tree_index + django_settings.TREES_PER_PAGE, len(names)) - 1
 
-            pages.append((f"{trees[first_tree_index].name} - {trees[last_tree_index].name}", f"{first_tree_index+1}-{last_tree_index+1}"))
+            pages.append((f"{names[first_tree_index]} - {names[last_tree_index]}", f"{first_tree_index+1}-{last_tree_index+1}"))
+
+        project_pages_cache.store(key, pages)
 
         return pages
     
@@ -309,53 +318,168 @@ class Tree(models.Model):
         return self.phylotree.unassigned_sequences
 
     @property
-    @cache
     def svg_file_name(self) -> str:
         """ Returns the name of the SVG file for the tree """
 
-        return svg_file_name(project=self.project, tree=self)
+        return self.stored_file_name("svg")
     
     @property
-    @cache
     def fasta_file_name(self) -> str:
         """ Returns the name of the FASTA file for the tree """
 
-        return fasta_file_name(project=self.project, tree=self)
+        return self.stored_file_name("fasta")
     
     @property
-    @cache
     def original_fasta_file_name(self) -> str:
         """ Returns the name of the original FASTA file (when available) for the tree """
 
-        return fasta_file_name(project=self.project, tree=self, prefer_original=True)
+        return self.stored_file_name("original_fasta")
     
     @property
-    @cache
     def dist_file_name(self) -> str:
         """ Returns the name of the distance file """
 
-        dist_list = glob.glob(os.path.join(django_settings.PROJECT_PATH, self.project.name, f"{self.name}*pwcoldist.txt"))
-
-        if dist_list:
-            return dist_list[0]
-
-        return None
+        return self.stored_file_name("dist")
     
     @property
-    @cache
     def tree_file_name(self) -> str:
         """ Returns the name of the NEXUS file for the tree """
 
-        return nexus_file_name(project=self.project, tree=self) or newick_file_name(project=self.project, tree=self)
+        return self.stored_file_name("tree")
+
+    def find_file_name(self, role: str) -> str:
+        """ Returns the file for a role (one of TreeFile.ROLE_CHOICES) found by looking in the project directory, or None """
+
+        if role == "svg":
+            return svg_file_name(project=self.project, tree=self)
+
+        elif role == "fasta":
+            return fasta_file_name(project=self.project, tree=self)
+
+        elif role == "original_fasta":
+            return fasta_file_name(project=self.project, tree=self, prefer_original=True)
+
+        elif role == "dist":
+            return self.project.manifest().first("dist", starts_with=self.name)
+
+        elif role == "tree":
+            return nexus_file_name(project=self.project, tree=self) or newick_file_name(project=self.project, tree=self)
+
+        elif role == "name":
+            if "collapsed" in self.name:
+                starts_with: str = self.name.split("collapsed")[0]
+            else:
+                starts_with: str = self.name
+
+            for manifest in (self.project.manifest(), project_manifest(os.path.join(self.project.files_path, "namefiles"))):
+                for file in manifest.files("text", starts_with=starts_with):
+                    if "name" in os.path.basename(file):
+                        return file
+
+            return None
+
+        raise ValueError(f"Unknown tree file role {role}")
+
+    _stored_files: dict = None
+
+    def stored_files(self) -> dict[str: "TreeFile"]:
+        """ Returns the recorded files of the tree by role, read from the database once per instance (or from prefetch_related("files")) """
+
+        if self._stored_files is None:
+            self._stored_files = {file.role: file for file in self.files.all()} if self.pk else {}
+
+        return self._stored_files
+
+    def stored_file_name(self, role: str) -> str:
+        """ Returns the recorded file for a role, looking in the project directory if it wasn't recorded or has since been deleted or renamed """
+
+        if (stored := self.stored_files().get(role)) and os.path.isfile(file_name := os.path.join(self.project.files_path, stored.path)):
+            return file_name
+
+        return self.find_file_name(role)
+
+    def stored_file_hash(self, role: str) -> str:
+        """ Returns the hash of the file for a role, from its record while the file's size and modification time still match it
+        a matching record without a hash has the hash stored, so the file is read once rather than on every call """
+
+        if not (file_name := self.stored_file_name(role)):
+            return None
+
+        stored: TreeFile = self.stored_files().get(role)
+
+        if not stored or os.path.join(self.project.files_path, stored.path) != file_name or stored.verify() is not None:
+            return file_hash(file_name=file_name)
+
+        if not stored.hash:
+            stored.hash = file_hash(file_name=file_name)
+            stored.save(update_fields=["hash"])
+
+        return stored.hash
+
+    def record_files(self, *, hash: bool=False) -> list["TreeFile"]:
+        """ Find the tree's files in the project directory and store their paths, sizes and modification times
+        with hash=True also store the hashes of files that don't have one (record_tree_files does this, so completing a process doesn't read every file) """
+
+        stored: dict[str: TreeFile] = {file.role: file for file in self.files.all()}
+        recorded: list[TreeFile] = []
+
+        for role, _ in TreeFile.ROLE_CHOICES:
+            file_name: str = self.find_file_name(role)
+
+            if not file_name or not os.path.isfile(file_name):
+                if role in stored:
+                    stored[role].delete()
+
+                continue
+
+            tree_file: TreeFile = stored.get(role) or TreeFile(tree=self, role=role)
+            path: str = os.path.relpath(file_name, self.project.files_path)
+            stat = os.stat(file_name)
+
+            changed: bool = tree_file.pk is None or tree_file.path != path or tree_file.size != stat.st_size or tree_file.mtime != stat.st_mtime
+
+            if changed:
+                tree_file.path = path
+                tree_file.size = stat.st_size
+                tree_file.mtime = stat.st_mtime
+                tree_file.hash = None
+
+            if hash and not tree_file.hash:
+                tree_file.hash = file_hash(file_name=file_name)
+                changed = True
+
+            if changed:
+                tree_file.save()
+
+            recorded.append(tree_file)
+
+        self._stored_files = None
+
+        return recorded
+
+    def copy_to(self, project: Project) -> "Tree":
+        """ Save a copy of the tree, and the records of its files, in another project whose directory holds the same files """
+
+        files: list[TreeFile] = list(self.files.all())
+
+        self.project = project
+        self.id = None
+        self._stored_files = None
+        self.save()
+
+        for file in files:
+            file.id = None
+            file.tree = self
+            file.save()
+
+        return self
 
     @property
-    @cache
     def highlighter_file_name_png(self) -> str:
         """ Returns the name of the highlighter file for the tree (png) """
 
         return os.path.join(self.project.files_path, f"{self.name}_highlighter.png")
 
-    @cache
     def highlighter_file_name_svg(self, *, width: int=None, path: bool=True) -> str:
         """ Returns the name of the highlighter file for the tree (svg)"""
 
@@ -368,7 +492,6 @@ class Tree(models.Model):
         else:
             return f"{self.name}_highlighter.{width}.svg"
     
-    @cache
     def match_file_name_svg(self, *, width: int=None, path: bool=True, show_multiple: bool=True) -> str:
         """ Returns the name of the match file for the tree (svg)"""
 
@@ -387,23 +510,34 @@ class Tree(models.Model):
             return f"{self.name}_match{match}.{width}.svg"
         
     @property
-    @cache
-    def name_file_name(self) -> str:
-        """ Returns the name of the name file for the tree """
+    def highlighter_index_file_name(self) -> str:
+        """ Returns the name of the highlighter index file for the tree (npz) """
 
-        starts_with: str = None
+        return os.path.join(self.project.files_path, f"{self.name}_highlighter_index.npz")
 
-        if "collapsed" in self.name:
-            starts_with= self.name.split("collapsed")[0]
-        else:
-            starts_with= self.name
+    def highlighter_tiles_directory(self, *, width: int=None) -> str:
+        """ Returns the directory of highlighter tiles for the tree """
 
-        for directory, _, files in os.walk(self.project.files_path):
-            for file in files:
-                if "name" in file and file.startswith(starts_with) and file.endswith(".txt"):
-                    return os.path.join(directory, file)
-                
-        return None
+        if not width:
+            width = django_settings.HIGHLIGHTER_MARK_WIDTH
+
+        return os.path.join(self.project.files_path, f"{self.name}_highlighter_tiles.{width}")
+
+    def highlighter_tile_file_name(self, *, level: int, column: int, row: int, width: int=None, output_format: str="svg") -> str:
+        """ Returns the name of a highlighter tile for the tree (svg or png) """
+
+        return os.path.join(self.highlighter_tiles_directory(width=width), str(level), f"{column}_{row}.{output_format}")
+
+    def highlighter_index(self) -> "HighlighterIndex":
+        """ Returns the stored highlighter work for the tree, keyed by the hash of its original FASTA (from its TreeFile record when that is current) """
+
+        return HighlighterIndex(self.highlighter_index_file_name, fasta_hash=self.stored_file_hash("original_fasta"))
+
+    @property
+    def name_file_name(self) -> str:
+        """ Returns the name of the name file for the tree """
+
+        return self.stored_file_name("name")
 
     
     @property
@@ -739,13 +873,21 @@ class Tree(models.Model):
         
         return ordered_sequence_names
     
-    def has_svg_highlighter(self, *, width: int=None, no_build: bool=False) -> bool:
+    def highlighter_session(self, *, processes: int=1) -> "HighlighterSession":
+        """ Returns a session that loads the alignment, tree and consensus once for any number of highlighter plots
+        only pass processes > 1 outside of web requests, since each plot then starts a process pool """
+
+        return HighlighterSession(self, processes=processes)
+
+    def has_svg_highlighter(self, *, width: int=None, no_build: bool=False, session: "HighlighterSession"=None) -> bool:
         """ Create a mutation highlighter plot """
 
         if not width:
             width = django_settings.HIGHLIGHTER_MARK_WIDTH
 
-        if not self.tree_file_name or not self.fasta_file_name or not os.path.exists(self.tree_file_name) or not os.path.exists(self.fasta_file_name):
+        session = session or self.highlighter_session()
+
+        if not session.ready:
             return False
 
         if os.path.exists(self.highlighter_file_name_svg(width=width)):
@@ -753,42 +895,68 @@ class Tree(models.Model):
         
         elif no_build:
             return False
-        
-        alignment = AlignIO.read(self.original_fasta_file_name, "fasta")
 
-        tree_file_name = self.tree_file_name
-        if "nexus" in tree_file_name:
-            tree = Phylo.read(self.tree_file_name, "nexus")
-        else:
-            tree = Phylo.read(self.tree_file_name, "newick")
+        if not session.draw_highlighter(width=width):
+            return False
 
-        try:
-            shortenizer = SequenceNameShortenizer(alignment)
+        session.save()
+    
+        return True
 
-            for sequence in alignment:
-                sequence.id = shortenizer.shortenize(sequence.id)
-                
-            for terminal in tree.get_terminals():
-                terminal.name = shortenizer.shortenize(terminal.name)
-        except:
-            pass
+    def draw_png_highlighter(self, *, file_name: str=None, width: int=None, scale: float=1, session: "HighlighterSession"=None) -> bool:
+        """ Draw the mismatch highlighter plot as a PNG (without labels) straight from the mismatch intervals
+        writes highlighter_file_name_png unless given another file name, and a small scale makes a thumbnail """
 
-        try:
-            mutation_plot = HighlighterPlot(alignment, tree=tree, top_margin=12, seq_gap=-0.185*2, seq_name_font_size=16, ruler_font_size=12, plot_width=6*72, bottom_margin=45, left_margin=0, right_margin=0, plot_label_gap=3) # (46*2)-36
-            mutation_plot.draw_mismatches(self.highlighter_file_name_svg(width=width), apobec=True, g_to_a=True, glycosylation=True, sort="tree", scheme="LANL", mark_width=width)
-        except Exception as error:
-            print(error)
+        if not width:
+            width = django_settings.HIGHLIGHTER_MARK_WIDTH
+
+        session = session or self.highlighter_session()
+
+        if not session.ready or not session.draw_png(file_name=file_name or self.highlighter_file_name_png, width=width, scale=scale):
             return False
-    
+
+        session.save()
+
+        return True
+
+    def has_highlighter_tile(self, *, level: int, column: int, row: int, width: int=None, output_format: str="svg", no_build: bool=False, session: "HighlighterSession"=None) -> bool:
+        """ Create a highlighter tile (svg or png), if it hasn't been drawn since the tree last changed
+        returns False if the tile isn't in the tree's tile pyramid """
+
+        if not width:
+            width = django_settings.HIGHLIGHTER_MARK_WIDTH
+
+        session = session or self.highlighter_session()
+
+        if not session.ready:
+            return False
+
+        tile_file_name: str = self.highlighter_tile_file_name(level=level, column=column, row=row, width=width, output_format=output_format)
+        svg_file_name: str = self.svg_file_name
+
+        # Recoloring or reordering the tree rewrites its SVG, so older tiles are drawn again
+        if os.path.exists(tile_file_name) and (not svg_file_name or os.path.getmtime(tile_file_name) > os.path.getmtime(svg_file_name)):
+            return True
+
+        elif no_build:
+            return False
+
+        if not session.draw_tile(level=level, column=column, row=row, width=width, output_format=output_format):
+            return False
+
+        session.save()
+
         return True
     
-    def has_svg_match(self, *, width: int=None, no_build: bool=False, show_multiple: bool=True) -> bool:
+    def has_svg_match(self, *, width: int=None, no_build: bool=False, show_multiple: bool=True, session: "HighlighterSession"=None) -> bool:
         """ Create a match highlighter plot """
         
         if not width:
             width = django_settings.MATCH_MARK_WIDTH
 
-        if not self.tree_file_name or not self.fasta_file_name or not os.path.exists(self.tree_file_name) or not os.path.exists(self.fasta_file_name):
+        session = session or self.highlighter_session()
+
+        if not session.ready:
             return False
         
         elif no_build:
@@ -799,42 +967,11 @@ class Tree(models.Model):
             match_file_time: float = os.path.getmtime(self.match_file_name_svg(width=width, show_multiple=show_multiple))
             if match_file_time > tree_file_time:
                 return True
-        
-        alignment = AlignIO.read(self.original_fasta_file_name, "fasta")
 
-        tree_file_name = self.tree_file_name
-        
-        if "nexus" in tree_file_name:
-            tree = Phylo.read(self.tree_file_name, "nexus")
-        else:
-            tree = Phylo.read(self.tree_file_name, "newick")
-
-        references: list[Seq] = []
-        colors_by_short: dict[str: str] = {color["short"]: f"#{color['value']}" for color in django_settings.ANNOTATION_COLORS}
-        consensus = self.get_lineage_consensus()
-        colors: dict = {
-            "references": [],
-            "unique": "#C4BD3B", #"#EFE645",
-            "multiple": "#BDBDBD", #"#808080",
-        }
-
-        if not show_multiple:
-            colors["multiple"] = None
-
-        for color, sequence in consensus.items():
-            if color in colors_by_short:
-                colors["references"].append(colors_by_short[color])
-                references.append(sequence)
-
-        if not references:
+        if not session.draw_match(width=width, show_multiple=show_multiple):
             return False
 
-        try:
-            mutation_plot = HighlighterPlot(alignment, tree=tree, top_margin=12, seq_gap=-0.185*2, seq_name_font_size=16, ruler_font_size=12, plot_width=6*72, bottom_margin=45, left_margin=0, right_margin=0, plot_label_gap=3)
-            mutation_plot.draw_matches(self.match_file_name_svg(width=width, show_multiple=show_multiple), references=references, sort="tree", scheme=colors, mark_width=width, sequence_labels=False)
-        except Exception as error:
-            log.debug(f"Got exception while creating mutation plot: {error}")
-            return False
+        session.save()
 
         return True
         
@@ -865,7 +1002,7 @@ class Tree(models.Model):
 
             sequence = self.get_sequence_by_id(id)
  
-            for _ in range(parse_sequence_name(id)["multiplicity"]):
+            for _ in range(sequence_object["multiplicity"]):
                 sequences_by_color[sequence_object["color"]].append(SeqRecord(Seq(sequence)))
 
         for color, alignment in sequences_by_color.items():
@@ -896,6 +1033,50 @@ class Tree(models.Model):
         return tree
 
 
+class TreeFile(models.Model):
+    """ A file of a tree, recorded when the tree is imported or processed so it can be found without scanning the project directory """
+
+    ROLE_CHOICES: set[tuple] = (("svg", "SVG"), ("fasta", "FASTA"), ("original_fasta", "Original FASTA"), ("dist", "Distance"), ("tree", "Tree"), ("name", "Name"))
+
+    tree = models.ForeignKey(Tree, on_delete=models.CASCADE, related_name='files')
+    role = models.CharField(max_length=256, choices=ROLE_CHOICES)
+    path = models.CharField(max_length=1024)
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    hash = models.CharField(max_length=32, null=True, blank=True)
+
+    class Meta:
+        unique_together = ('tree', 'role',)
+        ordering = ['tree', 'role']
+
+    def __str__(self) -> str:
+        """ Returns the path of the file for print() """
+        return f"{self.tree}: {self.path}"
+
+    @property
+    def file_name(self) -> str:
+        """ Returns the full name of the file (path is relative to the project directory, so records survive a project being renamed) """
+
+        return os.path.join(self.tree.project.files_path, self.path)
+
+    def verify(self, *, contents: bool=False) -> str:
+        """ Returns a description of how the file differs from its record, or None if it matches
+        checks the size and modification time, and with contents=True the hash (when one has been recorded) """
+
+        if not os.path.isfile(self.file_name):
+            return f"{self.path} is missing"
+
+        stat = os.stat(self.file_name)
+
+        if stat.st_size != self.size or stat.st_mtime != self.mtime:
+            return f"{self.path} has changed size or modification time since it was recorded"
+
+        if contents and self.hash and file_hash(file_name=self.file_name) != self.hash:
+            return f"{self.path} has different contents than when it was recorded"
+
+        return None
+
+
 class Process(models.Model):
     """ Holds information about a process in a project or Tree """
 
@@ -925,13 +1106,16 @@ class Process(models.Model):
         self.save()
 
     def complete(self) -> None:
-        """ Complete the process """
+        """ Complete the process, recording the files the pipeline made for its tree """
 
         self.status = "Completed"
         self.pid = None
         self.created_time = None
         self.save()
 
+        if self.tree:
+            self.tree.record_files()
+
     def fail(self) -> None:
         """ Fail the process """
 
@@ -989,6 +1173,10 @@ class Process(models.Model):
 
 
 # Importing last to avoid circular imports
-from phylobook.projects.utils import svg_file_name, fasta_file_name, nexus_file_name, newick_file_name, PhyloTree, get_lineage_dict, parse_sequence_name, SequenceNameShortenizer
+from phylobook.projects.utils import svg_file_name, fasta_file_name, nexus_file_name, newick_file_name, file_hash, PhyloTree, get_lineage_dict, SequenceNameShortenizer
 from phylobook.projects.utils import highlighter
+from phylobook.projects.utils.highlighter_index import HighlighterIndex
+from phylobook.projects.utils.manifest import ProjectManifest, project_manifest
+from phylobook.projects.utils.cache import project_pages_cache
+from phylobook.projects.utils.highlighter_session import HighlighterSession
 from Bio.Graphics import HighlighterPlot
\ No newline at end of file
@@ -43,4 +43,32 @@ class ProjectTests(TestCase):
         self.assertEqual(Lineage.objects.all().filter(color="Red").count(), 2)
 
         for color in ("Gray", "Apricot", "Lavender", "Pink", "Purple"):
-            self.assertEqual(Lineage.objects.all().filter(color=color).count(), 22, f"Testing color: {color}")
\ No newline at end of file
+            self.assertEqual(Lineage.objects.all().filter(color=color).count(), 22, f"Testing color: {color}")
+
+    def test_pages_should_split_trees_into_pages_from_one_query_of_names(self):
+        """ Project pages should cover every tree from one query of the names, and be rebuilt only once trees are added or removed """
+
+        my_project = Project.objects.create(name="My Paged Project")
+
+        for index in range(23):
+            Tree.objects.create(project=my_project, name=f"tree_{index:02}")
+
+        with self.settings(TREES_PER_PAGE=10):
+            # One query to check the trees haven't changed, and one for the names
+            with self.assertNumQueries(2):
+                self.assertEqual(my_project.pages(), [("tree_00 - tree_09", "1-10"), ("tree_10 - tree_19", "11-20"), ("tree_20 - tree_22", "21-23")])
+
+            # Once cached, only the check
+            with self.assertNumQueries(1):
+                self.assertEqual(len(my_project.pages()), 3)
+
+            Tree.objects.get(project=my_project, name="tree_22").delete()
+            self.assertEqual(my_project.pages()[-1], ("tree_20 - tree_21", "21-22"))
+
+    def test_highlighter_session_should_compare_in_one_process_unless_asked(self):
+        """ Web requests draw highlighter plots without starting a process pool, and management commands can ask for one """
+
+        tree = Tree.objects.create(project=Project.objects.create(name="My Highlighted Project"), name="tree")
+
+        self.assertEqual(tree.highlighter_session().processes, 1)
+        self.assertEqual(tree.highlighter_session(processes=4).processes, 4)
@@ -1,11 +1,29 @@
 import logging
 log = logging.getLogger('test')
 
-import os
+import glob, io, math, os, shutil, struct, tempfile, zlib
 
 from django.test import TestCase, SimpleTestCase
 
+import numpy as np
+
+from reportlab.lib import colors
+from reportlab.pdfbase.pdfmetrics import stringWidth
+
+from Bio import AlignIO, Phylo
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from Bio.Align import MultipleSeqAlignment
+
 from phylobook.projects import utils 
+from phylobook.projects.models import Project, Tree, TreeFile
+from phylobook.projects.utils.highlighter import Highlighter, HighlighterPlot, codon_position
+from phylobook.projects.utils.highlighter_engine import BLOCK_ROWS, GapIndex, Intervals, row_ranges
+from phylobook.projects.utils.cache import BoundedCache, approximate_size, highlighter_tiles_cache, project_manifests_cache, svg_dimensions_cache
+from phylobook.projects.utils.highlighter_index import HighlighterIndex
+from phylobook.projects.utils.highlighter_tiles import HighlighterTiles
+from phylobook.projects.utils.highlighter_canvas import PNG_BAND_ROWS, RasterCanvas, rgb, string_width
+from phylobook.projects.utils.manifest import MAX_AGE, project_manifest
 
 
 class TreeTests(TestCase):
@@ -153,6 +171,217 @@ class TreeTests(TestCase):
 
         self.assertEqual(lineage_counts["red"]["count"], 77)
 
+    # Tests for project_manifest
+
+    def test_project_manifest_should_match_glob_and_rescan_when_directory_changes(self):
+        """ project_manifest should find the files glob would, and scan again once a file is added or the manifest is too old """
+
+        with tempfile.TemporaryDirectory() as directory:
+            for file_name in ("tree_1.svg", "tree_1_highlighter.svg", "tree_10_nexus.tre", ".tree_1.svg", "other.svg"):
+                open(os.path.join(directory, file_name), "w").close()
+
+            manifest = project_manifest(directory)
+
+            self.assertEqual(manifest.files("svg", starts_with="tree_1"), glob.glob(os.path.join(directory, "tree_1*.svg")))
+            self.assertEqual(manifest.first("nexus", starts_with="tree_1"), os.path.join(directory, "tree_10_nexus.tre"))
+            self.assertIs(manifest.first("fasta", starts_with="tree_1"), None)
+            self.assertIs(project_manifest(directory), manifest)
+
+            open(os.path.join(directory, "tree_1.fasta"), "w").close()
+            os.utime(directory, ns=(manifest.mtime + 1, manifest.mtime + 1))
+
+            self.assertEqual(project_manifest(directory).first("fasta", starts_with="tree_1"), os.path.join(directory, "tree_1.fasta"))
+
+            # A file whose creation didn't reach the directory's modification time is found once the manifest is too old
+            manifest = project_manifest(directory)
+            open(os.path.join(directory, "tree_1_newick.tre"), "w").close()
+            os.utime(directory, ns=(manifest.mtime, manifest.mtime))
+
+            self.assertIs(project_manifest(directory), manifest)
+
+            manifest.scanned -= MAX_AGE
+
+            self.assertEqual(project_manifest(directory).first("newick", starts_with="tree_1"), os.path.join(directory, "tree_1_newick.tre"))
+
+    def test_project_manifests_should_be_evicted_once_over_budget(self):
+        """ Manifests are kept in a BoundedCache measured by their names, so visiting many projects can't grow it forever """
+
+        with tempfile.TemporaryDirectory() as directory:
+            for file_name in ("tree_1.svg", "tree_1.fasta", "tree_1_newick.tre"):
+                open(os.path.join(directory, file_name), "w").close()
+
+            manifest = project_manifest(directory)
+            self.assertGreater(approximate_size(manifest), approximate_size(manifest.names))
+
+            max_bytes: int = project_manifests_cache.max_bytes
+
+            try:
+                project_manifests_cache.resize(approximate_size(manifest) * 2)
+
+                for index in range(5):
+                    project_manifest(os.path.join(directory, f"missing_{index}"))
+
+                self.assertLessEqual(project_manifests_cache.bytes, project_manifests_cache.max_bytes)
+                self.assertIsNot(project_manifest(directory), manifest)
+            finally:
+                project_manifests_cache.resize(max_bytes)
+
+        self.assertEqual(project_manifest(directory).names, [])
+
+    # Tests for svg_dimensions
+
+    def test_svg_dimensions_should_read_the_root_view_box_and_notice_changes(self):
+        """ svg_dimensions should read the viewBox of the root element, and read it again once the file changes """
+
+        self.assertEqual(utils.svg_dimensions("/phylobook/test_data/with_timepoints.svg"), (783, 486))
+
+        with tempfile.TemporaryDirectory() as directory:
+            file_name: str = os.path.join(directory, "plot.svg")
+
+            with open(file_name, "w") as svg_file:
+                svg_file.write('<?xml version="1.0"?>\n<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 100.5 20">' + "<rect/>" * 2000 + "</svg>")
+
+            self.assertEqual(utils.svg_dimensions(file_name), (100, 20))
+
+            hits: int = svg_dimensions_cache.hits
+            self.assertEqual(utils.svg_dimensions(file_name), (100, 20))
+            self.assertEqual(svg_dimensions_cache.hits, hits + 1)
+
+            with open(file_name, "w") as svg_file:
+                svg_file.write('<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 300 400"></svg>')
+
+            self.assertEqual(utils.svg_dimensions(file_name), (300, 400))
+
+    # Tests for tree_svg_pairs
+
+    def test_tree_svg_pairs_should_pair_trees_with_their_own_svgs(self):
+        """ tree_svg_pairs should pair tree_1 with tree_1's SVGs only, not tree_10's """
+
+        files: list[str] = sorted([
+            "tree_1_highlighter.png", "tree_1.svg", "tree_1.phy_phyml_tree.txt.svg", "tree_1_highlighter.50.svg", "tree_1_match.50.svg",
+            "tree_10_highlighter.png", "tree_10.svg",
+            "tree_2.svg",
+        ])
+
+        self.assertEqual(utils.tree_svg_pairs(files), [("tree_10", "tree_10.svg"), ("tree_1", "tree_1.phy_phyml_tree.txt.svg"), ("tree_1", "tree_1.svg")])
+
+    # Tests for Tree.record_files
+
+    def test_tree_record_files_should_store_files_and_look_them_up(self):
+        """ Tree.record_files should store the tree's files, which are then found without the project directory """
+
+        with tempfile.TemporaryDirectory() as directory, self.settings(PROJECT_PATH=directory):
+            os.makedirs(os.path.join(directory, "record"))
+            shutil.copy("/phylobook/test_data/with_timepoints.svg", os.path.join(directory, "record", "record_tree.svg"))
+            shutil.copy("/phylobook/test_data/with_timepoints.fasta", os.path.join(directory, "record", "record_tree.fasta"))
+
+            tree = Tree.objects.create(project=Project.objects.create(name="record"), name="record_tree")
+            files: dict = {file.role: file for file in tree.record_files()}
+
+            self.assertEqual(sorted(files), ["fasta", "original_fasta", "svg"])
+            self.assertEqual(files["svg"].path, "record_tree.svg")
+            self.assertIs(files["svg"].hash, None)
+
+            files = {file.role: file for file in tree.record_files(hash=True)}
+
+            self.assertEqual(files["svg"].hash, utils.file_hash(file_name="/phylobook/test_data/with_timepoints.svg"))
+            self.assertIs(files["svg"].verify(contents=True), None)
+
+            # A recorded file that has been renamed or deleted is looked for in the project directory again
+            os.rename(os.path.join(directory, "record", "record_tree.svg"), os.path.join(directory, "record", "record_tree.phy_phyml_tree.txt.svg"))
+            tree = Tree.objects.get(pk=tree.pk)
+
+            self.assertEqual(tree.svg_file_name, os.path.join(directory, "record", "record_tree.phy_phyml_tree.txt.svg"))
+            self.assertEqual(tree.stored_files()["svg"].verify(), "record_tree.svg is missing")
+
+            os.remove(os.path.join(directory, "record", "record_tree.phy_phyml_tree.txt.svg"))
+
+            self.assertIs(tree.svg_file_name, None)
+
+            tree.record_files()
+            self.assertNotIn("svg", Tree.objects.get(pk=tree.pk).stored_files())
+
+    def test_tree_stored_file_hash_should_come_from_a_current_record(self):
+        """ Tree.stored_file_hash should store and reuse the recorded hash, and only hash the file again once it changes """
+
+        with tempfile.TemporaryDirectory() as directory, self.settings(PROJECT_PATH=directory):
+            os.makedirs(os.path.join(directory, "hashed"))
+            file_name: str = os.path.join(directory, "hashed", "hashed_tree.fasta")
+            shutil.copy("/phylobook/test_data/with_timepoints.fasta", file_name)
+
+            tree = Tree.objects.create(project=Project.objects.create(name="hashed"), name="hashed_tree")
+            tree.record_files()
+
+            self.assertEqual(tree.stored_file_hash("fasta"), utils.file_hash(file_name=file_name))
+            self.assertEqual(TreeFile.objects.get(tree=tree, role="fasta").hash, utils.file_hash(file_name=file_name))
+
+            # The record is trusted while the file's size and modification time match it
+            TreeFile.objects.filter(tree=tree, role="fasta").update(hash="0" * 32)
+            tree = Tree.objects.get(pk=tree.pk)
+
+            self.assertEqual(tree.stored_file_hash("fasta"), "0" * 32)
+
+            os.utime(file_name, (os.path.getmtime(file_name) + 10,) * 2)
+            tree = Tree.objects.get(pk=tree.pk)
+
+            self.assertEqual(tree.stored_file_hash("fasta"), utils.file_hash(file_name=file_name))
+            self.assertIs(tree.stored_file_hash("dist"), None)
+
+    def test_tree_highlighter_tile_should_be_redrawn_once_the_tree_changes(self):
+        """ A highlighter tile older than the tree's SVG is stale, and is drawn again on its own """
+
+        with tempfile.TemporaryDirectory() as directory, self.settings(PROJECT_PATH=directory):
+            os.makedirs(os.path.join(directory, "tiles"))
+            shutil.copy("/phylobook/test_data/with_timepoints.svg", os.path.join(directory, "tiles", "tiles_tree.svg"))
+            shutil.copy("/phylobook/test_data/with_timepoints.fasta", os.path.join(directory, "tiles", "tiles_tree.fasta"))
+
+            alignment = AlignIO.read("/phylobook/test_data/with_timepoints.fasta", "fasta")
+            Phylo.write(Phylo.BaseTree.Tree(Phylo.BaseTree.Clade(clades=[Phylo.BaseTree.Clade(name=sequence.id, branch_length=1) for sequence in alignment])), os.path.join(directory, "tiles", "tiles_tree_newick.tre"), "newick")
+
+            tree = Tree.objects.create(project=Project.objects.create(name="tiles"), name="tiles_tree")
+            file_name: str = tree.highlighter_tile_file_name(level=1, column=0, row=1)
+
+            self.assertTrue(tree.has_highlighter_tile(level=1, column=0, row=1))
+            self.assertEqual(os.listdir(os.path.dirname(file_name)), ["0_1.svg"])
+            self.assertFalse(tree.has_highlighter_tile(level=1, column=2, row=0))
+
+            # Rewriting the tree SVG (as recoloring does) makes the tile stale
+            drawn: float = os.path.getmtime(file_name)
+            os.utime(tree.svg_file_name, (drawn + 10, drawn + 10))
+
+            self.assertFalse(tree.has_highlighter_tile(level=1, column=0, row=1, no_build=True))
+            self.assertTrue(tree.has_highlighter_tile(level=1, column=0, row=1))
+            self.assertGreater(os.path.getmtime(file_name), drawn)
+
+    def test_tree_highlighter_tiles_should_be_kept_between_sessions(self):
+        """ Tile requests should share one cached tile pyramid until the tree changes, and tiles can be drawn as PNGs """
+
+        with tempfile.TemporaryDirectory() as directory, self.settings(PROJECT_PATH=directory):
+            os.makedirs(os.path.join(directory, "tiles"))
+            shutil.copy("/phylobook/test_data/with_timepoints.svg", os.path.join(directory, "tiles", "tiles_tree.svg"))
+            shutil.copy("/phylobook/test_data/with_timepoints.fasta", os.path.join(directory, "tiles", "tiles_tree.fasta"))
+
+            alignment = AlignIO.read("/phylobook/test_data/with_timepoints.fasta", "fasta")
+            Phylo.write(Phylo.BaseTree.Tree(Phylo.BaseTree.Clade(clades=[Phylo.BaseTree.Clade(name=sequence.id, branch_length=1) for sequence in alignment])), os.path.join(directory, "tiles", "tiles_tree_newick.tre"), "newick")
+
+            tree = Tree.objects.create(project=Project.objects.create(name="tiles"), name="tiles_tree")
+            tiles: HighlighterTiles = tree.highlighter_session().tiles(width=3)
+
+            self.assertIs(Tree.objects.get(pk=tree.pk).highlighter_session().tiles(width=3), tiles)
+            self.assertIsNot(tree.highlighter_session().tiles(width=3, output_format="png"), tiles)
+            self.assertGreater(highlighter_tiles_cache.bytes, len(alignment) * len(alignment[0]))
+
+            self.assertTrue(tree.has_highlighter_tile(level=1, column=1, row=1, width=3, output_format="png"))
+            self.assertEqual(os.listdir(os.path.join(tree.highlighter_tiles_directory(width=3), "1")), ["1_1.png"])
+
+            with open(tree.highlighter_tile_file_name(level=1, column=1, row=1, width=3, output_format="png"), "rb") as file:
+                self.assertEqual(file.read(8), b"\x89PNG\r\n\x1a\n")
+
+            # Rewriting the tree SVG loads the tree again
+            os.utime(tree.svg_file_name, (os.path.getmtime(tree.svg_file_name) + 10,) * 2)
+
+            self.assertIsNot(tree.highlighter_session().tiles(width=3), tiles)
+
     # Tests for lineage_dict
 
     def test_lineage_dict_should_return_dictionary(self):
@@ -272,6 +501,25 @@ class PhyloTreeTests(SimpleTestCase):
 
         self.assertIn("box", self.phylotree.sequences["TP_2_101_16"])
 
+    def test_phylotree_sequences_should_be_readable_like_dicts(self):
+        """ PhyloTree sequences should be TreeSequences that can be read like dicts """
+
+        sequence = self.phylotree.sequences["TP_2_101_16"]
+
+        self.assertIsInstance(sequence, utils.TreeSequence)
+        self.assertEqual(sequence["color"], sequence.color)
+        self.assertEqual(sequence["multiplicity"], 16)
+        self.assertEqual(sequence.get("bad_field", "default"), "default")
+
+        with self.assertRaises(KeyError):
+            sequence["bad_field"]
+
+        with self.assertRaises(AttributeError):
+            sequence.bad_field = None
+
+        self.assertIn(sequence, self.phylotree.tree_sequence_names())
+        self.assertEqual(len(self.phylotree.tree_sequence_names()), len(self.phylotree.sequences))
+
     def test_phylobtree_lineage_counts_returns_correct_counts(self):
         """ PhyloTree lineage counts returns correct counts """
 
@@ -307,6 +555,22 @@ class PhyloTreeTests(SimpleTestCase):
         self.assertEqual(utils.file_hash(file_name="/phylobook/test_data/with_timepoints_changed.svg"), "ea9bb2da5eaaf4ff4292a7bcfeda7681")
         os.remove("/phylobook/test_data/with_timepoints_changed.svg")
     
+    def test_phylotree_change_lineage_updates_counts(self):
+        """ PhyloTree change lineage moves the sequence's multiplicity to the new lineage's counts """
+
+        self.phylotree.change_lineage(sequence="TP_2_101_16", color="neonblue")
+        self.assertEqual(self.phylotree.lineage_counts["red"], {'timepoints': {"100": 38, "101": 16, "102": 0, "103": 0, "104": 0}, 'total': 54})
+        self.assertEqual(self.phylotree.lineage_counts["neonblue"], {'timepoints': {"100": 0, "101": 23, "102": 10, "103": 8, "104": 1}, 'total': 42})
+
+        for name in [name for name, sequence in self.phylotree.sequences.items() if sequence["color"] == "neonblue"]:
+            self.phylotree.change_lineage(sequence=name, color="lavender")
+
+        changed_counts: dict = self.phylotree.lineage_counts
+
+        self.phylotree._prep_tree_lineage_counts()
+        self.assertEqual(changed_counts, self.phylotree.lineage_counts)
+        self.assertNotIn("neonblue", self.phylotree.lineage_counts)
+
     def test_phylotree_swap_lineages_raises_exception_given_bad_color(self):
         """ PhyloTree swap lineages raises exception given bad color """
 
@@ -329,6 +593,19 @@ class PhyloTreeTests(SimpleTestCase):
         self.assertEqual(utils.file_hash(file_name="/phylobook/test_data/with_timepoints_changed.svg"), "3a1b67a4bf3c88cdf6bd34e96dad2f4f")
         os.remove("/phylobook/test_data/with_timepoints_changed.svg")
 
+    def test_phylotree_swap_lineages_counts_match_a_recount(self):
+        """ PhyloTree swap lineages keeps the counts and color index the same as recounting the tree """
+
+        self.phylotree.swap_lineages("neonblue", "red")
+        self.phylotree.swap_lineages("red", "green")
+        swapped_counts: dict = self.phylotree.lineage_counts
+
+        self.phylotree._prep_tree_lineage_counts()
+        self.assertEqual(swapped_counts, self.phylotree.lineage_counts)
+
+        for color, names in self.phylotree._by_color.items():
+            self.assertEqual(names, {name for name, sequence in self.phylotree.sequences.items() if sequence["color"] == color})
+
     def test_phylotree_should_swap_returns_none_if_no_swap_needed(self):
         """ PhyloTree should swap returns None if no swap needed """
 
@@ -393,4 +670,390 @@ class PhyloTreeTests(SimpleTestCase):
     def test_phylotree_should_show_no_unassigned_sequences_if_there_are_none(self):
         """ PhyloTree should show no unassigned sequences if there are none """
 
-        self.assertEqual(self.phylotree.unassigned_sequences, 0)
\ No newline at end of file
+        self.assertEqual(self.phylotree.unassigned_sequences, 0)
+
+    def test_phylotree_save_should_raise_exception_if_file_changed_since_load(self):
+        """ PhyloTree save should refuse to merge its lineages into a tree file that was replaced after loading """
+
+        with tempfile.TemporaryDirectory() as directory:
+            file_name: str = os.path.join(directory, "tree.svg")
+            shutil.copyfile("/phylobook/test_data/with_timepoints.svg", file_name)
+
+            phylotree = utils.PhyloTree(file_name=file_name)
+            shutil.copyfile("/phylobook/test_data/without_timepoints.svg", file_name)
+
+            with self.assertRaises(utils.TreeFileChanged):
+                phylotree.save()
+
+            self.assertEqual(utils.file_hash(file_name=file_name), utils.file_hash(file_name="/phylobook/test_data/without_timepoints.svg"))
+            self.assertEqual(os.listdir(directory), ["tree.svg"])
+
+    def test_phylotree_save_should_match_elementtree_write(self):
+        """ PhyloTree save should write the same namespaces, prefixes and escapes as ElementTree.write """
+
+        import xml.etree.ElementTree as ET
+
+        with tempfile.TemporaryDirectory() as directory:
+            file_name: str = os.path.join(directory, "tree.svg")
+
+            with open(file_name, "w") as svg_file:
+                svg_file.write('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" xmlns:x="urn:example">'
+                    '<x:note x:kind="a &amp; &quot;b&quot;&#10;c">1 &lt; 2</x:note>'
+                    '<a xlink:href="#TP_1"><text class="box" x="5" xml:space="preserve">TP_1</text></a>'
+                    '<path id="TP_1" style="stroke: #000000;" />tail &gt;</svg>')
+
+            ET.register_namespace("", "http://www.w3.org/2000/svg")
+            expected: bytes = ET.tostring(ET.parse(file_name).getroot())
+
+            utils.PhyloTree(file_name=file_name).save()
+
+            with open(file_name, "rb") as svg_file:
+                self.assertEqual(svg_file.read(), expected)
+
+
+class HighlighterTests(SimpleTestCase):
+    """ Tests for the Highlighter class """
+
+    @classmethod
+    def setUp(self):
+        """ Set up whatever objects are going to be needed for all tests """
+
+        self.alignment = AlignIO.read("/phylobook/test_data/with_timepoints.fasta", "fasta")
+        self.highlighter = Highlighter(self.alignment, seq_type="NT")
+
+    def test_vectorized_mismatches_match_per_sequence_mismatches(self):
+        """ Vectorized mismatches should be the same as comparing each sequence in turn """
+
+        options: dict = {"apobec": True, "g_to_a": True, "stop_codons": True}
+
+        self.assertEqual(self.highlighter.list_mismatches(vectorized=True, **options), self.highlighter.list_mismatches(vectorized=False, **options))
+
+    def test_vectorized_mismatches_include_reference_stop_codons(self):
+        """ Vectorized mismatches should mark stop codons in the reference itself """
+
+        mismatches = self.highlighter.list_mismatches(references=1, stop_codons=True)
+
+        self.assertGreater(len(mismatches[1]), 0)
+        self.assertTrue(all(codes == ["Stop codon"] for codes in mismatches[1].values()))
+
+    def test_vectorized_matches_match_per_sequence_matches(self):
+        """ Bitmask matches should be the same as comparing each sequence in turn """
+
+        references: list = [0, self.alignment[5].seq, 9]
+
+        self.assertEqual(self.highlighter.list_matches(references=references, vectorized=True), self.highlighter.list_matches(references=references, vectorized=False))
+
+    def test_match_masks_should_be_full_for_references(self):
+        """ Reference sequences should match themselves everywhere """
+
+        masks = self.highlighter.list_match_masks(references=[0, 9])
+
+        self.assertTrue((masks[0] == 0b11).all())
+        self.assertTrue((masks[9] == 0b11).all())
+
+    def test_mismatch_intervals_should_match_per_sequence_mismatches(self):
+        """ Vectorized mismatch intervals should be the same as encoding each sequence's mismatches in turn """
+
+        options: dict = {"apobec": True, "g_to_a": True, "stop_codons": True}
+
+        self.assertEqual(self.highlighter.list_mismatch_intervals(vectorized=True, **options), self.highlighter.list_mismatch_intervals(vectorized=False, **options))
+
+    def test_duplicate_sequences_should_be_compared_once(self):
+        """ Identical sequences should share a distinct row and still get their own marks """
+
+        alignment = MultipleSeqAlignment(list(self.alignment) + list(self.alignment[:5]))
+        highlighter = Highlighter(alignment, seq_type="NT")
+
+        self.assertEqual(len(highlighter.matrix.distinct), len(self.alignment))
+        self.assertAlmostEqual(highlighter.matrix.dedupe_ratio, len(alignment) / len(self.alignment))
+        self.assertEqual(highlighter.list_mismatches(references=3, g_to_a=True), highlighter.list_mismatches(references=3, g_to_a=True, vectorized=False))
+        self.assertEqual(highlighter.list_matches(references=[0, 7]), highlighter.list_matches(references=[0, 7], vectorized=False))
+
+    def test_row_ranges_should_cover_rows_in_blocks(self):
+        """ row_ranges should split rows into contiguous ranges of at least BLOCK_ROWS rows """
+
+        self.assertEqual(row_ranges(10, 4), [(0, 10)])
+        self.assertEqual(row_ranges(BLOCK_ROWS * 3, 2), [(0, BLOCK_ROWS * 3 // 2), (BLOCK_ROWS * 3 // 2, BLOCK_ROWS * 3)])
+
+    def test_parallel_intervals_should_match_serial_intervals(self):
+        """ Splitting the alignment across processes should give the same intervals in the same order """
+
+        reference: str = str(self.alignment[0].seq)
+        records: list[SeqRecord] = []
+
+        for index in range(BLOCK_ROWS * 2 + 1):
+            sequence: list[str] = list(reference)
+            sequence[index % len(sequence)] = "-"
+            sequence[(index * 7) % len(sequence)] = "A"
+            records.append(SeqRecord(Seq("".join(sequence)), id=f"sequence_{index}"))
+
+        highlighter = Highlighter(MultipleSeqAlignment(records), seq_type="NT")
+
+        self.assertEqual(highlighter.list_mismatch_intervals(g_to_a=True, stop_codons=True, processes=2), highlighter.list_mismatch_intervals(g_to_a=True, stop_codons=True))
+        self.assertEqual(highlighter.list_match_intervals(references=[0, 1], processes=2), highlighter.list_match_intervals(references=[0, 1]))
+
+    def test_intervals_encode_should_skip_background_runs(self):
+        """ Intervals.encode should give one run per stretch of equal codes, leaving out the background """
+
+        intervals = Intervals.encode(np.array([0, 3, 3, 0, 0, 5, 3, 3], dtype=np.uint16))
+
+        self.assertEqual(list(intervals), [(1, 2, 3), (5, 1, 5), (6, 2, 3)])
+        self.assertEqual(intervals.marked, 5)
+        self.assertEqual(intervals.positions(), [1, 2, 5, 6, 7])
+
+    def test_export_mismatches_should_stream_to_files_and_file_like_objects(self):
+        """ Exporting to a file name or a file-like object should write the same report as the report iterator """
+
+        report: str = "".join(self.highlighter.mismatch_report(g_to_a=True, apobec=True))
+        buffer = io.StringIO()
+
+        self.highlighter.export_mismatches(buffer, g_to_a=True, apobec=True)
+        self.assertEqual(buffer.getvalue(), report)
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.highlighter.export_mismatches(os.path.join(directory, "mismatches.txt"), g_to_a=True, apobec=True)
+
+            with open(os.path.join(directory, "mismatches.txt")) as file:
+                self.assertEqual(file.read(), report)
+
+    def test_match_report_should_have_a_block_per_sequence(self):
+        """ The match report should yield one block for each sequence, labelling the references """
+
+        blocks: list[str] = list(self.highlighter.match_report(references=[0, 9]))
+
+        self.assertEqual(len(blocks), len(self.alignment))
+        self.assertTrue(blocks[9].startswith(f"{self.alignment[9].id} (R2)\n"))
+
+    def test_highlighter_index_should_reuse_stored_intervals(self):
+        """ A saved index should give the same intervals, and be ignored once the FASTA hash changes """
+
+        options: dict = {"apobec": True, "g_to_a": True, "glycosylation": True}
+        expected_mismatches: list[Intervals] = self.highlighter.list_mismatch_intervals(**options)
+        expected_matches: list[Intervals] = self.highlighter.list_match_intervals(references=[0, 9])
+
+        with tempfile.TemporaryDirectory() as directory:
+            file_name: str = os.path.join(directory, "tree_highlighter_index.npz")
+
+            index = HighlighterIndex(file_name, fasta_hash="first")
+            Highlighter(self.alignment, seq_type="NT", index=index).list_mismatch_intervals(**options)
+            Highlighter(self.alignment, seq_type="NT", index=index).list_match_intervals(references=[0, 9])
+            index.save()
+
+            index = HighlighterIndex(file_name, fasta_hash="first")
+            self.assertFalse(index.changed)
+            self.assertEqual(Highlighter(self.alignment, seq_type="NT", index=index).list_mismatch_intervals(**options), expected_mismatches)
+            self.assertEqual(Highlighter(self.alignment, seq_type="NT", index=index).list_match_intervals(references=[0, 9]), expected_matches)
+            self.assertFalse(index.changed)
+
+            self.assertEqual(HighlighterIndex(file_name, fasta_hash="second").arrays, {})
+
+    def test_streamed_svg_should_draw_the_same_shapes_as_reportlab(self):
+        """ The streaming SVG backend should write the same elements as the reportlab backend, and keep the viewBox """
+
+        counts: dict[str: dict] = {}
+
+        with tempfile.TemporaryDirectory() as directory:
+            for backend in ("reportlab", "stream"):
+                file_name: str = os.path.join(directory, f"{backend}.svg")
+                HighlighterPlot(self.alignment).draw_mismatches(file_name, apobec=True, g_to_a=True, backend=backend)
+
+                with open(file_name) as file:
+                    svg: str = file.read()
+
+                counts[backend] = {element: svg.count(f"<{element} ") for element in ("polygon", "circle", "text")}
+                self.assertIn('viewBox="0 0 ', svg)
+
+            self.assertEqual(sorted(os.listdir(directory)), ["reportlab.svg", "stream.svg"])
+
+        self.assertEqual(counts["stream"], counts["reportlab"])
+
+    def test_failed_drawing_should_not_leave_partial_output(self):
+        """ A plot that fails part way through drawing should close and remove its partial file for every backend """
+
+        class FailingPlot(HighlighterPlot):
+            def _draw_marks_mismatch(self, plot_index, mismatches, is_reference=False):
+                raise RuntimeError("drawing failed")
+
+            def _draw_title(self):
+                if self.plot_type == "match":
+                    raise RuntimeError("drawing failed")
+
+                super()._draw_title()
+
+        with tempfile.TemporaryDirectory() as directory:
+            for backend, output_format in (("stream", "svg"), ("paths", "svg"), ("raster", "png")):
+                file_name: str = os.path.join(directory, f"{backend}.{output_format}")
+
+                with self.assertRaises(RuntimeError):
+                    FailingPlot(self.alignment).draw_mismatches(file_name, output_format=output_format, backend=backend)
+
+                with self.assertRaises(RuntimeError):
+                    FailingPlot(self.alignment).draw_matches(file_name, references=[0, 1], output_format=output_format, backend=backend)
+
+                with self.assertRaises(Exception):
+                    HighlighterPlot(self.alignment).draw_mismatches(file_name, reference=len(self.alignment) + 5, output_format=output_format, backend=backend)
+
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_path_svg_should_batch_marks_by_color_and_glyphs_by_symbol(self):
+        """ The path backend should write one path per mark color, and one <use> for every glyph the stream backend draws """
+
+        with tempfile.TemporaryDirectory() as directory:
+            svgs: dict[str: str] = {}
+
+            for backend in ("stream", "paths"):
+                file_name: str = os.path.join(directory, f"{backend}.svg")
+                HighlighterPlot(self.alignment).draw_mismatches(file_name, apobec=True, g_to_a=True, backend=backend)
+
+                with open(file_name) as file:
+                    svgs[backend] = file.read()
+
+        rect_fills: set[str] = {line.split('fill="')[1].split('"')[0] for line in svgs["stream"].splitlines() if line.startswith("<rect ")}
+
+        self.assertEqual(svgs["paths"].count("<rect "), 0)
+        self.assertEqual(svgs["paths"].count("<path "), len(rect_fills))
+        self.assertEqual(sum(svgs["paths"].count(f'm{command}') for command in "-0123456789"), svgs["stream"].count("<rect "))
+        self.assertEqual(svgs["paths"].count("<use "), svgs["stream"].count("<polygon ") + svgs["stream"].count("<circle "))
+        self.assertIn('viewBox="0 0 ', svgs["paths"])
+
+    def test_highlighter_tiles_should_split_each_level_into_tiles(self):
+        """ Each level of the tile pyramid should be 2**level tiles on a side, with marks only in the tiles they cover """
+
+        with tempfile.TemporaryDirectory() as directory:
+            tiles = HighlighterTiles(self.alignment, directory, tile_size=64)
+            file_names: list[str] = tiles.draw_mismatches(levels=[0, 1], apobec=True, g_to_a=True)
+
+            self.assertEqual(len(file_names), 1 + 4)
+            self.assertTrue(all(os.path.exists(file_name) for file_name in file_names))
+            self.assertEqual(tiles.tile_file_name(1, 1, 0), os.path.join(directory, "1", "1_0.svg"))
+
+            self.assertTrue(tiles.has_tile(tiles.levels-1, 0, 0))
+            self.assertFalse(tiles.has_tile(tiles.levels, 0, 0))
+            self.assertFalse(tiles.has_tile(1, 2, 0))
+
+            with open(tiles.tile_file_name(0, 0, 0)) as file:
+                tile: str = file.read()
+
+            self.assertIn('viewBox="0 0 64 64"', tile)
+            self.assertIn("<path ", tile)
+
+    def test_highlighter_tile_should_be_drawn_on_its_own(self):
+        """ Drawing one tile should write only that tile, the same as it is when its whole level is drawn """
+
+        with tempfile.TemporaryDirectory() as level_directory, tempfile.TemporaryDirectory() as tile_directory:
+            HighlighterTiles(self.alignment, level_directory, tile_size=64).draw_mismatches(levels=2, apobec=True, g_to_a=True)
+
+            tiles = HighlighterTiles(self.alignment, tile_directory, tile_size=64)
+            file_name: str = tiles.draw_tile(2, 1, 2, apobec=True, g_to_a=True)
+
+            self.assertEqual(file_name, tiles.tile_file_name(2, 1, 2))
+            self.assertEqual(os.listdir(tiles.level_directory(2)), ["1_2.svg"])
+
+            with open(file_name) as tile, open(os.path.join(level_directory, "2", "1_2.svg")) as level_tile:
+                self.assertEqual(tile.read(), level_tile.read())
+
+            with self.assertRaises(ValueError):
+                tiles.draw_tile(2, 4, 0)
+
+    def test_highlighter_tiles_should_reuse_a_level_for_each_tile(self):
+        """ Tiles of one level should share the level's mismatches and sort order, and still match the tiles of the whole level """
+
+        with tempfile.TemporaryDirectory() as level_directory, tempfile.TemporaryDirectory() as tile_directory:
+            HighlighterTiles(self.alignment, level_directory, tile_size=64).draw_mismatches(levels=2, apobec=True, g_to_a=True)
+
+            tiles = HighlighterTiles(self.alignment, tile_directory, tile_size=64)
+            tiles.draw_tile(2, 0, 0, apobec=True, g_to_a=True)
+
+            plot: HighlighterPlot = tiles._level_plots[2]
+            matches_list: list[Intervals] = plot.matches_list
+            sorted_keys: list[int] = plot.sorted_keys
+
+            for column, row in ((1, 2), (3, 3)):
+                file_name: str = tiles.draw_tile(2, column, row, apobec=True, g_to_a=True)
+
+                with open(file_name) as tile, open(os.path.join(level_directory, "2", f"{column}_{row}.svg")) as level_tile:
+                    self.assertEqual(tile.read(), level_tile.read())
+
+            self.assertIs(plot.matches_list, matches_list)
+            self.assertIs(plot.sorted_keys, sorted_keys)
+
+            # Other mismatch options find the mismatches again
+            tiles.draw_tile(2, 0, 0, apobec=False, g_to_a=True)
+            self.assertIsNot(plot.matches_list, matches_list)
+
+    def test_raster_png_should_paint_marks_into_pixels(self):
+        """ The raster backend should write a PNG of the plot's size with the mark colors painted in, a band of rows at a time """
+
+        buffer = io.BytesIO()
+        plot = HighlighterPlot(self.alignment)
+        plot.draw_mismatches(buffer, output_format="png", apobec=True, g_to_a=True, scale=.25)
+        png: bytes = buffer.getvalue()
+
+        self.assertTrue(png.startswith(b"\x89PNG\r\n\x1a\n"))
+
+        width, height = struct.unpack(">II", png[16:24])
+        self.assertEqual((width, height), (plot.canvas.pixel_width, math.ceil(plot._height)))
+        self.assertGreater(plot.canvas.bands, 1)
+        self.assertEqual(plot.canvas.pixels.shape[0], height - (plot.canvas.bands-1) * PNG_BAND_ROWS)
+
+        # A single IDAT chunk follows IHDR, and every row starts with its filter byte
+        size: int = struct.unpack(">I", png[33:37])[0]
+        rows: np.ndarray = np.frombuffer(zlib.decompress(png[41:41+size]), dtype=np.uint8).reshape(height, width*3+1)
+
+        painted: set[tuple] = {tuple(pixel) for pixel in rows[:, 1:].reshape(-1, 3).tolist()}
+        self.assertIn(rgb(plot._hex_to_color("#FF00FF")), painted)
+        self.assertTrue(any(rgb(plot._hex_to_color(color)) in painted for color in plot.mismatch_plot_colors["NT"]["LANL"].values()))
+
+    def test_raster_png_should_refuse_marks_above_painted_bands(self):
+        """ Marks drawn back up the plot would land in bands that are already compressed """
+
+        canvas = RasterCanvas(io.BytesIO(), width=10, height=PNG_BAND_ROWS * 3)
+        canvas.mark(0, 10, 5, 5, fill=colors.red, stroke=colors.red)
+
+        with self.assertRaises(ValueError):
+            canvas.mark(0, PNG_BAND_ROWS * 3 - 10, 5, 5, fill=colors.red, stroke=colors.red)
+
+    def test_string_width_should_match_reportlab(self):
+        """ Widths from the glyph width table should be exactly reportlab's stringWidth """
+
+        for record in self.alignment:
+            for font_size in (8, 12.5, 16):
+                self.assertEqual(string_width(f"{record.id} (r10)", "Helvetica", font_size), stringWidth(f"{record.id} (r10)", "Helvetica", font_size))
+
+        self.assertEqual(string_width("Wé@", "Times-Roman", 10), stringWidth("Wé@", "Times-Roman", 10))
+
+    def test_gap_index_codon_position_should_match_codon_position(self):
+        """ GapIndex.codon_position should give the same answer as counting gaps """
+
+        sequence: str = "AT-G--CAT-GC"
+        gap_index = GapIndex(sequence)
+
+        for base in [base for base, symbol in enumerate(sequence) if symbol != "-"]:
+            self.assertEqual(gap_index.codon_position(base, codon_offset=1), codon_position(sequence, base, codon_offset=1))
+
+    def test_gap_index_next_ungapped_should_skip_gaps(self):
+        """ GapIndex.next_ungapped should return the following bases with gaps removed """
+
+        gap_index = GapIndex("T-A--G-C")
+
+        self.assertEqual(gap_index.next_ungapped(0), "AG")
+        self.assertEqual(gap_index.next_ungapped(5), "C")
+        self.assertEqual(gap_index.next_ungapped(7), "")
+
+    def test_bounded_cache_should_evict_least_recently_used(self):
+        """ BoundedCache should stay within its byte budget and count hits, misses and evictions """
+
+        value: str = "A" * 100
+        cache = BoundedCache(name="test", max_bytes=approximate_size(value) * 2)
+
+        cache.store("first", value)
+        cache.store("second", value)
+        cache.lookup("first")
+        cache.store("third", value)
+
+        self.assertEqual(cache.lookup("second"), (False, None))
+        self.assertEqual(cache.lookup("first"), (True, value))
+        self.assertLessEqual(cache.bytes, cache.max_bytes)
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertEqual(cache.stats()["evictions"], 1)
@@ -33,10 +33,17 @@ urlpatterns = [
     path("match_image_no_multiple/<str:project>/<str:tree>", views.MatchImage.as_view(), {"multiple": False}, name="match_image_no_multiple"),
     path("match_image_no_multiple/<str:project>/<str:tree>/<str:throwaway>", views.MatchImage.as_view(), {"multiple": False}, name="match_image_no_multiple_throwaway"),
     
+    path("highlighter_tile/<str:project>/<str:tree>/<int:level>/<int:column>/<int:row>", views.HighlighterTile.as_view(), name="highlighter_tile"),
+    path("highlighter_tile/<str:project>/<str:tree>/<int:level>/<int:column>/<int:row>/<str:format>", views.HighlighterTile.as_view(), name="highlighter_tile_format"),
+    path("highlighter_zoom/<str:project>/<str:tree>", views.HighlighterZoom.as_view(), name="highlighter_zoom"),
+    path("highlighter_zoom/<str:project>/<str:tree>/<int:level>", views.HighlighterZoom.as_view(), name="highlighter_zoom_level"),
+    
     path("import_project", views.ImportProject.as_view(), name="import_project"),
     path("import_project/status", views.ImportProcessStatus.as_view(), name="import_project_status"),
     path("project_name_available/<str:project_name>", views.ProjectNameAvailable.as_view(), name="project_name_available"),
     
+    path("_stats/highlighter_cache", views.HighlighterCacheStats.as_view(), name="highlighter_cache_stats"),
+    
     path("<str:name>", login_required(views.displayProject)),
     path("<str:name>/<int:start>-<int:end>", login_required(views.displayProject), name="project_by_page"),
     path("<str:name>/<int:start>-<int:end>/<str:file>", login_required(views.getFile), name="get_file_by_page"),
@@ -0,0 +1,152 @@
+""" A memory bounded cache for results that are expensive to compute """
+
+import hashlib, sys, threading
+from collections import OrderedDict
+from functools import wraps
+from typing import Any, Callable
+
+
+class BoundedCache:
+    """ A least recently used cache that holds at most max_bytes of (approximately measured) values """
+
+    def __init__(self, *, name: str, max_bytes: int):
+        """ Set up an empty cache """
+
+        self.name: str = name
+        self.max_bytes: int = max_bytes
+
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.bytes: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    def __len__(self) -> int:
+        """ Returns the number of entries in the cache """
+
+        return len(self._entries)
+
+    def lookup(self, key: Any) -> tuple[bool, Any]:
+        """ Returns (True, value) if the key is cached, or (False, None) if it isn't """
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+
+                return True, self._entries[key][0]
+
+            self.misses += 1
+
+        return False, None
+
+    def store(self, key: Any, value: Any) -> None:
+        """ Store a value, evicting the least recently used entries until it fits """
+
+        size: int = approximate_size(value)
+
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._entries.pop(key)[1]
+
+            self._entries[key] = (value, size)
+            self.bytes += size
+
+            self._evict()
+
+    def resize(self, max_bytes: int) -> None:
+        """ Change the memory budget, evicting entries if the cache is now too big """
+
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self) -> None:
+        """ Remove every entry and reset the counters """
+
+        with self._lock:
+            self._entries.clear()
+            self.bytes = self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict[str: Any]:
+        """ Returns the hit, miss and size counters for logging """
+
+        return {
+            "name": self.name,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _evict(self) -> None:
+        """ Drop least recently used entries until the cache is within its budget (call with the lock held) """
+
+        while self.bytes > self.max_bytes and self._entries:
+            _, (_, size) = self._entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+
+def cached(cache: BoundedCache) -> Callable:
+    """ Decorator that memoizes a function in a BoundedCache
+    string arguments are keyed by a digest so the cache doesn't keep whole sequences alive """
+
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            key: tuple = (function.__qualname__, hash_key(args), hash_key(tuple(sorted(kwargs.items()))))
+
+            found, value = cache.lookup(key)
+            if found:
+                return value
+
+            value = function(*args, **kwargs)
+            cache.store(key, value)
+
+            return value
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
+
+
+def hash_key(value: Any) -> Any:
+    """ Returns a hashable key for a value, with strings replaced by a short digest """
+
+    if isinstance(value, str):
+        return hashlib.blake2b(value.encode(), digest_size=16).digest()
+
+    if isinstance(value, (tuple, list)):
+        return tuple(hash_key(item) for item in value)
+
+    return value
+
+
+def approximate_size(value: Any) -> int:
+    """ Returns the approximate memory used by a value and the containers inside it """
+
+    size: int = sys.getsizeof(value)
+
+    if isinstance(value, dict):
+        size += sum(approximate_size(key) + approximate_size(item) for key, item in value.items())
+
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(approximate_size(item) for item in value)
+
+    return size
+
+
+highlighter_cache = BoundedCache(name="highlighter", max_bytes=64 * 1024 * 1024)
+project_pages_cache = BoundedCache(name="project pages", max_bytes=4 * 1024 * 1024)
+project_manifests_cache = BoundedCache(name="project manifests", max_bytes=16 * 1024 * 1024)
+svg_dimensions_cache = BoundedCache(name="svg dimensions", max_bytes=1024 * 1024)
+highlighter_tiles_cache = BoundedCache(name="highlighter tiles", max_bytes=128 * 1024 * 1024)
@@ -1,7 +1,7 @@
 import logging
 log = logging.getLogger('app')
 
-import os, glob, zipfile
+import bisect, os, zipfile
 
 from django.conf import settings
 
@@ -9,17 +9,43 @@ from Bio.Align import MultipleSeqAlignment
 import xml.etree.ElementTree as ET
 
 from phylobook.projects.models import Tree, Project, Lineage
+from phylobook.projects.utils.cache import svg_dimensions_cache
 
 
 def svg_dimensions(svg_file_name: str) -> tuple[int, int]:
-    """ Returns the dimensions of an svg file as a tuple of (width, height) """
+    """ Returns the dimensions of an svg file as a tuple of (width, height), from the viewBox of its root element
+    the result is cached until the file's modification time or size changes """
 
-    tree_svg = ET.parse(svg_file_name)
-    root = tree_svg.getroot()
-    view_box = root.attrib["viewBox"]
-    _, _, width, height = view_box.split(" ")
+    stat = os.stat(svg_file_name)
+    key: tuple = (svg_file_name, stat.st_mtime_ns, stat.st_size)
 
-    return (int(float(width)), int(float(height)))
+    found, dimensions = svg_dimensions_cache.lookup(key)
+
+    if found:
+        return dimensions
+
+    view_box = svg_root_attributes(svg_file_name)["viewBox"]
+    _, _, width, height = view_box.replace(",", " ").split()
+
+    dimensions: tuple[int, int] = (int(float(width)), int(float(height)))
+    svg_dimensions_cache.store(key, dimensions)
+
+    return dimensions
+
+
+def svg_root_attributes(svg_file_name: str, *, chunk_size: int=4096) -> dict[str: str]:
+    """ Returns the attributes of the root element of an svg file, reading and parsing only as far as its start tag """
+
+    parser = ET.XMLPullParser(events=("start",))
+
+    with open(svg_file_name, "rb") as svg_file:
+        while chunk := svg_file.read(chunk_size):
+            parser.feed(chunk)
+
+            for _, element in parser.read_events():
+                return dict(element.attrib)
+
+    raise ValueError(f"No root element found in {svg_file_name}")
 
 
 def fasta_type(*, tree: Tree) -> str:
@@ -27,7 +53,7 @@ def fasta_type(*, tree: Tree) -> str:
 
     nt_codes: str = "ACGTUiRYKMSWBDHVN-" # IUPAC nucleotide codes
 
-    file_names = glob.glob(os.path.join(settings.PROJECT_PATH, tree.project.name, tree.name + "*.fasta"))
+    file_names = tree.project.manifest().files("fasta", starts_with=tree.name)
     if not len(file_names):
         return fasta_type_by_file_name(tree=tree)
     
@@ -63,12 +89,12 @@ def svg_file_name(*, tree: Tree, project: Project) -> str:
     """ Returns the name of the tree file
     It's found this way because there can be variations in the file name """
 
-    svg_list = glob.glob(os.path.join(settings.PROJECT_PATH, project.name, f"{tree.name}*.svg"))
+    svg_list = project.manifest().files("svg", starts_with=tree.name)
 
     new_svg_list: list = []
 
     for test_svg in svg_list:
-        if "_highlighter" not in test_svg and "_match" not in test_svg:
+        if "_highlighter" not in os.path.basename(test_svg) and "_match" not in os.path.basename(test_svg):
             new_svg_list.append(test_svg)
 
     if new_svg_list:
@@ -79,12 +105,32 @@ def svg_file_name(*, tree: Tree, project: Project) -> str:
     return svg
 
 
+def tree_svg_pairs(files: list[str]) -> list[tuple[str, str]]:
+    """ Returns (tree name, svg) for each highlighter PNG in the sorted names of a project's files
+    paired with the tree SVGs named after it, as tree.svg or tree.<anything>.svg (so tree_1 doesn't pair with tree_10.svg) """
+
+    svgs: list[str] = [file for file in files if file.endswith(".svg") and "_highlighter." not in file and "_match." not in file and "_match_no_multiple." not in file]
+    pairs: list[tuple[str, str]] = []
+
+    for file in files:
+        if file.endswith("_highlighter.png"):
+            tree_name: str = file[0:file.index("_highlighter.png")]
+
+            for svg in svgs[bisect.bisect_left(svgs, f"{tree_name}."):]:
+                if not svg.startswith(f"{tree_name}."):
+                    break
+
+                pairs.append((tree_name, svg))
+
+    return pairs
+
+
 def fasta_file_name(*, tree: Tree, project: Project, prefer_original: bool=False) -> str:
     """ Returns the name of the tree file
     It's found this way because there can be variations in the file name """
 
     fasta: str = None
-    fasta_list = glob.glob(os.path.join(settings.PROJECT_PATH, project.name, f"{tree.name}*.fasta"))
+    fasta_list = project.manifest().files("fasta", starts_with=tree.name)
 
     if fasta_list:
         while len(fasta_list) > 1:   
@@ -105,27 +151,13 @@ def fasta_file_name(*, tree: Tree, project: Project, prefer_original: bool=False
 def nexus_file_name(*, tree: Tree, project: Project) -> str:
     """ Returns the name of a nexus tree file """
 
-    tre_list = glob.glob(os.path.join(settings.PROJECT_PATH, project.name, f"{tree.name}*nexus.tre"))
-
-    if tre_list:
-        tre: str = tre_list[0]
-    else:
-        tre: str = None
-
-    return tre
+    return project.manifest().first("nexus", starts_with=tree.name)
 
 
 def newick_file_name(*, tree: Tree, project: Project) -> str:
     """ Returns the name of a nexus tree file """
 
-    tre_list = glob.glob(os.path.join(settings.PROJECT_PATH, project.name, f"{tree.name}*newick.tre"))
-
-    if tre_list:
-        tre: str = tre_list[0]
-    else:
-        tre: str = None
-
-    return tre
+    return project.manifest().first("newick", starts_with=tree.name)
 
 
 def get_lineage_dict(ordering: str=None) -> dict[str: list]:
@@ -283,4 +315,6 @@ def handle_import_file(project: Project, file_name: str=None, file: object=None,
         tree.type = fasta_type(tree=tree)
         tree.save()
 
+        tree.record_files()
+
     return path
\ No newline at end of file
@@ -1,5 +1,6 @@
-from functools import cache
-from typing import Union
+from typing import Iterable, Iterator, Union
+
+import numpy as np
 
 import Bio
 from Bio import Graphics
@@ -7,11 +8,19 @@ from Bio.Align import AlignInfo
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 
+from phylobook.projects.utils.cache import cached, highlighter_cache
+from phylobook.projects.utils.highlighter_index import HighlighterIndex
+from phylobook.projects.utils.highlighter_engine import AlignmentMatrix, GapIndex, Intervals, MAX_MATCH_REFERENCES, CHARACTER_MASK, G_TO_A_MUTATION, APOBEC, STOP_CODON, GLYCOSYLATION, full_mask, popcount, match_dict, match_runs, merge_runs, mismatch_names, mismatch_dict, mismatch_intervals
+
+# Export files are written through a buffer this size, one sequence at a time
+REPORT_BUFFER_BYTES: int = 1024 * 1024
+
 class Highlighter:
     """ Get mutation info from an alignment """
 
-    def __init__(self, alignment, *, seq_type: str=None, codon_offset: int=0):
-        """ Initialize the Mutations object """
+    def __init__(self, alignment, *, seq_type: str=None, codon_offset: int=0, index: HighlighterIndex=None):
+        """ Initialize the Mutations object
+        pass a HighlighterIndex to reuse (and store) the encoded alignment and vectorized results """
 
         self.alignment = alignment
         self.codon_offet: int=codon_offset % 3
@@ -20,6 +29,18 @@ class Highlighter:
             raise ValueError(f"type must be provided (either 'NT' or 'AA', got: '{seq_type}')")
         else:
             self.seq_type = seq_type
+
+        self.index: HighlighterIndex = index
+        self._matrix: AlignmentMatrix = None
+
+    @property
+    def matrix(self) -> AlignmentMatrix:
+        """ The alignment encoded as a uint8 matrix, built (or read from the index) on first use """
+
+        if self._matrix is None:
+            self._matrix = AlignmentMatrix(self.alignment) if self.index is None else self.index.matrix(self.alignment)
+
+        return self._matrix
         
     def get_seq_index_by_id(self, id: str) -> str:
         """ Get a sequence from the alignment by its id """
@@ -30,10 +51,42 @@ class Highlighter:
         
         raise IndexError(f"Could not find sequence with id {id}")
 
-    def list_mismatches(self, *, references: Union[int, str]=0, apobec: bool=False, g_to_a: bool=False, stop_codons: bool=False, glycosylation: bool=False, codon_offset: int=0) -> list[dict[str: list]]:
-        """ Get matches from a sequence and a reference sequence """
+    def list_mismatches(self, *, references: Union[int, str]=0, apobec: bool=False, g_to_a: bool=False, stop_codons: bool=False, glycosylation: bool=False, codon_offset: int=0, vectorized: bool=True) -> list[dict[str: list]]:
+        """ Get matches from a sequence and a reference sequence
+        vectorized compares the whole alignment at once as a matrix, otherwise each sequence is compared in turn """
 
         mismatches: list[dict[str: list]] = []
+        reference_object = self._mismatch_reference(references)
+
+        if vectorized:
+            return [mismatch_dict(intervals) for intervals in self.matrix.mismatch_intervals(reference=self.references, seq_type=self.seq_type, apobec=apobec, g_to_a=g_to_a, stop_codons=stop_codons, glycosylation=glycosylation, codon_offset=codon_offset)]
+        
+        for sequence in self.alignment:
+            mismatches.append(self.get_mismatches(sequence=sequence, references=reference_object, seq_type=self.seq_type, apobec=apobec, g_to_a=g_to_a, stop_codons=stop_codons, glycosylation=glycosylation, codon_offset=codon_offset))
+
+        return mismatches
+
+    def list_mismatch_intervals(self, *, references: Union[int, str]=0, apobec: bool=False, g_to_a: bool=False, stop_codons: bool=False, glycosylation: bool=False, codon_offset: int=0, vectorized: bool=True, processes: int=1) -> list[Intervals]:
+        """ Get mismatches as one run length Intervals per sequence
+        codes hold the mismatched character in the low byte and the highlighter_engine mismatch flags in the high byte
+        processes > 1 splits the vectorized comparison across a process pool """
+
+        if vectorized:
+            self._mismatch_reference(references)
+
+            options: dict = {"reference": self.references, "seq_type": self.seq_type, "apobec": apobec, "g_to_a": g_to_a, "stop_codons": stop_codons, "glycosylation": glycosylation, "codon_offset": codon_offset}
+
+            if self.index is not None:
+                return self.index.mismatch_intervals(self.matrix, processes=processes, **options)
+
+            return self.matrix.mismatch_intervals(processes=processes, **options)
+
+        mismatches: list[dict[str: list]] = self.list_mismatches(references=references, apobec=apobec, g_to_a=g_to_a, stop_codons=stop_codons, glycosylation=glycosylation, codon_offset=codon_offset, vectorized=False)
+
+        return [mismatch_intervals(sequence_mismatches, len(self.alignment[0])) for sequence_mismatches in mismatches]
+
+    def _mismatch_reference(self, references: Union[int, str]):
+        """ Resolve the reference to an index, record it in self.references, and return the reference sequence """
 
         if isinstance(references, str):
             references = self.get_seq_index_by_id(references)
@@ -46,11 +99,8 @@ class Highlighter:
 
         if not reference_object:
             raise ValueError(f"Reference sequence {references} is empty")
-        
-        for sequence in self.alignment:
-            mismatches.append(self.get_mismatches(sequence=sequence, references=reference_object, seq_type=self.seq_type, apobec=apobec, g_to_a=g_to_a, stop_codons=stop_codons, glycosylation=glycosylation, codon_offset=codon_offset))
 
-        return mismatches
+        return reference_object
 
     @staticmethod
     def get_mismatches(*, sequence: Union[str, Seq, SeqRecord], references: Union[str, Seq, SeqRecord], seq_type: str=None, apobec: bool=False, g_to_a: bool=False, stop_codons: bool=False, glycosylation: bool=False, codon_offset: int=0) -> dict[int: list]:
@@ -80,7 +130,7 @@ class Highlighter:
         return Highlighter.get_mismatches_from_str(sequence=sequence, references=references, seq_type=seq_type, apobec=apobec, g_to_a=g_to_a, stop_codons=stop_codons, glycosylation=glycosylation, codon_offset=codon_offset)
     
     @staticmethod
-    @cache
+    @cached(highlighter_cache)
     def get_mismatches_from_str(*, sequence: str, references: str, seq_type: str, apobec: bool, g_to_a: bool, stop_codons: bool=False, glycosylation: bool, codon_offset: int=0) -> dict[int: list]:
         """ Get mutations from a sequence and a reference sequence
         separated out so it can be cached (Seq and SeqRecord are not hashable) """
@@ -92,6 +142,7 @@ class Highlighter:
         references = references.replace("\n", "")
 
         mismatches: dict = {}
+        gap_index: GapIndex = GapIndex(sequence) if stop_codons or glycosylation else None
 
         if sequence == references and (seq_type == "NT" and not stop_codons) and (seq_type == "AA" and not glycosylation):
             return mismatches
@@ -116,31 +167,19 @@ class Highlighter:
 
             # Stop codons only apply to NT sequences
             if seq_type == "NT":
-                if stop_codons and sequence[base_index] in "TU" and base_index <= len(sequence)-3 and SeqUtils.codon_position(sequence, base_index, codon_offset=codon_offset) == 0:
-                    base_snippet: str = ""
-                    snippet_index: int = base_index+1
-
-                    while len(base_snippet) < 2 and snippet_index < len(sequence):
-                        base_snippet += sequence[snippet_index] if sequence[snippet_index] != "-" else ""
-                        snippet_index += 1
-
-                        if base_snippet in ("AA", "AG", "GA"):
-                            if base_index not in mismatches:
-                                mismatches[base_index] = []
+                if stop_codons and sequence[base_index] in "TU" and base_index <= len(sequence)-3 and gap_index.codon_position(base_index, codon_offset=codon_offset) == 0:
+                    if gap_index.next_ungapped(base_index) in ("AA", "AG", "GA"):
+                        if base_index not in mismatches:
+                            mismatches[base_index] = []
 
-                            mismatches[base_index].append("Stop codon")
+                        mismatches[base_index].append("Stop codon")
 
             # Glycosylation only applies to AA sequences
             elif seq_type == "AA":
                 if glycosylation and sequence[base_index] == "N" and base_index <= len(sequence)-3:
-                    base_snippet: str = ""
-                    snippet_index: int = base_index+1
-
-                    while len(base_snippet) < 2 and snippet_index < len(sequence):
-                        base_snippet += sequence[snippet_index] if sequence[snippet_index] != "-" else ""
-                        snippet_index += 1
+                    base_snippet: str = gap_index.next_ungapped(base_index)
                     
-                    if base_snippet[0] != "P" and base_snippet[1] in "ST":
+                    if len(base_snippet) == 2 and base_snippet[0] != "P" and base_snippet[1] in "ST":
                         if base_index not in mismatches:
                             mismatches[base_index] = []
 
@@ -148,38 +187,100 @@ class Highlighter:
         
         return mismatches
     
-    def export_mismatches(self, output_file, *, references: Union[int, str]=0, apobec: bool=False, g_to_a: bool=False, stop_codons: bool=False, glycosylation: bool=False, codon_offset: int=0) -> None:
-        """ Export mismatches to a .txt file"""
+    def export_mismatches(self, output_file, *, references: Union[int, str]=0, apobec: bool=False, g_to_a: bool=False, stop_codons: bool=False, glycosylation: bool=False, codon_offset: int=0, vectorized: bool=True) -> None:
+        """ Export mismatches to a .txt file
+        output_file can be a file name or any file-like object, and is written one sequence at a time """
+
+        write_report(output_file, self.mismatch_report(references=references, apobec=apobec, g_to_a=g_to_a, stop_codons=stop_codons, glycosylation=glycosylation, codon_offset=codon_offset, vectorized=vectorized))
+
+    def mismatch_report(self, *, references: Union[int, str]=0, apobec: bool=False, g_to_a: bool=False, stop_codons: bool=False, glycosylation: bool=False, codon_offset: int=0, vectorized: bool=True) -> Iterator[str]:
+        """ Get the text of the mismatch export, one sequence block at a time
+        mismatches are found before this returns, so the iterator can be handed straight to a StreamingHttpResponse """
+
+        mismatches = self.list_mismatch_intervals(references=references, apobec=apobec, g_to_a=g_to_a, stop_codons=stop_codons, glycosylation=glycosylation, codon_offset=codon_offset, vectorized=vectorized)
 
-        output: str = ""
-        mismatches = self.list_mismatches(references=references, apobec=apobec, g_to_a=g_to_a, stop_codons=stop_codons, glycosylation=glycosylation, codon_offset=codon_offset)
+        return self._mismatch_blocks(mismatches)
+
+    def _mismatch_blocks(self, mismatches: list[Intervals]) -> Iterator[str]:
+        """ Yields the export text for each sequence's mismatches """
 
         for sequence_index, sequence in enumerate(self.alignment):
             working: dict = {}
 
-            for base, codes in mismatches[sequence_index].items():
-                for code in codes:
-                    if code not in working:
-                        working[code] = []
+            for start, length, code in mismatches[sequence_index]:
+                for name in mismatch_names(code):
+                    if name not in working:
+                        working[name] = []
                     
-                    working[code].append(base+1)
+                    working[name] += range(start+1, start+length+1)
             
-            output += f"{sequence.id}\n"
+            block: list[str] = [f"{sequence.id}\n"]
 
             for code in sorted(working, key=lambda x: (len(x), x)):
-                output += f"{code} ["
-                output += " ".join([str(thing) for thing in working[code]])
-                output += "]\n"
+                block.append(f"{code} [{' '.join([str(thing) for thing in working[code]])}]\n")
 
-            output += "\n"
+            block.append("\n")
 
-        with open(output_file, mode="wt") as file:
-            file.write(output)
+            yield "".join(block)
 
-    def list_matches(self, *, references=0) -> list[dict[str: list]]:
-        """ Get matches from a sequence and a reference sequence """
+    def list_matches(self, *, references=0, vectorized: bool=True) -> list[dict[str: list]]:
+        """ Get matches from a sequence and a reference sequence
+        vectorized compares the whole alignment at once as a matrix of bitmasks, otherwise each sequence is compared in turn """
 
         matches: list[dict[str: list]] = []
+        reference_objects: list = self._match_references(references)
+
+        if vectorized and len(reference_objects) <= MAX_MATCH_REFERENCES:
+            return [match_dict(intervals, len(reference_objects)) for intervals in self._match_intervals(reference_objects)]
+
+        for sequence_index, sequence in enumerate(self.alignment):
+            if sequence_index in self.references:
+                matches.append({})
+            else:
+                matches.append(self.get_matches(sequence=sequence, references=reference_objects, seq_type=self.seq_type))
+
+        return matches
+
+    def list_match_masks(self, *, references=0) -> np.ndarray:
+        """ Get a (sequences x columns) matrix of bitmasks where bit r is set when a sequence matches reference r
+        reference sequences match themselves everywhere """
+
+        return self._match_masks(self._match_references(references))
+
+    def list_match_intervals(self, *, references=0, processes: int=1) -> list[Intervals]:
+        """ Get matches as one run length Intervals per sequence, with the match bitmask as the code
+        columns matching every reference are left out, so reference sequences have no runs
+        processes > 1 splits the comparison across a process pool """
+
+        return self._match_intervals(self._match_references(references), processes=processes)
+
+    def _match_intervals(self, reference_objects: list, *, processes: int=1) -> list[Intervals]:
+        """ Get the match intervals for resolved references """
+
+        if self.index is not None:
+            intervals: list[Intervals] = self.index.match_intervals(self.matrix, reference_objects, processes=processes)
+        else:
+            intervals: list[Intervals] = self.matrix.match_intervals(reference_objects, processes=processes)
+
+        for sequence_index in range(len(self.alignment)):
+            if sequence_index in self.references:
+                intervals[sequence_index] = Intervals([], [], intervals[sequence_index].codes[:0])
+
+        return intervals
+
+    def _match_masks(self, reference_objects: list) -> np.ndarray:
+        """ Get the match bitmasks for resolved references """
+
+        masks: np.ndarray = self.matrix.match_masks(reference_objects)
+
+        for sequence_index in range(len(self.alignment)):
+            if sequence_index in self.references:
+                masks[sequence_index] = full_mask(len(reference_objects))
+
+        return masks
+
+    def _match_references(self, references) -> list:
+        """ Resolve references to a list of sequences, and record them in self.references """
 
         if not isinstance(references, list):
             references = [references]
@@ -212,13 +313,7 @@ class Highlighter:
             else:
                 reference_objects.append(self.alignment[self.references[-1]])
 
-        for sequence_index, sequence in enumerate(self.alignment):
-            if sequence_index in self.references:
-                matches.append({})
-            else:
-                matches.append(self.get_matches(sequence=sequence, references=reference_objects, seq_type=self.seq_type))
-
-        return matches
+        return reference_objects
     
     @staticmethod
     def get_matches(*, sequence: Union[str, Seq, SeqRecord], references: Union[list[str, Seq, SeqRecord], str, Seq, SeqRecord], seq_type: str=None) -> dict[int: list]:
@@ -265,7 +360,7 @@ class Highlighter:
         return Highlighter.get_matches_from_str(sequence=sequence, references=tuple(new_references), seq_type=seq_type)
 
     @staticmethod
-    @cache
+    @cached(highlighter_cache)
     def get_matches_from_str(*, sequence: str, references: tuple[str], seq_type: str) -> dict[int: list]:
         """ Get matches from a sequence and a reference sequence
         separated out so it can be cached (Seq and SeqRecord are not hashable) """
@@ -293,58 +388,79 @@ class Highlighter:
         return matches
     
     def export_matches(self, output_file, *, references: tuple[Union[int, str]]=0) -> None:
-        """ Export matches to a .txt file """
+        """ Export matches to a .txt file
+        output_file can be a file name or any file-like object, and is written one sequence at a time """
+
+        write_report(output_file, self.match_report(references=references))
+
+    def match_report(self, *, references: tuple[Union[int, str]]=0) -> Iterator[str]:
+        """ Get the text of the match export, one sequence block at a time
+        matches are found before this returns, so the iterator can be handed straight to a StreamingHttpResponse """
+
+        matches = self.list_match_intervals(references=references)
+
+        return self._match_blocks(matches)
+
+    def _match_blocks(self, matches: list[Intervals]) -> Iterator[str]:
+        """ Yields the export text for each sequence's matches """
 
-        output: str = ""
-        matches = self.list_matches(references=references)
-        
         for sequence_index, sequence in enumerate(self.alignment):
             matched: dict = {}
+            counts: list[int] = popcount(matches[sequence_index].codes, len(self.references)).tolist()
 
-            for base, codes in matches[sequence_index].items():
-                if "Unique" in codes:
-                    if "Unique" not in matched:
-                        matched["Unique"] = []
-                    
-                    matched["Unique"].append(base+1)
+            for (start, length, mask), count in zip(matches[sequence_index], counts):
+                if not count:
+                    code = "Unique"
                 
-                elif len(codes) > 1:
-                    if "Multiple" not in matched:
-                        matched["Multiple"] = []
-                    
-                    matched["Multiple"].append(base+1)
+                elif count > 1:
+                    code = "Multiple"
 
                 else:
-                    if codes[0] not in matched:
-                        matched[codes[0]] = []
+                    code = mask.bit_length() - 1
+
+                if code not in matched:
+                    matched[code] = []
                     
-                    matched[codes[0]].append(base+1)
+                matched[code] += range(start+1, start+length+1)
 
             if sequence_index in self.references:
-                output += f"{sequence.id} (R{self.references.index(sequence_index)+1})\n"
+                block: list[str] = [f"{sequence.id} (R{self.references.index(sequence_index)+1})\n"]
             else:
-                output += f"{sequence.id}\n"
+                block: list[str] = [f"{sequence.id}\n"]
 
             for code in list(range(10)) + ["Unique", "Multiple"]:
                 if code not in matched:
                     continue
 
                 if code == "Unique":
-                    output += f"Unique in query "
+                    label: str = "Unique in query"
 
                 elif code == "Multiple":
-                    output += f"Multiple matches "
+                    label: str = "Multiple matches"
                     
                 else:
-                    output += f"R{code+1} "
+                    label: str = f"R{code+1}"
 
-                output += f"[{' '.join([str(thing) for thing in matched[code]])}]\n"
+                block.append(f"{label} [{' '.join([str(thing) for thing in matched[code]])}]\n")
 
-            output += "\n"
+            block.append("\n")
 
-        with open(output_file, mode="wt") as file:
-            file.write(output)
+            yield "".join(block)
     
+
+def write_report(output_file, blocks: Iterable[str]) -> None:
+    """ Write report text to a file name or file-like object as each block is produced """
+
+    if hasattr(output_file, "write"):
+        for block in blocks:
+            output_file.write(block)
+
+        return
+
+    with open(output_file, mode="wt", buffering=REPORT_BUFFER_BYTES) as file:
+        for block in blocks:
+            file.write(block)
+
 AlignInfo.Highlighter = Highlighter
 
 
@@ -352,12 +468,11 @@ from reportlab.lib import colors
 from reportlab.lib.colors import Color
 from reportlab.lib.units import inch
 
-from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.graphics.shapes import Drawing
 
-from reportlab.graphics.shapes import Drawing, String, Line, Rect, Circle, PolyLine, Polygon
+from phylobook.projects.utils.highlighter_canvas import Canvas, RasterCanvas, ReportlabCanvas, SvgPathCanvas, SvgStreamCanvas, string_width
 
 from Bio import SeqUtils
-from Bio.Graphics import _write
 from Bio.Align import AlignInfo
 
 
@@ -409,6 +524,10 @@ class HighlighterPlot:
         self._seq_height: float = self.seq_name_font_size
         self.seq_gap: float = self._seq_height / 5 if seq_gap is None else seq_gap
 
+        # The mismatch options and sort orders of the last plot drawn, so drawing it again (as tiles do) skips finding and sorting the marks
+        self._prepared_mismatches: tuple = None
+        self._sorted_keys: dict[str: list[int]] = {}
+
         self.match_plot_colors: dict[str: dict] = {
             "ML": {
                 "references": ["#FF0000", "#537EFF", "#00CB85", "#000000", "#FFA500"],
@@ -467,8 +586,10 @@ class HighlighterPlot:
             }
         }
 
-    def _setup_drawing(self, *, plot_type: str, output_format: str="svg", title: str=None, sort: str="similar", mark_width: float=1, scale: float=1, sequence_labels: bool=True):
-        """ Setus up the drawing """
+    def _setup_drawing(self, output_file, *, plot_type: str, output_format: str="svg", title: str=None, sort: str="similar", mark_width: float=1, scale: float=1, sequence_labels: bool=True, backend: str=None):
+        """ Setus up the drawing
+        backend is 'paths' (SVG with one path per mark color), 'stream' (SVG with one element per mark), 'raster' (PNG without text) or 'reportlab' (any format),
+        and defaults to 'paths' for SVG and 'raster' for PNG """
         
         self.plot_type: str = plot_type
         self.output_format: str = output_format
@@ -481,6 +602,7 @@ class HighlighterPlot:
 
         self._plot_floor: float = self.bottom_margin + self._ruler_height
 
+        self._sequence_labels: bool = sequence_labels
         self._seq_name_width: float = self._max_seq_name_width if sequence_labels else 0
         self._width: float = self.left_margin + self.plot_width + self.plot_label_gap + self._seq_name_width + self.right_margin
         
@@ -490,9 +612,10 @@ class HighlighterPlot:
 
         self.scale = scale
 
-        self.drawing = Drawing(self._width, self._height)
+        if sort in self._sorted_keys:
+            self.sorted_keys = self._sorted_keys[sort]
 
-        if sort == "similar":
+        elif sort == "similar":
             self.sorted_keys = self._sort_similar()
         
         elif sort == "tree":
@@ -504,6 +627,15 @@ class HighlighterPlot:
         else: 
             self.sorted_keys = range(len(self.matches_list))
 
+        self._sorted_keys[sort] = self.sorted_keys
+
+        # The canvas opens its output, so it is made last and drawn on inside one with block by the caller
+        self.canvas = self._make_canvas(output_file, output_format=output_format, backend=backend)
+        self.drawing: Drawing = getattr(self.canvas, "drawing", None)
+
+    def _draw_frame(self) -> None:
+        """ Draw the title, ruler, sequence labels and base lines under the marks """
+
         self._draw_title()
         if self.ruler:
             self._draw_ruler()
@@ -511,7 +643,7 @@ class HighlighterPlot:
         for plot_index, seq_index in enumerate(self.sorted_keys):
 
             # Add label for sequence
-            if sequence_labels:
+            if self._sequence_labels:
                 id = self.alignment[seq_index].id
                 if self.mark_reference:
                     if isinstance(self._mutations.references, int):
@@ -519,16 +651,15 @@ class HighlighterPlot:
                             id += " (r)"
                     elif seq_index in self._mutations.references:
                         id += f" (r{self._mutations.references.index(seq_index)+1})"
-                    
+                
                 x: float = self.left_margin + self.plot_width + self.plot_label_gap #(inch/4)
                 y: float = ((self._seq_count-(plot_index + .75)) * (self._seq_height + self.seq_gap))  + self.seq_gap + self._plot_floor
-                sequence_str: String = String(x, y, id, fontName="Helvetica", fontSize=self.seq_name_font_size)
-                self.drawing.add(sequence_str, id)
+                self.canvas.string(x, y, id, font="Helvetica", font_size=self.seq_name_font_size)
 
             # Add base line for sequence
             color: Color = None
 
-            if plot_type == "match":
+            if self.plot_type == "match":
                 if seq_index in self._mutations.references:
                     color = self._hex_to_color(self._current_scheme[self._mutations.references.index(seq_index)])
 
@@ -544,7 +675,7 @@ class HighlighterPlot:
                         sequence = self.alignment[seq_index]
 
                     sequence = sequence.replace("\n", "")
-                    
+                
                     if sequence.replace in self._mutations.references:
                         color = self._hex_to_color(self._current_scheme[self._mutations.references.index(sequence)])
 
@@ -554,18 +685,42 @@ class HighlighterPlot:
             x1: float = self.left_margin
             x2: float = self.left_margin + self.plot_width
             y: float = (self._seq_count-(plot_index + .5)) * (self._seq_height + self.seq_gap) + self.seq_gap + self._plot_floor
-            sequence_baseline: Line = Line(x1, y, x2, y, strokeColor=color)
-            self.drawing.add(sequence_baseline)
-    
-    def draw_mismatches(self, output_file, *, output_format: str="svg", title: str=None, reference: Union[str, int]=0, apobec: bool=False, g_to_a: bool=False, stop_codons: bool=False, glycosylation: bool=False, sort: str="similar", mark_width: float=1, scheme: str="LANL", scale: float=1, sequence_labels: bool=True):
-        """ Draw mismatches compared to a reference sequence """
+            self.canvas.line(x1, y, x2, y, stroke=color)
+
+    def _make_canvas(self, output_file, *, output_format: str, backend: str=None) -> Canvas:
+        """ Returns the canvas for the chosen backend, sized to the plot """
+
+        if backend is None:
+            backend = {"svg": "paths", "png": "raster"}.get(output_format.lower(), "reportlab")
+
+        if backend == "paths":
+            return SvgPathCanvas(output_file, width=self._width, height=self._height, output_format=output_format)
+        elif backend == "stream":
+            return SvgStreamCanvas(output_file, width=self._width, height=self._height, output_format=output_format)
+        elif backend == "raster":
+            return RasterCanvas(output_file, width=self._width, height=self._height, output_format=output_format, dpi=288*self.scale)
+        elif backend == "reportlab":
+            return ReportlabCanvas(output_file, width=self._width, height=self._height, output_format=output_format, dpi=288*self.scale)
+        else:
+            raise ValueError(f"backend must be 'paths', 'stream', 'raster' or 'reportlab', got '{backend}'")
 
-        self._mutations = AlignInfo.Highlighter(self.alignment, seq_type=self.seq_type)
-        
-        self.matches_list = self._mutations.list_mismatches(references=reference, apobec=apobec, g_to_a=g_to_a, stop_codons=stop_codons, glycosylation=glycosylation, codon_offset=self.codon_offset)
-        self.references = self._mutations.references
+    def draw_mismatches(self, output_file, *, output_format: str="svg", title: str=None, reference: Union[str, int]=0, apobec: bool=False, g_to_a: bool=False, stop_codons: bool=False, glycosylation: bool=False, sort: str="similar", mark_width: float=1, scheme: str="LANL", scale: float=1, sequence_labels: bool=True, vectorized: bool=True, processes: int=1, index: HighlighterIndex=None, backend: str=None):
+        """ Draw mismatches compared to a reference sequence
+        processes > 1 finds the mismatches with a process pool over shared memory, and index reuses stored mismatches
+        backend picks how the plot is written (see _setup_drawing)
+        drawing the same plot again with the same mismatch options reuses the mismatches and sort order """
+
+        mismatch_options: tuple = (reference, apobec, g_to_a, stop_codons, glycosylation, vectorized)
+
+        if self._prepared_mismatches != mismatch_options:
+            self._mutations = AlignInfo.Highlighter(self.alignment, seq_type=self.seq_type, index=index)
+            
+            self.matches_list = self._mutations.list_mismatch_intervals(references=reference, apobec=apobec, g_to_a=g_to_a, stop_codons=stop_codons, glycosylation=glycosylation, codon_offset=self.codon_offset, vectorized=vectorized, processes=processes)
+            self.references = self._mutations.references
+            self._mark_counts: list[int] = [mismatches.marked for mismatches in self.matches_list]
 
-        self._setup_drawing(output_format=output_format, title=title, sort=sort, mark_width=mark_width, scale=scale, plot_type="mismatch", sequence_labels=sequence_labels)
+            self._prepared_mismatches = mismatch_options
+            self._sorted_keys = {}
 
         self.scheme: str = scheme
         self._current_scheme: dict = self.mismatch_plot_colors[self.seq_type][self.scheme] if self.scheme in self.mismatch_plot_colors[self.seq_type] else self.mismatch_plot_colors[self.seq_type]["LANL"]
@@ -575,70 +730,81 @@ class HighlighterPlot:
         self._glycosylation: bool = glycosylation
         self._stop_codons: bool = stop_codons
 
-        for plot_index, seq_index in enumerate(self.sorted_keys):
-            matches = self.matches_list[seq_index]
-            self._draw_marks_mismatch(plot_index, matches, is_reference=(seq_index == self.references))
+        reference_mismatches: Intervals = self.matches_list[self.references]
+        self._reference_glycosylation: set[int] = set(reference_mismatches.positions((reference_mismatches.codes >> 8 & GLYCOSYLATION) > 0))
+
+        self._setup_drawing(output_file, output_format=output_format, title=title, sort=sort, mark_width=mark_width, scale=scale, plot_type="mismatch", sequence_labels=sequence_labels, backend=backend)
 
-        return _write(self.drawing, output_file, self.output_format, dpi=288*self.scale)
+        with self.canvas:
+            self._draw_frame()
 
-    def _draw_marks_mismatch(self, plot_index: int, mismatches: dict[int: list], is_reference: bool=False) -> None:
-        """ Draw marks for a mismatch sequence """
+            for plot_index, seq_index in enumerate(self.sorted_keys):
+                matches = self.matches_list[seq_index]
+                self._draw_marks_mismatch(plot_index, matches, is_reference=(seq_index == self.references))
 
-        already_processed: list = []
-        for base, mismatch_item in mismatches.items():
-            if base in already_processed:
-                continue
+            return self.canvas.save()
 
-            for code in mismatch_item:
-                if code in self._current_scheme:
-                    width: int = 1
-                    color: Color = self._hex_to_color(self._current_scheme[code])
+    def _draw_marks_mismatch(self, plot_index: int, mismatches: Intervals, is_reference: bool=False) -> None:
+        """ Draw marks for a mismatch sequence from its mismatch intervals """
 
-                    check_base: int = base+1
-                    while check_base in mismatches and code in mismatches[check_base]:
-                        width += 1
-                        already_processed.append(check_base)
-                        check_base += 1
+        characters: np.ndarray = mismatches.codes & CHARACTER_MASK
+        starts, widths, characters, _ = merge_runs(mismatches.starts[characters > 0], mismatches.lengths[characters > 0], characters[characters > 0])
 
-                    self.drawing.add(self._base_mark(plot_index, base, color, width=width))
+        for base, width, character in zip(starts.tolist(), widths.tolist(), characters.tolist()):
+            name: str = mismatch_names(character)[0]
+
+            if name in self._current_scheme:
+                color: Color = self._hex_to_color(self._current_scheme[name])
+                self._draw_base_mark(plot_index, base, color, width=width)
         
         # Symboloic markers need to be drawn second so they are on top of the rectangles
-        for base, mismatch_item in mismatches.items():
-            x: float = self.left_margin + self._base_left(base) + ((self._base_left(base+1)-self._base_left(base))/2)
-            y: float = (self._seq_count-(plot_index + .5)) * (self._seq_height + self.seq_gap) + self.seq_gap + self._plot_floor
-                
-            if "APOBEC" in mismatch_item:
-                self.draw_circle(x, y)
-                
-            elif "G->A mutation" in mismatch_item:
-                self.draw_diamond(x, y)
+        y: float = (self._seq_count-(plot_index + .5)) * (self._seq_height + self.seq_gap) + self.seq_gap + self._plot_floor
+        glycosylation: set[int] = set(mismatches.positions((mismatches.codes >> 8 & GLYCOSYLATION) > 0))
+
+        for start, length, code in mismatches:
+            flags: int = code >> 8
 
-            elif "Glycosylation" in mismatch_item:
-                if is_reference:
+            for base in range(start, start+length):
+                x: float = self.left_margin + self._base_left(base) + ((self._base_left(base+1)-self._base_left(base))/2)
+
+                if flags & APOBEC:
                     self.draw_circle(x, y)
-                else:
-                    if "Glycosylation" not in self.matches_list[self.references].get(base, {}):
-                        self.draw_diamond(x, y, filled=True)
+                    
+                elif flags & G_TO_A_MUTATION:
+                    self.draw_diamond(x, y)
 
-            elif "Stop codon" in mismatch_item:
-                self.draw_diamond(x, y, color="#0000FF")
+                elif flags & GLYCOSYLATION:
+                    if is_reference:
+                        self.draw_circle(x, y)
+                    else:
+                        if base not in self._reference_glycosylation:
+                            self.draw_diamond(x, y, filled=True)
+
+                elif flags & STOP_CODON:
+                    self.draw_diamond(x, y, color="#0000FF")
 
         if self.seq_type == "AA" and self._glycosylation:
-            for base, mismatch_item in self.matches_list[self.references].items():
-                if "Glycosylation" in mismatch_item and "Glycosylation" not in mismatches.get(base, {}):
-                    x: float = self.left_margin + self._base_left(base) + ((self._base_left(base+1)-self._base_left(base))/2)
-                    y: float = (self._seq_count-(plot_index + .5)) * (self._seq_height + self.seq_gap) + self.seq_gap + self._plot_floor
+            for base in sorted(self._reference_glycosylation - glycosylation):
+                x: float = self.left_margin + self._base_left(base) + ((self._base_left(base+1)-self._base_left(base))/2)
 
-                    self.draw_diamond(x, y, color="#0000FF")
+                self.draw_diamond(x, y, color="#0000FF")
 
-    def draw_matches(self, output_file, *, output_format: str="svg", title: str=None, references: list[Union[str, int]]=0, sort: str="similar", mark_width: float=1, scheme: Union[str, dict]="LANL", scale: float=1, sequence_labels: bool=True):
-        """ Draw mismatches compared to a reference sequence """
+    def draw_matches(self, output_file, *, output_format: str="svg", title: str=None, references: list[Union[str, int]]=0, sort: str="similar", mark_width: float=1, scheme: Union[str, dict]="LANL", scale: float=1, sequence_labels: bool=True, processes: int=1, index: HighlighterIndex=None, backend: str=None):
+        """ Draw mismatches compared to a reference sequence
+        processes > 1 finds the matches with a process pool over shared memory, and index reuses stored matches
+        backend picks how the plot is written (see _setup_drawing) """
 
-        self._mutations = AlignInfo.Highlighter(self.alignment, seq_type=self.seq_type)
+        self._mutations = AlignInfo.Highlighter(self.alignment, seq_type=self.seq_type, index=index)
         
-        self.matches_list = self._mutations.list_matches(references=references)
+        self.matches_list = self._mutations.list_match_intervals(references=references, processes=processes)
         self.references = self._mutations.references
 
+        self._prepared_mismatches = None
+        self._sorted_keys = {}
+
+        self._reference_count: int = len(self.references)
+        self._mark_counts: list[int] = [matches.marked for matches in self.matches_list]
+
         if isinstance(scheme, str):
             self.scheme: str = scheme
     
@@ -669,68 +835,35 @@ class HighlighterPlot:
         else:
             raise TypeError("scheme must be a string or a dictionary")
 
-        self._setup_drawing(output_format=output_format, title=title, sort=sort, mark_width=mark_width, scale=scale, plot_type="match", sequence_labels=sequence_labels)
-
-        for plot_index, seq_index in enumerate(self.sorted_keys):
-            matches = self.matches_list[seq_index]
-            self._draw_marks_match(plot_index, matches, is_reference=(seq_index in self.references))
-
-        return _write(self.drawing, output_file, self.output_format, dpi=288*self.scale)
-
-    def _draw_marks_match(self, plot_index: int, matches: dict[int, list], is_reference: bool) -> None:
-        """ Draw the marks for a match sequence """
+        self._setup_drawing(output_file, output_format=output_format, title=title, sort=sort, mark_width=mark_width, scale=scale, plot_type="match", sequence_labels=sequence_labels, backend=backend)
 
-        already_processed: dict[list] = {"Unique": [], "Multiple": [], "Single": []}
-        for base, match_item in matches.items():
-            check_base: int = base+1
-            width: int = 1
+        with self.canvas:
+            self._draw_frame()
 
-            if "Unique" in match_item:
-                if base in already_processed["Unique"]:
-                    continue
-
-                if self._current_unique_color is not None:
-                    color: Color = self._hex_to_color(self._current_unique_color)
-
-                    while check_base in matches and "Unique" in matches[check_base]:
-                        width += 1
-                        already_processed["Unique"].append(check_base)
-                        check_base += 1
+            for plot_index, seq_index in enumerate(self.sorted_keys):
+                matches = self.matches_list[seq_index]
+                self._draw_marks_match(plot_index, matches, is_reference=(seq_index in self.references))
 
-                    self.drawing.add(self._base_mark(plot_index, base, color, width=width))
+            return self.canvas.save()
 
-            elif len(match_item) > 1:
-
-                if base in already_processed["Multiple"]:
-                    continue
+    def _draw_marks_match(self, plot_index: int, matches: Intervals, is_reference: bool) -> None:
+        """ Draw the marks for a match sequence from its match intervals """
 
-                if self._current_multiple_color is not None:
-                    color: Color = self._hex_to_color(self._current_multiple_color)
-
-                    while check_base in matches and len(matches[check_base]) > 1:
-                        width += 1
-                        already_processed["Multiple"].append(check_base)
-                        check_base += 1
-
-                    self.drawing.add(self._base_mark(plot_index, base, color, width=width))
+        single: list[bool] = [reference_index >= len(self._current_scheme) or self._current_scheme[reference_index] is not None for reference_index in range(self._reference_count)]
+        marks = match_runs(matches, self._reference_count, unique=self._current_unique_color is not None, multiple=self._current_multiple_color is not None, single=single)
 
+        for base, width, code in marks:
+            if code == "Unique":
+                color: Color = self._hex_to_color(self._current_unique_color)
+            elif code == "Multiple":
+                color: Color = self._hex_to_color(self._current_multiple_color)
             else:
-                if base in already_processed["Single"]:
-                    continue
-
-                for code in match_item:
-                    if self._current_scheme[code] is not None:
-                        color: Color = self._hex_to_color(self._current_scheme[code])
+                color: Color = self._hex_to_color(self._current_scheme[code])
 
-                        while check_base in matches and code in matches[check_base]:
-                            width += 1
-                            already_processed["Single"].append(check_base)
-                            check_base += 1
+            self._draw_base_mark(plot_index, base, color, width=width)
 
-                        self.drawing.add(self._base_mark(plot_index, base, color, width=width))
-
-    def _base_mark(self, plot_index, base, color, width: int=1) -> Rect:
-        """ Returns a mark for a particular base """
+    def _draw_base_mark(self, plot_index, base, color, width: int=1) -> None:
+        """ Draw a mark for a particular base """
 
         x1: float = self.left_margin + self._base_left(base)
         x2: float = self.left_margin + self._base_left(base + (width - 1) + self.mark_width )
@@ -738,7 +871,7 @@ class HighlighterPlot:
         y1: float = ((self._seq_count-plot_index) * (self._seq_height + self.seq_gap)) + (self.seq_gap/2) + self._plot_floor
         y2: float = ((self._seq_count-(plot_index+1)) * (self._seq_height + self.seq_gap)) + self.seq_gap + self._plot_floor
 
-        return Rect(x1, y1, x2-x1, y2-y1, fillColor=color, strokeColor=color, strokeWidth=0.1)
+        self.canvas.mark(x1, y1, x2-x1, y2-y1, fill=color, stroke=color, stroke_width=0.1)
 
     def _draw_title(self) -> None:
         """ Draw the title at the top of the plot """
@@ -747,7 +880,7 @@ class HighlighterPlot:
             x: float = self.left_margin + (self.plot_width/2)
             y: float = self._height - self.top_margin - (self._title_font_height/2)
 
-            self.drawing.add(String(x, y, self.title, textAnchor="middle", fontName=self.title_font, fontSize=self.title_font_size))
+            self.canvas.string(x, y, self.title, anchor="middle", font=self.title_font, font_size=self.title_font_size)
 
     def _draw_ruler(self) -> None:
         """ Draw the ruler at the bottom of the plot """
@@ -772,8 +905,7 @@ class HighlighterPlot:
         x2: float = self.left_margin + self.plot_width
         y: float = self.bottom_margin + (self._ruler_font_height * 3)
 
-        ruler_line: Line = Line(x1, y, x2, y, strokeColor=colors.black, strokeWidth=2)
-        self.drawing.add(ruler_line)
+        self.canvas.line(x1, y, x2, y, stroke=colors.black, stroke_width=2)
 
     def _ruler_marks(self, marked_bases: list) -> None:
         """ Draw marks on the ruler """
@@ -799,7 +931,7 @@ class HighlighterPlot:
         x: float = self.left_margin + self._base_center(base)
         y: float = self.bottom_margin+self._ruler_font_height
 
-        self.drawing.add(String(x, y, str(base + 1), textAnchor="middle", fontName=self.ruler_font, fontSize=self.ruler_font_size))
+        self.canvas.string(x, y, str(base + 1), anchor="middle", font=self.ruler_font, font_size=self.ruler_font_size)
 
         return (x, y)
 
@@ -811,7 +943,7 @@ class HighlighterPlot:
         top: float = self.bottom_margin + (self._ruler_font_height * 3)
         bottom: float = self.bottom_margin + (self._ruler_font_height * 2)
 
-        self.drawing.add(Line(x, top, x, bottom, strokeColor=colors.black, strokeWidth=1))
+        self.canvas.line(x, top, x, bottom, stroke=colors.black, stroke_width=1)
 
         return (x, top, bottom)
 
@@ -823,7 +955,7 @@ class HighlighterPlot:
         top: float = self.bottom_margin + (self._ruler_font_height * 3)
         bottom: float = self.bottom_margin + (self._ruler_font_height * 2.5)
 
-        self.drawing.add(Line(x, top, x, bottom, strokeColor=colors.black, strokeWidth=1))
+        self.canvas.line(x, top, x, bottom, stroke=colors.black, stroke_width=1)
 
         return (x, top, bottom)
 
@@ -845,20 +977,14 @@ class HighlighterPlot:
     
     @property
     def _max_seq_name_width(self) -> float:
-        """ Get the width of the longest sequence name """
+        """ Get the width of the longest sequence name, remembered for each set of sequence names """
 
-        max_width: float = 0
         if self.plot_type == "match":
             reference_tag: str = " (r10)"
         elif self.plot_type == "mismatch":
             reference_tag: str = " (r)"
 
-        for sequence in self.alignment:
-            width: float = stringWidth(f"{sequence.id} {reference_tag}", self.seq_name_font, self.seq_name_font_size)
-            if width > max_width:
-                max_width = width
-        
-        return max_width
+        return widest_label("\n".join(sequence.id for sequence in self.alignment), reference_tag=reference_tag, font=self.seq_name_font, font_size=self.seq_name_font_size)
     
     def _hex_to_color(self, hex: str) -> Color:
         """ Convert a hex color to rgb """
@@ -871,22 +997,19 @@ class HighlighterPlot:
         """ Sort sequences by similarity to the reference sequence 
         returns list of indexes"""
 
-        return sorted(range(len(self.matches_list)), key=lambda x: len(self.matches_list[x]))
+        return sorted(range(len(self.matches_list)), key=lambda x: self._mark_counts[x])
     
     def draw_diamond(self, x: float, y: float, color: str="#FF00FF", filled: bool=False) -> None:
         """ Draw a rectangle on the plot """
         
         fill_color = self._hex_to_color(color) if filled else None
 
-        diamond = Polygon([x, y-((self._seq_height/3)/2), x-((self._seq_height/3)/2), y, x, y+((self._seq_height/3)/2), x+((self._seq_height/3)/2), y], strokeColor=self._hex_to_color(color), strokeWidth=2, fillColor=fill_color)
-        
-        self.drawing.add(diamond)
+        self.canvas.glyph("diamond", x, y, radius=(self._seq_height/3)/2, stroke=self._hex_to_color(color), stroke_width=2, fill=fill_color)
 
     def draw_circle(self, x: float, y: float, color: str="#FF00FF", filled: bool=True) -> None:
         """ Draw a circle on the plot"""
         
-        circle = Circle(x, y, (self._seq_height/3)/2, fillColor=self._hex_to_color(color), strokeColor=self._hex_to_color("#FF00FF"), strokeWidth=0.1)
-        self.drawing.add(circle)
+        self.canvas.glyph("circle", x, y, radius=(self._seq_height/3)/2, fill=self._hex_to_color(color), stroke=self._hex_to_color("#FF00FF"), stroke_width=0.1)
     
     def _get_index_by_id(self, id: str) -> int:
         """ Get the index of a sequence by its id """
@@ -948,12 +1071,19 @@ class HighlighterPlot:
 Graphics.HighlighterPlot = HighlighterPlot
 
 
+@cached(highlighter_cache)
+def widest_label(ids: str, *, reference_tag: str, font: str, font_size: float) -> float:
+    """ Returns the width of the widest sequence label, given the newline separated sequence ids """
+
+    return max(string_width(f"{id} {reference_tag}", font, font_size) for id in ids.split("\n"))
+
+
 from Bio import SeqUtils
 
-@cache
-def codon_position(sequence: Union[str, Seq, SeqRecord], base: int, *, codon_offset: int=0) -> int:
+def codon_position(sequence: Union[str, Seq, SeqRecord], base: int, *, codon_offset: int=0, gap_index: GapIndex=None) -> int:
     """ Get the codon position of a base in a sequence
-    returns 0 for the first base of a codon, 1 for the second, or 2 for the third) """
+    returns 0 for the first base of a codon, 1 for the second, or 2 for the third)
+    pass a GapIndex for the sequence to avoid counting gaps on every call """
 
     if isinstance(sequence, Seq):
             sequence = str(sequence)
@@ -971,6 +1101,9 @@ def codon_position(sequence: Union[str, Seq, SeqRecord], base: int, *, codon_off
     if sequence[base] == "-":
         raise ValueError(f"Position {base} is a gap")
     
+    if gap_index is not None:
+        return gap_index.codon_position(base, codon_offset=codon_offset)
+
     adjusted_base: int =  base-sequence[:base+1].count("-")
     return ((adjusted_base + codon_offset) % 3)
 
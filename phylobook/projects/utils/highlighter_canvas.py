@@ -0,0 +1,602 @@
+""" Drawing backends for HighlighterPlot: reportlab for every format, SVG written straight to the output file, SVG with marks batched into paths,
+or PNG painted straight into a pixel array """
+
+import math, os, struct, threading, zlib
+from typing import Callable
+from xml.sax.saxutils import escape, quoteattr
+
+import numpy as np
+
+from reportlab.lib.colors import Color
+from reportlab.lib.rl_accel import unicode2T1
+from reportlab.pdfbase.pdfmetrics import getFont, stringWidth
+from reportlab.graphics.shapes import Drawing, String, Line, Rect, Circle, Polygon
+
+from Bio.Graphics import _write
+
+# SVG output is written through a buffer this size
+SVG_BUFFER_BYTES: int = 1024 * 1024
+
+# PNG pixel rows are painted and compressed this many at a time
+PNG_BAND_ROWS: int = 256
+
+# How far above the top of its row a later shape (a glyph's stroke) can reach, so rows of tiles and bands of pixels are kept until nothing more can land in them
+SHAPE_REACH: float = 2
+
+
+class Canvas:
+    """ Shapes shared by every backend: marks are rectangles and glyphs are small repeated symbols
+    backends that can batch these (SvgPathCanvas) override mark and glyph
+    draw inside a with block so a plot that fails part way is discarded, leaving no open file or partial output behind """
+
+    def __enter__(self) -> "Canvas":
+        """ Returns the canvas to draw on """
+
+        return self
+
+    def __exit__(self, error_type, error, traceback) -> None:
+        """ Discard the plot if drawing it raised """
+
+        if error_type is not None:
+            self.discard()
+
+    def discard(self) -> None:
+        """ Drop a plot that won't be saved """
+
+        pass
+
+    def mark(self, x: float, y: float, width: float, height: float, *, fill: Color, stroke: Color, stroke_width: float=1) -> None:
+        """ Draw a sequence mark """
+
+        self.rect(x, y, width, height, fill=fill, stroke=stroke, stroke_width=stroke_width)
+
+    def glyph(self, shape: str, x: float, y: float, *, radius: float, fill: Color, stroke: Color, stroke_width: float=1) -> None:
+        """ Draw a diamond or circle glyph centered on x, y """
+
+        if shape == "diamond":
+            self.polygon([x, y-radius, x-radius, y, x, y+radius, x+radius, y], fill=fill, stroke=stroke, stroke_width=stroke_width)
+        elif shape == "circle":
+            self.circle(x, y, radius, fill=fill, stroke=stroke, stroke_width=stroke_width)
+        else:
+            raise ValueError(f"Unknown glyph shape '{shape}'")
+
+
+class ReportlabCanvas(Canvas):
+    """ Collects shapes in a reportlab Drawing and renders it with Bio.Graphics when saved """
+
+    def __init__(self, output_file, *, width: float, height: float, output_format: str="svg", dpi: float=72):
+        """ Start an empty drawing """
+
+        self.output_file = output_file
+        self.output_format: str = output_format
+        self.dpi: float = dpi
+
+        self.drawing = Drawing(width, height)
+
+    def rect(self, x: float, y: float, width: float, height: float, *, fill: Color, stroke: Color, stroke_width: float=1) -> None:
+        """ Add a rectangle """
+
+        self.drawing.add(Rect(x, y, width, height, fillColor=fill, strokeColor=stroke, strokeWidth=stroke_width))
+
+    def line(self, x1: float, y1: float, x2: float, y2: float, *, stroke: Color, stroke_width: float=1) -> None:
+        """ Add a line """
+
+        self.drawing.add(Line(x1, y1, x2, y2, strokeColor=stroke, strokeWidth=stroke_width))
+
+    def polygon(self, points: list[float], *, stroke: Color, stroke_width: float=1, fill: Color=None) -> None:
+        """ Add a polygon from a flat list of x, y coordinates """
+
+        self.drawing.add(Polygon(points, strokeColor=stroke, strokeWidth=stroke_width, fillColor=fill))
+
+    def circle(self, x: float, y: float, radius: float, *, fill: Color, stroke: Color, stroke_width: float=1) -> None:
+        """ Add a circle """
+
+        self.drawing.add(Circle(x, y, radius, fillColor=fill, strokeColor=stroke, strokeWidth=stroke_width))
+
+    def string(self, x: float, y: float, text: str, *, font: str, font_size: float, anchor: str="start") -> None:
+        """ Add a line of text """
+
+        self.drawing.add(String(x, y, text, textAnchor=anchor, fontName=font, fontSize=font_size))
+
+    def save(self):
+        """ Render the drawing to the output file """
+
+        return _write(self.drawing, self.output_file, self.output_format, dpi=self.dpi)
+
+
+class SvgStreamCanvas(Canvas):
+    """ Writes each shape to an SVG file as soon as it is drawn, without building a Drawing
+    uses the same y-up coordinates, flipping group and viewBox as reportlab's SVG renderer """
+
+    def __init__(self, output_file, *, width: float, height: float, output_format: str="svg", dpi: float=72):
+        """ Open the output (a file name or file-like object) and write the SVG header """
+
+        if output_format.lower() != "svg":
+            raise ValueError(f"SvgStreamCanvas can only write SVG, got {output_format}")
+
+        # A named file is written under a temporary name, so a plot that fails part way never looks finished
+        self.output_file = output_file
+
+        if hasattr(output_file, "write"):
+            self.file = output_file
+            self._owns_file: bool = False
+        else:
+            self.partial_file: str = partial_file_name(output_file)
+            self.file = open(self.partial_file, mode="wt", encoding="utf-8", buffering=SVG_BUFFER_BYTES)
+            self._owns_file: bool = True
+
+        self.height: float = height
+
+        self.file.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        self.file.write(f'<svg width="{width}" height="{height}" preserveAspectRatio="xMinYMin meet" viewBox="0 0 {int(width)} {int(height)}" xmlns="http://www.w3.org/2000/svg" version="1.0" fill-rule="evenodd" xmlns:xlink="http://www.w3.org/1999/xlink">\n')
+        self.file.write(f'<g id="group" transform="scale(1,-1) translate(0,-{int(height)})">\n')
+
+    def rect(self, x: float, y: float, width: float, height: float, *, fill: Color, stroke: Color, stroke_width: float=1) -> None:
+        """ Write a rectangle, flipping negative sizes like reportlab does """
+
+        if width < 0:
+            x, width = x + width, -width
+
+        if height < 0:
+            y, height = y + height, -height
+
+        self.file.write(f'<rect x="{number(x)}" y="{number(y)}" width="{number(width)}" height="{number(height)}" {paint(fill=fill, stroke=stroke, stroke_width=stroke_width)}/>\n')
+
+    def line(self, x1: float, y1: float, x2: float, y2: float, *, stroke: Color, stroke_width: float=1) -> None:
+        """ Write a line """
+
+        self.file.write(f'<line x1="{number(x1)}" y1="{number(y1)}" x2="{number(x2)}" y2="{number(y2)}" {paint(stroke=stroke, stroke_width=stroke_width)}/>\n')
+
+    def polygon(self, points: list[float], *, stroke: Color, stroke_width: float=1, fill: Color=None) -> None:
+        """ Write a polygon from a flat list of x, y coordinates """
+
+        coordinates: str = " ".join(f"{number(x)},{number(y)}" for x, y in zip(points[::2], points[1::2]))
+
+        self.file.write(f'<polygon points="{coordinates}" {paint(fill=fill, stroke=stroke, stroke_width=stroke_width)}/>\n')
+
+    def circle(self, x: float, y: float, radius: float, *, fill: Color, stroke: Color, stroke_width: float=1) -> None:
+        """ Write a circle """
+
+        self.file.write(f'<circle cx="{number(x)}" cy="{number(y)}" r="{number(radius)}" {paint(fill=fill, stroke=stroke, stroke_width=stroke_width)}/>\n')
+
+    def string(self, x: float, y: float, text: str, *, font: str, font_size: float, anchor: str="start") -> None:
+        """ Write a line of text, flipped back upright inside the y-up group """
+
+        if anchor == "middle":
+            x -= string_width(text, font, font_size) / 2
+        elif anchor == "end":
+            x -= string_width(text, font, font_size)
+
+        self.file.write(f'<text x="{number(x)}" y="{number(y)}" font-family={quoteattr(font)} font-size="{number(font_size)}px" fill="{svg_color(Color(0, 0, 0))}" transform="translate(0,{number(2*y)}) scale(1,-1)">{escape(text)}</text>\n')
+
+    def save(self) -> None:
+        """ Close the SVG, and move the file into place if it was opened here """
+
+        self._finish()
+
+        self.file.write("</g>\n</svg>\n")
+
+        if self._owns_file:
+            self.file.close()
+            os.replace(self.partial_file, self.output_file)
+
+    def discard(self) -> None:
+        """ Close and remove the partial file if it was opened here """
+
+        if self._owns_file:
+            self.file.close()
+
+            if os.path.exists(self.partial_file):
+                os.remove(self.partial_file)
+
+    def _finish(self) -> None:
+        """ Write anything held back until the end of the plot """
+
+        pass
+
+
+class SvgPathCanvas(SvgStreamCanvas):
+    """ A streaming SVG canvas that merges every mark of one color into a single <path>
+    and draws glyphs as <use> references to one <symbol> per glyph style
+    the paths and glyphs are written when the plot is saved, on top of the lines and labels, like the marks in the other backends """
+
+    def __init__(self, output_file, *, width: float, height: float, output_format: str="svg", dpi: float=72):
+        """ Start with no marks or glyphs """
+
+        super().__init__(output_file, width=width, height=height, output_format=output_format, dpi=dpi)
+
+        self._paths: dict[str: MarkPath] = {}
+        self._symbols: dict[tuple: str] = {}
+        self._uses: list[str] = []
+
+    def mark(self, x: float, y: float, width: float, height: float, *, fill: Color, stroke: Color, stroke_width: float=1) -> None:
+        """ Add a mark to the path for its color """
+
+        if width < 0:
+            x, width = x + width, -width
+
+        if height < 0:
+            y, height = y + height, -height
+
+        attributes: str = paint(fill=fill, stroke=stroke, stroke_width=stroke_width)
+
+        if attributes not in self._paths:
+            self._paths[attributes] = MarkPath()
+
+        self._paths[attributes].add(x, y, width, height)
+
+    def glyph(self, shape: str, x: float, y: float, *, radius: float, fill: Color, stroke: Color, stroke_width: float=1) -> None:
+        """ Add a reference to the symbol for this glyph style, defining the symbol the first time it is used """
+
+        if shape not in ("diamond", "circle"):
+            raise ValueError(f"Unknown glyph shape '{shape}'")
+
+        attributes: str = paint(fill=fill, stroke=stroke, stroke_width=stroke_width)
+        key: tuple = (shape, number(radius), attributes)
+
+        if key not in self._symbols:
+            self._symbols[key] = f"glyph{len(self._symbols)}"
+
+        self._uses.append(f'<use xlink:href="#{self._symbols[key]}" x="{number(x)}" y="{number(y)}"/>\n')
+
+    def _finish(self) -> None:
+        """ Write one path per mark color, then the glyph symbols and their references """
+
+        for attributes, path in self._paths.items():
+            self.file.write(f'<path d="{path}" fill-rule="nonzero" {attributes}/>\n')
+
+        if self._symbols:
+            self.file.write("<defs>\n")
+
+            for (shape, radius, attributes), symbol_id in self._symbols.items():
+                if shape == "diamond":
+                    element: str = f'<polygon points="0,-{radius} -{radius},0 0,{radius} {radius},0" {attributes}/>'
+                else:
+                    element: str = f'<circle cx="0" cy="0" r="{radius}" {attributes}/>'
+
+                self.file.write(f'<symbol id="{symbol_id}" overflow="visible">{element}</symbol>\n')
+
+            self.file.write("</defs>\n")
+
+        self.file.writelines(self._uses)
+
+
+class MarkPath:
+    """ The data of an SVG path made of rectangles, written with relative moves from one rectangle to the next """
+
+    def __init__(self):
+        """ Start an empty path """
+
+        self._commands: list[str] = []
+        self._x: float = 0
+        self._y: float = 0
+
+    def add(self, x: float, y: float, width: float, height: float) -> None:
+        """ Add a closed rectangle, relative to the start of the previous one
+        coordinates are rounded before taking differences so the rounding doesn't add up along the path """
+
+        x, y, width, height = (round(value, 4) for value in (x, y, width, height))
+
+        self._commands.append(f"m{number(x - self._x)} {number(y - self._y)}h{number(width)}v{number(height)}h{number(-width)}z")
+        self._x, self._y = x, y
+
+    def __str__(self) -> str:
+        """ Returns the path data """
+
+        return "".join(self._commands)
+
+
+class RasterCanvas(Canvas):
+    """ Paints shapes straight into RGB pixels and writes them as a PNG, with no drawing objects in between
+    marks are always at least a pixel so they stay visible in thumbnails, and text is left out since there is no font rasterizer
+    only one band of PNG_BAND_ROWS pixel rows is in memory at a time: shapes are queued for the bands they touch,
+    and marks must be drawn from the top of the plot down, as HighlighterPlot does, so finished bands can be painted, compressed and dropped """
+
+    def __init__(self, output_file, *, width: float, height: float, output_format: str="png", dpi: float=72):
+        """ Start a white image, dpi/72 pixels per point """
+
+        if output_format.lower() != "png":
+            raise ValueError(f"RasterCanvas can only write PNG, got {output_format}")
+
+        self.output_file = output_file
+        self.partial_file: str = None if hasattr(output_file, "write") else partial_file_name(output_file)
+
+        self.height: float = height
+        self.scale: float = dpi / 72
+
+        self.pixel_width: int = max(1, math.ceil(width * self.scale))
+        self.pixel_height: int = max(1, math.ceil(height * self.scale))
+        self.bands: int = math.ceil(self.pixel_height / PNG_BAND_ROWS)
+
+        # The band being painted, and the pixel row at its top
+        self.pixels: np.ndarray = None
+        self._band_top: int = 0
+
+        self._pending: dict[int: list] = {}
+        self._written_bands: int = 0
+        self._png: PngEncoder = PngEncoder(self.pixel_width, self.pixel_height)
+
+    def rect(self, x: float, y: float, width: float, height: float, *, fill: Color, stroke: Color, stroke_width: float=1) -> None:
+        """ Queue a rectangle """
+
+        self._add(min(y, y+height), max(y, y+height), stroke_width if stroke is not None and stroke != fill else 0, lambda: self._paint_rect(x, y, width, height, fill=fill, stroke=stroke, stroke_width=stroke_width))
+
+    def mark(self, x: float, y: float, width: float, height: float, *, fill: Color, stroke: Color, stroke_width: float=1) -> None:
+        """ Queue a mark, first painting the bands that nothing below it can reach (allowing a pixel for shapes rounded up to one) """
+
+        self._write_bands(self._band(max(y, y+height) + SHAPE_REACH + 1 / self.scale))
+        self.rect(x, y, width, height, fill=fill, stroke=stroke, stroke_width=stroke_width)
+
+    def line(self, x1: float, y1: float, x2: float, y2: float, *, stroke: Color, stroke_width: float=1) -> None:
+        """ Queue a line """
+
+        self._add(min(y1, y2), max(y1, y2), stroke_width, lambda: self._paint_line(x1, y1, x2, y2, stroke=stroke, stroke_width=stroke_width))
+
+    def polygon(self, points: list[float], *, stroke: Color, stroke_width: float=1, fill: Color=None) -> None:
+        """ Queue a polygon """
+
+        self._add(min(points[1::2]), max(points[1::2]), stroke_width if stroke is not None else 0, lambda: self._paint_polygon(points, stroke=stroke, stroke_width=stroke_width, fill=fill))
+
+    def circle(self, x: float, y: float, radius: float, *, fill: Color, stroke: Color, stroke_width: float=1) -> None:
+        """ Queue a circle """
+
+        self._add(y-radius, y+radius, stroke_width if stroke is not None else 0, lambda: self._paint_circle(x, y, radius, fill=fill, stroke=stroke, stroke_width=stroke_width))
+
+    def string(self, x: float, y: float, text: str, *, font: str, font_size: float, anchor: str="start") -> None:
+        """ Text isn't rasterized """
+
+        pass
+
+    def save(self) -> None:
+        """ Paint the remaining bands and write the PNG, to a temporary name first if the output is a file name """
+
+        self._write_bands(self.bands)
+
+        if hasattr(self.output_file, "write"):
+            self._png.write(self.output_file)
+            return
+
+        with open(self.partial_file, mode="wb") as file:
+            self._png.write(file)
+
+        os.replace(self.partial_file, self.output_file)
+
+    def discard(self) -> None:
+        """ Drop the queued shapes, and remove the partial file if saving it failed part way """
+
+        self._pending.clear()
+
+        if self.partial_file and os.path.exists(self.partial_file):
+            os.remove(self.partial_file)
+
+    def _add(self, bottom: float, top: float, stroke_width: float, paint: Callable) -> None:
+        """ Queue a shape for every band its vertical extent (widened by its stroke) touches """
+
+        half: float = max(stroke_width / 2, .5 / self.scale)
+
+        # Shapes are at least a pixel, so the window can run a row past the shape's bottom edge
+        _, rows = self._window(0, (self.height - top - half) * self.scale, 0, (self.height - bottom + half) * self.scale)
+        first_band, last_band = rows[0] // PNG_BAND_ROWS, min(self.bands-1, rows[1] // PNG_BAND_ROWS)
+
+        if first_band < self._written_bands:
+            raise ValueError("RasterCanvas marks must be drawn from the top of the plot down")
+
+        for band in range(first_band, last_band+1):
+            self._pending.setdefault(band, []).append(paint)
+
+    def _band(self, y: float) -> int:
+        """ Returns the band (from the top) containing a y coordinate, clamped to the image """
+
+        return min(self.bands-1, max(0, int((self.height - y) * self.scale) // PNG_BAND_ROWS))
+
+    def _write_bands(self, bands: int) -> None:
+        """ Paint and compress every band before the given band that hasn't been written yet """
+
+        for band in range(self._written_bands, bands):
+            self._band_top = band * PNG_BAND_ROWS
+            self.pixels = np.full((min(PNG_BAND_ROWS, self.pixel_height - self._band_top), self.pixel_width, 3), 255, dtype=np.uint8)
+
+            for paint in self._pending.pop(band, []):
+                paint()
+
+            self._png.add(self.pixels)
+
+        self._written_bands = max(self._written_bands, bands)
+
+    def _paint_rect(self, x: float, y: float, width: float, height: float, *, fill: Color, stroke: Color, stroke_width: float=1) -> None:
+        """ Paint a rectangle, outlining it only if the stroke differs from the fill """
+
+        if fill is not None:
+            self._fill(min(x, x+width), min(y, y+height), max(x, x+width), max(y, y+height), fill)
+
+        if stroke is not None and stroke != fill:
+            self._paint_polygon([x, y, x+width, y, x+width, y+height, x, y+height], stroke=stroke, stroke_width=stroke_width)
+
+    def _paint_line(self, x1: float, y1: float, x2: float, y2: float, *, stroke: Color, stroke_width: float=1) -> None:
+        """ Paint a line as a band stroke_width thick (and at least a pixel) """
+
+        half: float = stroke_width / 2
+
+        if x1 == x2 or y1 == y2:
+            self._fill(min(x1, x2) - (half if x1 == x2 else 0), min(y1, y2) - (half if y1 == y2 else 0), max(x1, x2) + (half if x1 == x2 else 0), max(y1, y2) + (half if y1 == y2 else 0), stroke)
+            return
+
+        steps: int = max(1, math.ceil(max(abs(x2-x1), abs(y2-y1)) * self.scale))
+
+        for step in range(steps+1):
+            x: float = x1 + (x2-x1) * step / steps
+            y: float = y1 + (y2-y1) * step / steps
+
+            self._fill(x-half, y-half, x+half, y+half, stroke)
+
+    def _paint_polygon(self, points: list[float], *, stroke: Color, stroke_width: float=1, fill: Color=None) -> None:
+        """ Paint a polygon, filling the pixels whose centers are inside it """
+
+        xs: np.ndarray = np.array(points[::2], dtype=float) * self.scale
+        ys: np.ndarray = (self.height - np.array(points[1::2], dtype=float)) * self.scale
+
+        if fill is not None and (window := self._band_window(*self._window(xs.min(), ys.min(), xs.max(), ys.max()))):
+            columns, rows = window
+            column_centers, row_centers = np.meshgrid(np.arange(*columns) + .5, np.arange(*rows) + .5)
+            inside: np.ndarray = np.zeros(column_centers.shape, dtype=bool)
+
+            for x1, y1, x2, y2 in zip(xs, ys, np.roll(xs, -1), np.roll(ys, -1)):
+                if y1 != y2:
+                    crosses: np.ndarray = ((y1 > row_centers) != (y2 > row_centers)) & (column_centers < x1 + (row_centers - y1) * (x2 - x1) / (y2 - y1))
+                    inside ^= crosses
+
+            self.pixels[rows[0]-self._band_top:rows[1]-self._band_top, columns[0]:columns[1]][inside] = rgb(fill)
+
+        if stroke is not None:
+            for index in range(0, len(points), 2):
+                self._paint_line(points[index], points[index+1], points[(index+2) % len(points)], points[(index+3) % len(points)], stroke=stroke, stroke_width=stroke_width)
+
+    def _paint_circle(self, x: float, y: float, radius: float, *, fill: Color, stroke: Color, stroke_width: float=1) -> None:
+        """ Paint a disc, with its outline as a ring stroke_width wide """
+
+        outer: float = radius + (stroke_width / 2 if stroke is not None else 0)
+
+        if not (window := self._band_window(*self._window((x-outer) * self.scale, (self.height-y-outer) * self.scale, (x+outer) * self.scale, (self.height-y+outer) * self.scale))):
+            return
+
+        columns, rows = window
+        column_centers, row_centers = np.meshgrid(np.arange(*columns) + .5, np.arange(*rows) + .5)
+        distances: np.ndarray = np.hypot(column_centers / self.scale - x, row_centers / self.scale - (self.height - y))
+        pixels: np.ndarray = self.pixels[rows[0]-self._band_top:rows[1]-self._band_top, columns[0]:columns[1]]
+
+        if fill is not None:
+            pixels[distances <= radius] = rgb(fill)
+
+        if stroke is not None:
+            pixels[np.abs(distances - radius) <= max(stroke_width / 2, .5 / self.scale)] = rgb(stroke)
+
+    def _fill(self, left: float, bottom: float, right: float, top: float, color: Color) -> None:
+        """ Paint the pixels of the current band covering a box in plot coordinates, at least one pixel wide and high """
+
+        if window := self._band_window(*self._window(left * self.scale, (self.height - top) * self.scale, right * self.scale, (self.height - bottom) * self.scale)):
+            columns, rows = window
+            self.pixels[rows[0]-self._band_top:rows[1]-self._band_top, columns[0]:columns[1]] = rgb(color)
+
+    def _window(self, left: float, top: float, right: float, bottom: float) -> tuple[tuple[int]]:
+        """ Returns the (start, end) pixel columns and rows covering a box in pixel coordinates, clipped to the image """
+
+        first_column: int = min(self.pixel_width-1, max(0, math.floor(left)))
+        first_row: int = min(self.pixel_height-1, max(0, math.floor(top)))
+
+        return (first_column, min(self.pixel_width, max(first_column+1, math.ceil(right)))), (first_row, min(self.pixel_height, max(first_row+1, math.ceil(bottom))))
+
+    def _band_window(self, columns: tuple[int], rows: tuple[int]) -> tuple[tuple[int]]:
+        """ Returns a window's columns and its rows clipped to the current band, or None if it misses the band """
+
+        rows = (max(rows[0], self._band_top), min(rows[1], self._band_top + len(self.pixels)))
+
+        return (columns, rows) if rows[0] < rows[1] else None
+
+
+class GlyphWidths:
+    """ A table of character widths for a font, in thousandths of the font size, filled in as characters are first seen
+    widths add up exactly as reportlab's stringWidth does for the standard (Type 1) fonts, and other fonts fall back to stringWidth """
+
+    def __init__(self, font_name: str):
+        """ Start an empty table for a font """
+
+        self.font_name: str = font_name
+        self.font = getFont(font_name)
+        self.widths: dict[str: float] = {}
+
+    def string_width(self, text: str, font_size: float) -> float:
+        """ Returns the width of a string in points """
+
+        if not hasattr(self.font, "widths"):
+            return stringWidth(text, self.font_name, font_size)
+
+        try:
+            return sum(map(self.widths.__getitem__, text)) * 0.001 * font_size
+
+        except KeyError:
+            for character in set(text) - self.widths.keys():
+                self.widths[character] = sum(sum(map(font.widths.__getitem__, encoded)) for font, encoded in unicode2T1(character, [self.font] + self.font.substitutionFonts))
+
+            return sum(map(self.widths.__getitem__, text)) * 0.001 * font_size
+
+
+_glyph_widths: dict[str: GlyphWidths] = {}
+
+
+def string_width(text: str, font_name: str, font_size: float) -> float:
+    """ Returns the width of a string in points, from the font's GlyphWidths table """
+
+    if font_name not in _glyph_widths:
+        _glyph_widths[font_name] = GlyphWidths(font_name)
+
+    return _glyph_widths[font_name].string_width(text, font_size)
+
+
+class PngEncoder:
+    """ Compresses RGB pixels into a PNG a band of rows at a time, so the whole image never has to be in memory """
+
+    def __init__(self, width: int, height: int):
+        """ Start an empty image """
+
+        self.width: int = width
+        self.height: int = height
+
+        self._compressor = zlib.compressobj(6)
+        self._data: list[bytes] = []
+
+    def add(self, rows: np.ndarray) -> None:
+        """ Compress the next rows of pixels """
+
+        rows = rows.reshape(-1, self.width*3)
+
+        # Each row starts with filter type 0 (none)
+        self._data.append(self._compressor.compress(np.hstack([np.zeros((len(rows), 1), dtype=np.uint8), rows]).tobytes()))
+
+    def write(self, file) -> None:
+        """ Write the PNG to a binary file """
+
+        def chunk(kind: bytes, data: bytes) -> bytes:
+            return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+        self._data.append(self._compressor.flush())
+
+        file.write(b"\x89PNG\r\n\x1a\n")
+        file.write(chunk(b"IHDR", struct.pack(">IIBBBBB", self.width, self.height, 8, 2, 0, 0, 0)))
+        file.write(chunk(b"IDAT", b"".join(self._data)))
+        file.write(chunk(b"IEND", b""))
+
+
+def partial_file_name(output_file: str) -> str:
+    """ Returns the temporary name a plot is written under before it is moved into place
+    each process and thread gets its own, so two requests drawing the same file can't write into one partial file """
+
+    return f"{output_file}.{os.getpid()}.{threading.get_ident()}.partial"
+
+
+def rgb(color: Color) -> tuple[int]:
+    """ Returns a reportlab color as 0-255 red, green and blue, inverting HighlighterPlot._hex_to_color """
+
+    return tuple(min(255, int(value * 256)) for value in (color.red, color.green, color.blue))
+
+
+def number(value: float) -> str:
+    """ Format a coordinate with enough precision for a plot, and no trailing zeros """
+
+    return f"{value:.4f}".rstrip("0").rstrip(".")
+
+
+def svg_color(color: Color) -> str:
+    """ Format a reportlab color the way reportlab's SVG renderer does """
+
+    return f"rgb({int(color.red*100)}%,{int(color.green*100)}%,{int(color.blue*100)}%)"
+
+
+def paint(*, fill: Color=None, stroke: Color=None, stroke_width: float=1) -> str:
+    """ Returns the fill and stroke attributes for a shape """
+
+    attributes: list[str] = [f'fill="{svg_color(fill) if fill is not None else "none"}"']
+
+    if stroke is not None:
+        attributes.append(f'stroke="{svg_color(stroke)}" stroke-width="{number(stroke_width)}"')
+
+    return " ".join(attributes)
@@ -0,0 +1,617 @@
+""" Vectorized engines that find highlighter marks for a whole alignment at once """
+
+import logging
+log = logging.getLogger('app')
+
+from multiprocessing import Pool, current_process, shared_memory
+from typing import Callable, Union
+
+import numpy as np
+
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+GAP: int = ord("-")
+WILDCARD: int = ord("X")
+BLOCK_ROWS: int = 256
+MAX_MATCH_REFERENCES: int = 64
+
+# Mismatch codes hold the mismatched character in the low byte and these flags in the high byte
+CHARACTER_MASK: int = 0xFF
+G_TO_A_MUTATION: int = 1
+APOBEC: int = 2
+STOP_CODON: int = 4
+GLYCOSYLATION: int = 8
+
+MISMATCH_FLAGS: dict[int: str] = {
+    G_TO_A_MUTATION: "G->A mutation",
+    APOBEC: "APOBEC",
+    STOP_CODON: "Stop codon",
+    GLYCOSYLATION: "Glycosylation",
+}
+
+
+class AlignmentMatrix:
+    """ An alignment encoded once as a (distinct sequences x columns) uint8 matrix
+    identical sequences are stored once, and inverse maps each sequence to its distinct row """
+
+    def __init__(self, alignment):
+        """ Encode the alignment, hashing each sequence so duplicates share a row """
+
+        rows: list[bytes] = []
+        distinct: dict[bytes: int] = {}
+        inverse: list[int] = []
+        self.ids: list[str] = []
+
+        for sequence in alignment:
+            row: bytes = sequence_string(sequence).encode("ascii")
+
+            if row not in distinct:
+                distinct[row] = len(rows)
+                rows.append(row)
+
+            inverse.append(distinct[row])
+            self.ids.append(getattr(sequence, "id", None))
+
+        if len({len(row) for row in rows}) > 1:
+            raise ValueError("All sequences in the alignment must be the same length")
+
+        if rows:
+            self.distinct: np.ndarray = np.frombuffer(b"".join(rows), dtype=np.uint8).reshape(len(rows), len(rows[0]))
+        else:
+            self.distinct: np.ndarray = np.zeros((0, 0), dtype=np.uint8)
+
+        self.inverse: np.ndarray = np.array(inverse, dtype=np.intp)
+
+        log.debug(f"Deduplicated {len(self)} sequences to {len(self.distinct)} distinct sequences (ratio {self.dedupe_ratio:.2f})")
+
+    @classmethod
+    def from_arrays(cls, *, distinct: np.ndarray, inverse: np.ndarray, ids: list[str]) -> "AlignmentMatrix":
+        """ Rebuild an AlignmentMatrix from its stored distinct rows and inverse index """
+
+        matrix = cls.__new__(cls)
+        matrix.distinct = distinct
+        matrix.inverse = inverse
+        matrix.ids = ids
+
+        return matrix
+
+    def __len__(self) -> int:
+        """ Returns the number of sequences """
+
+        return len(self.inverse)
+
+    @property
+    def length(self) -> int:
+        """ Returns the number of columns """
+
+        return self.distinct.shape[1]
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """ Returns the full (sequences x columns) matrix, with duplicates expanded """
+
+        return self.distinct[self.inverse]
+
+    @property
+    def dedupe_ratio(self) -> float:
+        """ Returns the number of sequences per distinct sequence (1 means there were no duplicates) """
+
+        return len(self) / len(self.distinct) if len(self.distinct) else 1.0
+
+    def row(self, index: int) -> np.ndarray:
+        """ Returns the encoded row of one sequence """
+
+        return self.distinct[self.inverse[index]]
+
+    def mismatch_intervals(self, *, reference: int, seq_type: str, apobec: bool=False, g_to_a: bool=False, stop_codons: bool=False, glycosylation: bool=False, codon_offset: int=0, processes: int=1) -> list["Intervals"]:
+        """ Get mismatches of every sequence against the reference row
+        returns one Intervals per sequence, with codes built from the mismatched character and MISMATCH_FLAGS
+        each distinct sequence is compared once, and sequences that are the same share an Intervals """
+
+        if seq_type not in ("NT", "AA"):
+            raise ValueError("type must be provided (either 'NT' or 'AA')")
+
+        return self.expand(self.distinct_mismatch_intervals(reference=reference, seq_type=seq_type, apobec=apobec, g_to_a=g_to_a, stop_codons=stop_codons, glycosylation=glycosylation, codon_offset=codon_offset, processes=processes))
+
+    def distinct_mismatch_intervals(self, *, reference: int, seq_type: str, apobec: bool=False, g_to_a: bool=False, stop_codons: bool=False, glycosylation: bool=False, codon_offset: int=0, processes: int=1) -> list["Intervals"]:
+        """ Get mismatches of each distinct sequence against the reference row (see mismatch_intervals) """
+
+        if seq_type not in ("NT", "AA"):
+            raise ValueError("type must be provided (either 'NT' or 'AA')")
+
+        return self._map_distinct(mismatch_block, processes=processes, reference=self.row(reference), seq_type=seq_type, apobec=apobec, g_to_a=g_to_a, stop_codons=stop_codons, glycosylation=glycosylation, codon_offset=codon_offset)
+
+    def match_masks(self, references: list[Union[str, Seq, SeqRecord]]) -> np.ndarray:
+        """ Get a (sequences x columns) matrix of bitmasks, where bit r is set when the sequence matches reference r at that column
+        an X in a reference matches anything """
+
+        encoded_references: list[np.ndarray] = self._encode_references(references)
+        masks: np.ndarray = np.zeros(self.distinct.shape, dtype=mask_dtype(len(references)))
+
+        for start in range(0, len(self.distinct), BLOCK_ROWS):
+            masks[start:start+BLOCK_ROWS] = match_mask_block(self.distinct[start:start+BLOCK_ROWS], encoded_references)
+
+        return masks[self.inverse]
+
+    def match_intervals(self, references: list[Union[str, Seq, SeqRecord]], *, processes: int=1) -> list["Intervals"]:
+        """ Get the runs of each sequence that don't match every reference, with the bitmask as the code
+        each distinct sequence is compared once, and sequences that are the same share an Intervals """
+
+        return self.expand(self.distinct_match_intervals(references, processes=processes))
+
+    def distinct_match_intervals(self, references: list[Union[str, Seq, SeqRecord]], *, processes: int=1) -> list["Intervals"]:
+        """ Get the match intervals of each distinct sequence (see match_intervals) """
+
+        return self._map_distinct(match_block, processes=processes, references=self._encode_references(references))
+
+    def expand(self, distinct_intervals: list["Intervals"]) -> list["Intervals"]:
+        """ Fan results for the distinct rows out to every sequence """
+
+        return [distinct_intervals[index] for index in self.inverse.tolist()]
+
+    def _encode_references(self, references: list[Union[str, Seq, SeqRecord]]) -> list[np.ndarray]:
+        """ Encode match references, checking there aren't too many and that they are the right length """
+
+        if len(references) > MAX_MATCH_REFERENCES:
+            raise ValueError(f"Can not match against more than {MAX_MATCH_REFERENCES} references, got {len(references)}")
+
+        encoded_references: list[np.ndarray] = []
+
+        for reference in references:
+            encoded_reference = np.frombuffer(sequence_string(reference).encode("ascii"), dtype=np.uint8)
+
+            if len(encoded_reference) != self.length:
+                raise ValueError("All references and sequence must be the same length")
+
+            encoded_references.append(encoded_reference)
+
+        return encoded_references
+
+    def _map_distinct(self, block_function: Callable, *, processes: int=1, **options) -> list["Intervals"]:
+        """ Run a block function over the distinct rows, BLOCK_ROWS at a time, and return the results in row order
+        with more than one process the rows are placed in shared memory and split into contiguous ranges across a pool,
+        so only the range bounds and options are sent to each worker """
+
+        ranges: list[tuple[int, int]] = row_ranges(len(self.distinct), processes)
+
+        # Daemonic processes (like the workers in ensure_project_highlighter_svgs) can't start a pool of their own
+        if len(ranges) <= 1 or current_process().daemon:
+            return _map_rows(self.distinct, block_function, 0, len(self.distinct), options)
+
+        log.debug(f"Splitting {len(self.distinct)} distinct sequences across {len(ranges)} processes")
+
+        shared = shared_memory.SharedMemory(create=True, size=self.distinct.nbytes)
+
+        try:
+            np.ndarray(self.distinct.shape, dtype=np.uint8, buffer=shared.buf)[:] = self.distinct
+
+            with Pool(len(ranges), initializer=_attach_shared_rows, initargs=(shared.name, self.distinct.shape)) as pool:
+                results: list[list] = pool.starmap(_map_shared_rows, [(block_function, start, stop, options) for start, stop in ranges])
+
+        finally:
+            shared.close()
+            shared.unlink()
+
+        return [result for range_results in results for result in range_results]
+
+
+class Intervals:
+    """ Runs of equal codes along one sequence, stored as parallel start, length and code arrays
+    columns holding the background code (no mark) are left out, so size scales with the number of runs """
+
+    def __init__(self, starts: np.ndarray, lengths: np.ndarray, codes: np.ndarray):
+        """ Wrap the run arrays, which must be ordered by start """
+
+        self.starts: np.ndarray = np.asarray(starts, dtype=np.int32)
+        self.lengths: np.ndarray = np.asarray(lengths, dtype=np.int32)
+        self.codes: np.ndarray = np.asarray(codes)
+
+    @classmethod
+    def encode(cls, row: np.ndarray, *, background: int=0) -> "Intervals":
+        """ Run length encode a row of codes, leaving out runs of the background code """
+
+        if not len(row):
+            return cls([], [], row[:0])
+
+        boundaries: np.ndarray = np.flatnonzero(row[1:] != row[:-1]) + 1
+        starts: np.ndarray = np.concatenate(([0], boundaries))
+        ends: np.ndarray = np.concatenate((boundaries, [len(row)]))
+        keep: np.ndarray = row[starts] != background
+
+        return cls(starts[keep], (ends - starts)[keep], row[starts][keep])
+
+    def __len__(self) -> int:
+        """ Returns the number of runs """
+
+        return len(self.starts)
+
+    def __iter__(self):
+        """ Yields (start, length, code) for each run """
+
+        return zip(self.starts.tolist(), self.lengths.tolist(), self.codes.tolist())
+
+    def __eq__(self, other) -> bool:
+        """ Intervals are equal when all of their runs are """
+
+        if not isinstance(other, Intervals):
+            return NotImplemented
+
+        return list(self) == list(other)
+
+    @property
+    def marked(self) -> int:
+        """ Returns the number of columns covered by the runs """
+
+        return int(self.lengths.sum())
+
+    def positions(self, keep: np.ndarray=None) -> list[int]:
+        """ Returns every column covered by the runs (or the runs selected by keep), in order """
+
+        starts: np.ndarray = self.starts if keep is None else self.starts[keep]
+        lengths: np.ndarray = self.lengths if keep is None else self.lengths[keep]
+
+        if not len(starts):
+            return []
+
+        offsets: np.ndarray = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+        return (np.repeat(starts, lengths) + offsets).tolist()
+
+
+class GapIndex:
+    """ Prefix counts of the gaps in one sequence, so ungapped coordinates are O(1) lookups """
+
+    def __init__(self, sequence: Union[str, Seq, SeqRecord]):
+        """ Build the index """
+
+        self.sequence: str = sequence_string(sequence)
+
+        encoded: np.ndarray = np.frombuffer(self.sequence.encode("ascii"), dtype=np.uint8)
+
+        # gaps_through[base] is the number of gaps in sequence[:base+1]
+        self.gaps_through: list[int] = np.cumsum(encoded == GAP).tolist()
+        self.ungapped_columns: list[int] = np.flatnonzero(encoded != GAP).tolist()
+
+    def ungapped_position(self, base: int) -> int:
+        """ Returns the position of a base with the gaps removed """
+
+        return base - self.gaps_through[base]
+
+    def codon_position(self, base: int, *, codon_offset: int=0) -> int:
+        """ Returns 0 for the first base of a codon, 1 for the second, or 2 for the third """
+
+        return (self.ungapped_position(base) + codon_offset) % 3
+
+    def next_ungapped(self, base: int, count: int=2) -> str:
+        """ Returns up to count ungapped bases following a base """
+
+        following: int = base + 1 - self.gaps_through[base]
+
+        return "".join(self.sequence[column] for column in self.ungapped_columns[following:following+count])
+
+
+def mask_dtype(reference_count: int) -> type:
+    """ Returns the smallest unsigned integer type that holds one bit per reference """
+
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if reference_count <= np.iinfo(dtype).bits:
+            return dtype
+
+    raise ValueError(f"Can not match against more than {MAX_MATCH_REFERENCES} references, got {reference_count}")
+
+
+def full_mask(reference_count: int) -> int:
+    """ Returns the bitmask of a column that matches every reference """
+
+    return (1 << reference_count) - 1
+
+
+def popcount(masks: np.ndarray, reference_count: int) -> np.ndarray:
+    """ Returns the number of references matched for each bitmask """
+
+    counts: np.ndarray = np.zeros(masks.shape, dtype=np.uint8)
+
+    for reference_index in range(reference_count):
+        counts += ((masks >> reference_index) & 1).astype(np.uint8)
+
+    return counts
+
+
+def pack_intervals(intervals: list[Intervals]) -> dict[str: np.ndarray]:
+    """ Concatenate a list of Intervals into flat arrays, with offsets marking where each one starts """
+
+    offsets: np.ndarray = np.zeros(len(intervals)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(sequence_intervals) for sequence_intervals in intervals])
+
+    return {
+        "offsets": offsets,
+        "starts": np.concatenate([sequence_intervals.starts for sequence_intervals in intervals] or [np.zeros(0, dtype=np.int32)]),
+        "lengths": np.concatenate([sequence_intervals.lengths for sequence_intervals in intervals] or [np.zeros(0, dtype=np.int32)]),
+        "codes": np.concatenate([sequence_intervals.codes for sequence_intervals in intervals] or [np.zeros(0, dtype=np.uint16)]),
+    }
+
+
+def unpack_intervals(*, offsets: np.ndarray, starts: np.ndarray, lengths: np.ndarray, codes: np.ndarray) -> list[Intervals]:
+    """ Split the flat arrays from pack_intervals back into a list of Intervals """
+
+    bounds: list[int] = offsets.tolist()
+
+    return [Intervals(starts[first:last], lengths[first:last], codes[first:last]) for first, last in zip(bounds[:-1], bounds[1:])]
+
+
+def match_dict(intervals: Intervals, reference_count: int) -> dict[int: list]:
+    """ Convert match intervals into the dictionary returned by Highlighter.get_matches_from_str """
+
+    matches: dict[int: list] = {}
+
+    for start, length, mask in intervals:
+        references: list = [reference_index for reference_index in range(reference_count) if mask >> reference_index & 1] or ["Unique"]
+
+        for base in range(start, start+length):
+            matches[base] = list(references)
+
+    return matches
+
+
+def merge_runs(starts: np.ndarray, lengths: np.ndarray, values: np.ndarray=None) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """ Join runs that touch and have the same value
+    returns the starts, lengths and values of the joined runs, and the joined run each input run went into """
+
+    if values is None:
+        values = np.zeros(len(starts), dtype=np.uint8)
+
+    if not len(starts):
+        return starts, lengths, values, np.zeros(0, dtype=np.int64)
+
+    ends: np.ndarray = starts + lengths
+
+    first: np.ndarray = np.ones(len(starts), dtype=bool)
+    first[1:] = (starts[1:] != ends[:-1]) | (values[1:] != values[:-1])
+
+    last: np.ndarray = np.append(first[1:], True)
+
+    return starts[first], ends[last] - starts[first], values[first], np.cumsum(first) - 1
+
+
+def match_runs(intervals: Intervals, reference_count: int, *, unique: bool=True, multiple: bool=True, single: list[bool]=None) -> list[tuple[int, int, Union[int, str]]]:
+    """ Returns the (start, width, code) of each match mark for a row of match intervals, ordered by start
+    code is 'Unique', 'Multiple' or a reference index.  A single reference run carries on through
+    following columns that match several references including that one """
+
+    marks: list[tuple[int, int, Union[int, str]]] = []
+    counts: np.ndarray = popcount(intervals.codes, reference_count)
+
+    if unique:
+        starts, lengths, _, _ = merge_runs(intervals.starts[counts == 0], intervals.lengths[counts == 0])
+        marks += [(start, length, "Unique") for start, length in zip(starts.tolist(), lengths.tolist())]
+
+    if multiple:
+        starts, lengths, _, _ = merge_runs(intervals.starts[counts > 1], intervals.lengths[counts > 1])
+        marks += [(start, length, "Multiple") for start, length in zip(starts.tolist(), lengths.tolist())]
+
+    for reference_index in range(reference_count):
+        if single is not None and not single[reference_index]:
+            continue
+
+        has_reference: np.ndarray = ((intervals.codes >> reference_index) & 1).astype(bool)
+        starts, lengths, _, groups = merge_runs(intervals.starts[has_reference], intervals.lengths[has_reference])
+
+        # Each joined run is marked from its first single reference column to its end
+        is_single: np.ndarray = counts[has_reference] == 1
+        marked_groups, first_single = np.unique(groups[is_single], return_index=True)
+        single_starts: np.ndarray = intervals.starts[has_reference][is_single][first_single]
+        ends: np.ndarray = starts[marked_groups] + lengths[marked_groups]
+
+        marks += [(start, end - start, reference_index) for start, end in zip(single_starts.tolist(), ends.tolist())]
+
+    return sorted(marks, key=lambda mark: mark[0])
+
+
+def mismatch_names(code: int) -> list[str]:
+    """ Returns the list of mismatch types for a mismatch code, as used by Highlighter.get_mismatches_from_str """
+
+    names: list[str] = []
+    character: int = code & CHARACTER_MASK
+
+    if character:
+        names.append("Gap" if character == GAP else chr(character))
+
+    for flag, name in MISMATCH_FLAGS.items():
+        if code >> 8 & flag:
+            names.append(name)
+
+    return names
+
+
+def mismatch_code(names: list[str]) -> int:
+    """ Returns the mismatch code for a list of mismatch types """
+
+    code: int = 0
+
+    for name in names:
+        flags: list[int] = [flag for flag, flag_name in MISMATCH_FLAGS.items() if flag_name == name]
+
+        if flags:
+            code |= flags[0] << 8
+        else:
+            code |= GAP if name == "Gap" else ord(name)
+
+    return code
+
+
+def mismatch_dict(intervals: Intervals) -> dict[int: list]:
+    """ Convert mismatch intervals into the dictionary returned by Highlighter.get_mismatches_from_str """
+
+    mismatches: dict[int: list] = {}
+
+    for start, length, code in intervals:
+        names: list[str] = mismatch_names(code)
+
+        for base in range(start, start+length):
+            mismatches[base] = list(names)
+
+    return mismatches
+
+
+def mismatch_intervals(mismatches: dict[int: list], length: int) -> Intervals:
+    """ Convert a dictionary from Highlighter.get_mismatches_from_str into mismatch intervals """
+
+    row: np.ndarray = np.zeros(length, dtype=np.uint16)
+
+    for base, names in mismatches.items():
+        row[base] = mismatch_code(names)
+
+    return Intervals.encode(row)
+
+
+def sequence_string(sequence: Union[str, Seq, SeqRecord]) -> str:
+    """ Returns a sequence as a plain string with no line breaks """
+
+    if isinstance(sequence, SeqRecord):
+        sequence = str(sequence.seq)
+    elif isinstance(sequence, Seq):
+        sequence = str(sequence)
+    elif not isinstance(sequence, str):
+        raise TypeError(f"Expected sequence to be a string, Seq, or SeqRecord, got {type(sequence)}")
+
+    return sequence.replace("\n", "")
+
+
+def row_ranges(rows: int, processes: int) -> list[tuple[int, int]]:
+    """ Split rows into at most processes contiguous (start, stop) ranges of at least BLOCK_ROWS rows """
+
+    count: int = max(1, min(processes, -(-rows // BLOCK_ROWS)))
+
+    return [(rows * index // count, rows * (index+1) // count) for index in range(count)]
+
+
+_shared_memory: shared_memory.SharedMemory = None
+_shared_rows: np.ndarray = None
+
+
+def _attach_shared_rows(name: str, shape: tuple[int, int]) -> None:
+    """ Pool initializer that attaches a worker to the shared alignment rows """
+
+    global _shared_memory, _shared_rows
+
+    _shared_memory = shared_memory.SharedMemory(name=name)
+    _shared_rows = np.ndarray(shape, dtype=np.uint8, buffer=_shared_memory.buf)
+
+
+def _map_shared_rows(block_function: Callable, start: int, stop: int, options: dict) -> list:
+    """ Run a block function over a range of the shared alignment rows """
+
+    return _map_rows(_shared_rows, block_function, start, stop, options)
+
+
+def _map_rows(rows: np.ndarray, block_function: Callable, start: int, stop: int, options: dict) -> list:
+    """ Run a block function over rows[start:stop], BLOCK_ROWS at a time """
+
+    results: list = []
+
+    for block_start in range(start, stop, BLOCK_ROWS):
+        results += block_function(rows[block_start:min(block_start+BLOCK_ROWS, stop)], **options)
+
+    return results
+
+
+def match_mask_block(block: np.ndarray, references: list[np.ndarray]) -> np.ndarray:
+    """ Get match bitmasks for a block of encoded rows against encoded references """
+
+    dtype = mask_dtype(len(references))
+    block_masks: np.ndarray = np.zeros(block.shape, dtype=dtype)
+
+    for reference_index, reference in enumerate(references):
+        block_masks[(block == reference) | (reference == WILDCARD)] |= dtype(1 << reference_index)
+
+    return block_masks
+
+
+def match_block(block: np.ndarray, references: list[np.ndarray]) -> list[Intervals]:
+    """ Get match intervals for a block of encoded rows against encoded references """
+
+    background: int = full_mask(len(references))
+
+    return [Intervals.encode(row, background=background) for row in match_mask_block(block, references)]
+
+
+def mismatch_block(block: np.ndarray, *, reference: np.ndarray, seq_type: str, apobec: bool, g_to_a: bool, stop_codons: bool, glycosylation: bool, codon_offset: int) -> list[Intervals]:
+    """ Get mismatch intervals for a block of encoded rows against an encoded reference """
+
+    length: int = block.shape[1]
+
+    different: np.ndarray = block != reference
+    g_to_a_marks: np.ndarray = np.zeros(block.shape, dtype=bool)
+    apobec_marks: np.ndarray = np.zeros(block.shape, dtype=bool)
+    stop_codon_marks: np.ndarray = np.zeros(block.shape, dtype=bool)
+    glycosylation_marks: np.ndarray = np.zeros(block.shape, dtype=bool)
+
+    # APOBEC and G->A mutations only apply to NT sequences
+    if seq_type == "NT" and (g_to_a or apobec):
+        transitions: np.ndarray = different & (reference == ord("G")) & (block == ord("A"))
+
+        if g_to_a:
+            g_to_a_marks = transitions
+
+        if apobec and length >= 3:
+            apobec_marks[:, :length-2] = transitions[:, :length-2] & np.isin(block[:, 1:length-1], (ord("A"), ord("G"))) & (block[:, 2:] != ord("C"))
+
+    for row_index, row in enumerate(block):
+        if seq_type == "NT" and stop_codons:
+            stop_codon_marks[row_index] = stop_codon_row(row, codon_offset=codon_offset)
+
+        elif seq_type == "AA" and glycosylation:
+            glycosylation_marks[row_index] = glycosylation_row(row)
+
+    codes: np.ndarray = np.where(different, block, 0).astype(np.uint16)
+    codes[g_to_a_marks] |= G_TO_A_MUTATION << 8
+    codes[apobec_marks] |= APOBEC << 8
+    codes[stop_codon_marks] |= STOP_CODON << 8
+    codes[glycosylation_marks] |= GLYCOSYLATION << 8
+
+    return [Intervals.encode(row) for row in codes]
+
+
+def _ungapped(row: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ Returns the column indexes and values of the ungapped bases in an encoded row """
+
+    columns: np.ndarray = np.flatnonzero(row != GAP)
+
+    return columns, row[columns]
+
+
+def stop_codon_row(row: np.ndarray, *, codon_offset: int=0) -> np.ndarray:
+    """ Returns a boolean array marking the first base of each stop codon in an encoded row """
+
+    marks: np.ndarray = np.zeros(row.shape, dtype=bool)
+    columns, bases = _ungapped(row)
+
+    if len(bases) < 3:
+        return marks
+
+    # Codon starts need two more ungapped bases after them
+    rank: np.ndarray = np.arange(len(bases)-2)
+    first, second, third = bases[:-2], bases[1:-1], bases[2:]
+
+    stops: np.ndarray = np.isin(first, (ord("T"), ord("U"))) & ((rank + codon_offset) % 3 == 0) & (columns[:-2] <= len(row)-3)
+    stops &= ((second == ord("A")) & np.isin(third, (ord("A"), ord("G")))) | ((second == ord("G")) & (third == ord("A")))
+
+    marks[columns[:-2][stops]] = True
+
+    return marks
+
+
+def glycosylation_row(row: np.ndarray) -> np.ndarray:
+    """ Returns a boolean array marking the N of each N-X-S/T glycosylation site in an encoded row """
+
+    marks: np.ndarray = np.zeros(row.shape, dtype=bool)
+    columns, bases = _ungapped(row)
+
+    if len(bases) < 3:
+        return marks
+
+    sites: np.ndarray = (bases[:-2] == ord("N")) & (bases[1:-1] != ord("P")) & np.isin(bases[2:], (ord("S"), ord("T"))) & (columns[:-2] <= len(row)-3)
+    marks[columns[:-2][sites]] = True
+
+    return marks
@@ -0,0 +1,125 @@
+""" An on-disk index of the highlighter work for one FASTA file, so plots can be redrawn without comparing sequences again """
+
+import logging
+log = logging.getLogger('app')
+
+import hashlib, os, tempfile
+from typing import Union
+
+import numpy as np
+
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+from phylobook.projects.utils.highlighter_engine import AlignmentMatrix, Intervals, pack_intervals, unpack_intervals, sequence_string
+
+
+class HighlighterIndex:
+    """ The encoded alignment plus mismatch and match intervals for a FASTA file, stored as an .npz next to the tree files
+    the index is keyed by the FASTA's content hash, and everything in it is dropped when the hash changes """
+
+    def __init__(self, file_name: str, *, fasta_hash: str):
+        """ Load the index if it exists and was built from the same FASTA """
+
+        self.file_name: str = file_name
+        self.fasta_hash: str = fasta_hash
+
+        self.arrays: dict[str: np.ndarray] = {}
+        self.changed: bool = False
+
+        self._matrix: AlignmentMatrix = None
+
+        self._load()
+
+    def _load(self) -> None:
+        """ Read the stored arrays, ignoring an index built from a different FASTA """
+
+        if not os.path.exists(self.file_name):
+            return
+
+        try:
+            with np.load(self.file_name, allow_pickle=False) as stored:
+                arrays: dict[str: np.ndarray] = {key: stored[key] for key in stored.files}
+
+        except Exception as error:
+            log.warning(f"Could not read highlighter index {self.file_name}: {error}")
+            return
+
+        if str(arrays.pop("fasta_hash", "")) != self.fasta_hash:
+            log.debug(f"Highlighter index {self.file_name} is out of date")
+            return
+
+        self.arrays = arrays
+
+    def save(self) -> None:
+        """ Write the index if anything was added, replacing the old file in one step """
+
+        if not self.changed:
+            return
+
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(self.file_name), suffix=".npz", delete=False) as file:
+            np.savez(file, fasta_hash=np.array(self.fasta_hash), **self.arrays)
+
+        os.replace(file.name, self.file_name)
+        self.changed = False
+
+    def matrix(self, alignment) -> AlignmentMatrix:
+        """ Returns the encoded alignment, encoding and storing it if it isn't in the index yet """
+
+        if self._matrix is not None:
+            return self._matrix
+
+        if "inverse" in self.arrays and len(self.arrays["inverse"]) == len(alignment):
+            self._matrix = AlignmentMatrix.from_arrays(distinct=self.arrays["distinct"], inverse=self.arrays["inverse"], ids=self.arrays["ids"].tolist())
+
+        else:
+            self._matrix = AlignmentMatrix(alignment)
+            self._store(distinct=self._matrix.distinct, inverse=self._matrix.inverse, ids=np.array(self._matrix.ids, dtype=str))
+
+        return self._matrix
+
+    def mismatch_intervals(self, matrix: AlignmentMatrix, *, processes: int=1, **options) -> list[Intervals]:
+        """ Returns AlignmentMatrix.mismatch_intervals, from the index when these options have been run before """
+
+        key: str = f"mismatches_{digest(repr(sorted(options.items())))}"
+
+        if f"{key}.offsets" not in self.arrays:
+            self._store_intervals(key, matrix.distinct_mismatch_intervals(processes=processes, **options))
+
+        return matrix.expand(self._stored_intervals(key))
+
+    def match_intervals(self, matrix: AlignmentMatrix, references: list[Union[str, Seq, SeqRecord]], *, processes: int=1) -> list[Intervals]:
+        """ Returns AlignmentMatrix.match_intervals, from the index when the references haven't changed
+        only the latest set of references is kept, since they change whenever lineages are reassigned """
+
+        key: str = f"matches_{digest(chr(10).join(sequence_string(reference) for reference in references))}"
+
+        if f"{key}.offsets" not in self.arrays:
+            for stored_key in [stored_key for stored_key in self.arrays if stored_key.startswith("matches_")]:
+                del self.arrays[stored_key]
+
+            self._store_intervals(key, matrix.distinct_match_intervals(references, processes=processes))
+
+        return matrix.expand(self._stored_intervals(key))
+
+    def _store(self, **arrays) -> None:
+        """ Add arrays to the index """
+
+        self.arrays.update(arrays)
+        self.changed = True
+
+    def _store_intervals(self, key: str, intervals: list[Intervals]) -> None:
+        """ Add a list of Intervals to the index under a key """
+
+        self._store(**{f"{key}.{name}": array for name, array in pack_intervals(intervals).items()})
+
+    def _stored_intervals(self, key: str) -> list[Intervals]:
+        """ Returns the list of Intervals stored under a key """
+
+        return unpack_intervals(**{name: self.arrays[f"{key}.{name}"] for name in ("offsets", "starts", "lengths", "codes")})
+
+
+def digest(text: str) -> str:
+    """ Returns a short digest of some text for use in index keys """
+
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
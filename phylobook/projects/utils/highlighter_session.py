@@ -0,0 +1,214 @@
+""" Draw every highlighter plot a tree needs from one load of its alignment, tree and lineage consensus """
+
+import logging
+log = logging.getLogger('app')
+
+import os
+from functools import cached_property
+
+from django.conf import settings as django_settings
+
+from Bio import AlignIO, Phylo
+from Bio.Seq import Seq
+
+from phylobook.projects.utils.cache import highlighter_cache, highlighter_tiles_cache
+from phylobook.projects.utils.highlighter import HighlighterPlot
+from phylobook.projects.utils.highlighter_index import HighlighterIndex
+from phylobook.projects.utils.highlighter_tiles import HighlighterTiles
+
+
+class HighlighterSession:
+    """ The shared inputs for a tree's highlighter plots, each loaded the first time a plot needs it
+    draw any mix of highlighter, match and no multiple match plots and mark widths, then save() once to store the highlighter index
+    sessions compare sequences in one process unless given more, which management commands can spare but web requests can't """
+
+    def __init__(self, tree: "Tree", *, processes: int=1):
+        """ Start a session for a tree, loading nothing yet """
+
+        self.tree = tree
+        self.processes: int = processes
+
+    @property
+    def ready(self) -> bool:
+        """ Returns True if the tree has the FASTA and tree files the plots are drawn from """
+
+        return bool(self.tree.tree_file_name and self.tree.fasta_file_name and os.path.exists(self.tree.tree_file_name) and os.path.exists(self.tree.fasta_file_name))
+
+    @cached_property
+    def alignment_and_tree(self) -> tuple:
+        """ Returns the original alignment and the Bio.Phylo tree, with sequence names shortened to match """
+
+        alignment = AlignIO.read(self.tree.original_fasta_file_name, "fasta")
+
+        tree_file_name: str = self.tree.tree_file_name
+        if "nexus" in tree_file_name:
+            tree = Phylo.read(tree_file_name, "nexus")
+        else:
+            tree = Phylo.read(tree_file_name, "newick")
+
+        try:
+            shortenizer = SequenceNameShortenizer(alignment)
+
+            for sequence in alignment:
+                sequence.id = shortenizer.shortenize(sequence.id)
+
+            for terminal in tree.get_terminals():
+                terminal.name = shortenizer.shortenize(terminal.name)
+        except:
+            pass
+
+        return alignment, tree
+
+    @cached_property
+    def index(self) -> HighlighterIndex:
+        """ Returns the tree's highlighter index """
+
+        return self.tree.highlighter_index()
+
+    @cached_property
+    def match_references(self) -> tuple[list[Seq], list[str]]:
+        """ Returns the lineage consensus sequences to match against, and their colors """
+
+        colors_by_short: dict[str: str] = {color["short"]: f"#{color['value']}" for color in django_settings.ANNOTATION_COLORS}
+        references: list[Seq] = []
+        colors: list[str] = []
+
+        for color, sequence in self.tree.get_lineage_consensus().items():
+            if color in colors_by_short:
+                colors.append(colors_by_short[color])
+                references.append(sequence)
+
+        return references, colors
+
+    def plot(self, **options) -> HighlighterPlot:
+        """ Returns a HighlighterPlot laid out for the project page """
+
+        alignment, tree = self.alignment_and_tree
+
+        return HighlighterPlot(alignment, tree=tree, top_margin=12, seq_gap=-0.185*2, seq_name_font_size=16, ruler_font_size=12, plot_width=6*72, bottom_margin=45, left_margin=0, right_margin=0, plot_label_gap=3, **options)
+
+    def draw_highlighter(self, *, width: int) -> bool:
+        """ Draw the mismatch highlighter SVG for a mark width """
+
+        try:
+            self.plot().draw_mismatches(self.tree.highlighter_file_name_svg(width=width), apobec=True, g_to_a=True, glycosylation=True, sort="tree", scheme="LANL", mark_width=width, processes=self.processes, index=self.index)
+        except Exception as error:
+            log.debug(f"Got exception while creating highlighter plot: {error}")
+            return False
+
+        log.debug(f"Highlighter cache after drawing {self.tree.name}: {highlighter_cache.stats()}")
+
+        return True
+
+    def draw_match(self, *, width: int, show_multiple: bool=True) -> bool:
+        """ Draw the match SVG for a mark width, with or without the multiple match color """
+
+        references, reference_colors = self.match_references
+
+        if not references:
+            return False
+
+        colors: dict = {
+            "references": reference_colors,
+            "unique": "#C4BD3B", #"#EFE645",
+            "multiple": "#BDBDBD" if show_multiple else None, #"#808080",
+        }
+
+        try:
+            self.plot().draw_matches(self.tree.match_file_name_svg(width=width, show_multiple=show_multiple), references=references, sort="tree", scheme=colors, mark_width=width, sequence_labels=False, processes=self.processes, index=self.index)
+        except Exception as error:
+            log.debug(f"Got exception while creating mutation plot: {error}")
+            return False
+
+        log.debug(f"Highlighter cache after drawing {self.tree.name} matches: {highlighter_cache.stats()}")
+
+        return True
+
+    def draw_png(self, *, file_name: str, width: int, scale: float=1) -> bool:
+        """ Draw the mismatch highlighter plot as a PNG without labels """
+
+        try:
+            self.plot().draw_mismatches(file_name, output_format="png", apobec=True, g_to_a=True, glycosylation=True, sort="tree", scheme="LANL", mark_width=width, scale=scale, sequence_labels=False, processes=self.processes, index=self.index)
+        except Exception as error:
+            log.debug(f"Got exception while drawing highlighter PNG: {error}")
+            return False
+
+        return True
+
+    def tiles(self, *, width: int, output_format: str="svg") -> HighlighterTiles:
+        """ Returns the tree's pyramid of highlighter tiles for a mark width
+        pyramids are kept in highlighter_tiles_cache until the FASTA, tree or tree SVG changes, so each tile request doesn't load and sort the alignment again """
+
+        directory: str = self.tree.highlighter_tiles_directory(width=width)
+        key: tuple = (directory, output_format, *((file_name, file_mtime(file_name)) for file_name in (self.tree.original_fasta_file_name, self.tree.tree_file_name, self.tree.svg_file_name)))
+
+        found, tiles = highlighter_tiles_cache.lookup(key)
+        if found:
+            return tiles
+
+        alignment, tree = self.alignment_and_tree
+        tiles = HighlighterTiles(alignment, directory, tree=tree, output_format=output_format, processes=self.processes, index=self.index)
+        highlighter_tiles_cache.store(key, tiles)
+
+        return tiles
+
+    def draw_tile(self, *, level: int, column: int, row: int, width: int, output_format: str="svg") -> bool:
+        """ Draw one highlighter tile as an SVG or PNG
+        returns False if the tile isn't in the tree's tile pyramid """
+
+        try:
+            tiles: HighlighterTiles = self.tiles(width=width, output_format=output_format)
+
+            if not tiles.has_tile(level, column, row):
+                return False
+
+            tiles.draw_tile(level, column, row, apobec=True, g_to_a=True, glycosylation=True, sort="tree", scheme="LANL", mark_width=width)
+        except Exception as error:
+            log.debug(f"Got exception while drawing highlighter tile: {error}")
+            return False
+
+        # A cached pyramid keeps the index of the session that made it
+        if tiles.index is not None:
+            tiles.index.save()
+
+        return True
+
+    def draw_all(self, *, highlighter_widths: list[int]=(), match_widths: list[int]=(), show_multiple: list[bool]=(True, False)) -> list[str]:
+        """ Draw the highlighter plots for every width, and the match plots for every width and show_multiple choice, then save the index
+        returns a description of each plot that couldn't be drawn """
+
+        failed: list[str] = []
+
+        if not self.ready:
+            return ["highlighter plots (missing FASTA or tree file)"]
+
+        for width in highlighter_widths:
+            if not self.draw_highlighter(width=width):
+                failed.append(f"highlighter {width}")
+
+        for width in match_widths:
+            for multiple in show_multiple:
+                if not self.draw_match(width=width, show_multiple=multiple):
+                    failed.append(f"match {width}{'' if multiple else ' no multiple'}")
+
+        self.save()
+
+        return failed
+
+    def save(self) -> None:
+        """ Store anything the plots added to the highlighter index """
+
+        if "index" in self.__dict__:
+            self.index.save()
+
+
+def file_mtime(file_name: str) -> int:
+    """ Returns the modification time of a file in nanoseconds, or None if there is no file """
+
+    try:
+        return os.stat(file_name).st_mtime_ns
+    except (FileNotFoundError, TypeError):
+        return None
+
+
+from phylobook.projects.utils import SequenceNameShortenizer
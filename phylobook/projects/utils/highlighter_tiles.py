@@ -0,0 +1,320 @@
+""" Highlighter plots drawn as a pyramid of fixed size tiles, so very large alignments can be viewed a piece at a time """
+
+import logging
+log = logging.getLogger('app')
+
+import math, os, threading
+from typing import Callable, Union
+
+from phylobook.projects.utils.cache import approximate_size
+from phylobook.projects.utils.highlighter import HighlighterPlot
+from phylobook.projects.utils.highlighter_canvas import SHAPE_REACH, Canvas, RasterCanvas, SvgPathCanvas
+from phylobook.projects.utils.highlighter_engine import Intervals
+from phylobook.projects.utils.highlighter_index import HighlighterIndex
+
+# Width and height of every tile, in pixels
+TILE_SIZE: int = 256
+
+# Tile formats, and the content type each is served as
+TILE_FORMATS: dict[str: str] = {"svg": "image/svg+xml", "png": "image/png"}
+
+# Roughly what a level plot kept for drawing single tiles holds per sequence: its place in the sort order and its mismatch intervals
+LEVEL_PLOT_BYTES_PER_SEQUENCE: int = 256
+
+
+class TileCanvas(Canvas):
+    """ Splits a plot into square tiles, and writes each tile as its own SVG or PNG file named {column}_{row}
+    rows are counted from the top, and shapes that cross a tile edge are drawn in every tile they touch
+    marks must be drawn from the top of the plot down, as HighlighterPlot does, so finished rows of tiles can be written and dropped
+    pass tile=(column, row) to keep and write only that tile """
+
+    def __init__(self, directory: str, *, width: float, height: float, output_format: str="svg", tile_size: int=TILE_SIZE, tile: tuple[int, int]=None):
+        """ Set up an empty set of tiles covering the plot """
+
+        self.directory: str = directory
+        self.output_format: str = output_format.lower()
+        self.tile_size: int = tile_size
+
+        self.width: float = width
+        self.height: float = height
+        self.columns: int = max(1, math.ceil(width / tile_size))
+        self.rows: int = max(1, math.ceil(height / tile_size))
+        self.tile: tuple[int, int] = tile
+
+        self._pending: dict[tuple: list] = {}
+        self._written_rows: int = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def tile_file_name(self, column: int, row: int) -> str:
+        """ Returns the file name of a tile """
+
+        return os.path.join(self.directory, f"{column}_{row}.{self.output_format}")
+
+    def rect(self, x: float, y: float, width: float, height: float, **paint) -> None:
+        """ Add a rectangle to the tiles it covers """
+
+        self._add((min(x, x+width), min(y, y+height), max(x, x+width), max(y, y+height)), paint, lambda canvas, dx, dy: canvas.rect(x-dx, y-dy, width, height, **paint))
+
+    def mark(self, x: float, y: float, width: float, height: float, **paint) -> None:
+        """ Add a mark to the tiles it covers, first writing out the rows of tiles that nothing below it can reach """
+
+        self._write_rows(self._row(max(y, y+height) + SHAPE_REACH))
+        self._add((min(x, x+width), min(y, y+height), max(x, x+width), max(y, y+height)), paint, lambda canvas, dx, dy: canvas.mark(x-dx, y-dy, width, height, **paint))
+
+    def line(self, x1: float, y1: float, x2: float, y2: float, **paint) -> None:
+        """ Add a line to the tiles it covers """
+
+        self._add((min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)), paint, lambda canvas, dx, dy: canvas.line(x1-dx, y1-dy, x2-dx, y2-dy, **paint))
+
+    def polygon(self, points: list[float], **paint) -> None:
+        """ Add a polygon to the tiles it covers """
+
+        xs: list[float] = points[::2]
+        ys: list[float] = points[1::2]
+
+        self._add((min(xs), min(ys), max(xs), max(ys)), paint, lambda canvas, dx, dy: canvas.polygon([value - (dy if index % 2 else dx) for index, value in enumerate(points)], **paint))
+
+    def circle(self, x: float, y: float, radius: float, **paint) -> None:
+        """ Add a circle to the tiles it covers """
+
+        self._add((x-radius, y-radius, x+radius, y+radius), paint, lambda canvas, dx, dy: canvas.circle(x-dx, y-dy, radius, **paint))
+
+    def glyph(self, shape: str, x: float, y: float, *, radius: float, **paint) -> None:
+        """ Add a glyph to the tiles it covers """
+
+        self._add((x-radius, y-radius, x+radius, y+radius), paint, lambda canvas, dx, dy: canvas.glyph(shape, x-dx, y-dy, radius=radius, **paint))
+
+    def string(self, x: float, y: float, text: str, *, font: str, font_size: float, anchor: str="start") -> None:
+        """ Tiles have no room for labels, so text is left out """
+
+        pass
+
+    def save(self) -> list[str]:
+        """ Write every remaining tile, including empty ones
+        returns the tile file names """
+
+        self._write_rows(self.rows)
+
+        if self.tile:
+            return [self.tile_file_name(*self.tile)]
+
+        return [self.tile_file_name(column, row) for row in range(self.rows) for column in range(self.columns)]
+
+    def discard(self) -> None:
+        """ Drop the tiles that haven't been written """
+
+        self._pending.clear()
+
+    def _add(self, bounds: tuple[float], paint: dict, draw: Callable) -> None:
+        """ Queue a shape for every tile its bounds (widened by its stroke) touch """
+
+        stroke_width: float = paint.get("stroke_width", 1) / 2 if paint.get("stroke") is not None else 0
+        left, bottom, right, top = bounds[0] - stroke_width, bounds[1] - stroke_width, bounds[2] + stroke_width, bounds[3] + stroke_width
+
+        first_row, last_row = self._row(top), self._row(bottom)
+
+        if first_row < self._written_rows:
+            raise ValueError("TileCanvas marks must be drawn from the top of the plot down")
+
+        for row in range(first_row, last_row+1):
+            for column in range(self._column(left), self._column(right)+1):
+                if self._wanted(column, row):
+                    self._pending.setdefault((column, row), []).append(draw)
+
+    def _row(self, y: float) -> int:
+        """ Returns the row of tiles (from the top) containing a y coordinate, clamped to the plot """
+
+        return min(self.rows-1, max(0, int((self.height - y) // self.tile_size)))
+
+    def _column(self, x: float) -> int:
+        """ Returns the column of tiles containing an x coordinate, clamped to the plot """
+
+        return min(self.columns-1, max(0, int(x // self.tile_size)))
+
+    def _wanted(self, column: int, row: int) -> bool:
+        """ Returns True if a tile is being drawn """
+
+        return self.tile is None or self.tile == (column, row)
+
+    def _write_rows(self, rows: int) -> None:
+        """ Write every row of tiles before the given row that hasn't been written yet """
+
+        for row in range(self._written_rows, rows):
+            for column in range(self.columns):
+                if self._wanted(column, row):
+                    self._write_tile(column, row)
+
+        self._written_rows = max(self._written_rows, rows)
+
+    def _write_tile(self, column: int, row: int) -> None:
+        """ Draw the queued shapes for one tile into its own canvas and save it """
+
+        if self.output_format == "svg":
+            canvas: Canvas = SvgPathCanvas(self.tile_file_name(column, row), width=self.tile_size, height=self.tile_size)
+        else:
+            canvas: Canvas = RasterCanvas(self.tile_file_name(column, row), width=self.tile_size, height=self.tile_size, output_format=self.output_format)
+
+        dx: float = column * self.tile_size
+        dy: float = self.height - (row+1) * self.tile_size
+
+        with canvas:
+            for draw in self._pending.pop((column, row), []):
+                draw(canvas, dx, dy)
+
+            canvas.save()
+
+
+class HighlighterTilePlot(HighlighterPlot):
+    """ A HighlighterPlot with no margins, labels or ruler, drawn onto a TileCanvas
+    pass tile=(column, row) to draw only that tile, skipping the marks of sequences that can't reach it """
+
+    def __init__(self, alignment, *, width: float, height: float, tile_size: int=TILE_SIZE, tile: tuple[int, int]=None, **options):
+        """ Size the plot so the sequences fill width x height """
+
+        super().__init__(alignment, plot_width=width, seq_name_font_size=height / len(alignment), seq_gap=0, left_margin=0, top_margin=0, bottom_margin=0, right_margin=0, plot_label_gap=0, ruler=False, **options)
+
+        self.tile_size: int = tile_size
+        self.tile: tuple[int, int] = tile
+
+    def _make_canvas(self, output_file, *, output_format: str, backend: str=None) -> Canvas:
+        """ Returns a TileCanvas writing tiles into the output_file directory """
+
+        return TileCanvas(output_file, width=self._width, height=self._height, output_format=output_format, tile_size=self.tile_size, tile=self.tile)
+
+    def _draw_marks_mismatch(self, plot_index: int, mismatches: Intervals, is_reference: bool=False) -> None:
+        """ Draw a sequence's mismatch marks if they can reach the tile """
+
+        if self._reaches_tile(plot_index):
+            super()._draw_marks_mismatch(plot_index, mismatches, is_reference=is_reference)
+
+    def _draw_marks_match(self, plot_index: int, matches: Intervals, is_reference: bool) -> None:
+        """ Draw a sequence's match marks if they can reach the tile """
+
+        if self._reaches_tile(plot_index):
+            super()._draw_marks_match(plot_index, matches, is_reference)
+
+    def _reaches_tile(self, plot_index: int) -> bool:
+        """ Returns True if the row of a sequence (widened by SHAPE_REACH) overlaps the tile being drawn, or every tile is being drawn """
+
+        if self.tile is None:
+            return True
+
+        top: float = (self._seq_count-plot_index) * (self._seq_height + self.seq_gap) + self.seq_gap + self._plot_floor
+        tile_top: float = self._height - self.tile[1] * self.tile_size
+
+        return top - (self._seq_height + self.seq_gap) - SHAPE_REACH <= tile_top and top + SHAPE_REACH >= tile_top - self.tile_size
+
+
+class HighlighterTiles:
+    """ A pyramid of highlighter tiles in a directory: level 0 is the whole plot in one tile,
+    and each level doubles the width and height, down to the level where every base and sequence is at least a pixel
+    tiles are in {directory}/{level}/{column}_{row}.{format}
+    the plot of each level is kept once a tile of it is drawn, so later tiles reuse its mismatches and sort order """
+
+    def __init__(self, alignment, directory: str, *, seq_type: str=None, tree: object=None, codon_offset: int=0, output_format: str="svg", tile_size: int=TILE_SIZE, processes: int=1, index: HighlighterIndex=None):
+        """ Set up the pyramid
+        pass an index so the sequences are compared once for every level """
+
+        self.alignment = alignment
+        self.directory: str = directory
+
+        self.seq_type: str = seq_type
+        self.tree = tree
+        self.codon_offset: int = codon_offset
+
+        self.output_format: str = output_format.lower()
+        self.tile_size: int = tile_size
+
+        self.processes: int = processes
+        self.index: HighlighterIndex = index
+
+        self._level_plots: dict[int: HighlighterTilePlot] = {}
+        self._lock = threading.Lock()
+
+    def __sizeof__(self) -> int:
+        """ Returns the approximate memory used by the alignment, the index and a plot for every level, so highlighter_tiles_cache can measure it """
+
+        sequences: int = len(self.alignment)
+        index_size: int = approximate_size(self.index.arrays) if self.index is not None else 0
+
+        return object.__sizeof__(self) + sequences * len(self.alignment[0]) + index_size + self.levels * sequences * LEVEL_PLOT_BYTES_PER_SEQUENCE
+
+    @property
+    def levels(self) -> int:
+        """ Returns the number of zoom levels in the pyramid """
+
+        largest: int = max(len(self.alignment), len(self.alignment[0]))
+
+        return max(0, math.ceil(math.log2(largest / self.tile_size))) + 1
+
+    def tiles_per_side(self, level: int) -> int:
+        """ Returns the number of tiles across (and down) a level """
+
+        return 2 ** level
+
+    def level_directory(self, level: int) -> str:
+        """ Returns the directory holding the tiles of a level """
+
+        return os.path.join(self.directory, str(level))
+
+    def tile_file_name(self, level: int, column: int, row: int) -> str:
+        """ Returns the file name of a tile """
+
+        return os.path.join(self.level_directory(level), f"{column}_{row}.{self.output_format}")
+
+    def has_tile(self, level: int, column: int, row: int) -> bool:
+        """ Returns True if the tile is in the pyramid """
+
+        return 0 <= level < self.levels and 0 <= column < self.tiles_per_side(level) and 0 <= row < self.tiles_per_side(level)
+
+    def draw_tile(self, level: int, column: int, row: int, **options) -> str:
+        """ Draw one mismatch tile, drawing only the sequences whose marks can reach it
+        options are passed to HighlighterPlot.draw_mismatches, and the level's plot is kept so the next tile skips finding and sorting the mismatches
+        returns the tile file name """
+
+        if not self.has_tile(level, column, row):
+            raise ValueError(f"Tile {column}, {row} is not in level {level} of {self.levels}")
+
+        # Cached tiles are shared by requests, and a level plot draws one tile at a time
+        with self._lock:
+            if level not in self._level_plots:
+                self._level_plots[level] = self._plot(level)
+
+            plot: HighlighterTilePlot = self._level_plots[level]
+            plot.tile = (column, row)
+
+            file_name: str = plot.draw_mismatches(self.level_directory(level), output_format=self.output_format, sequence_labels=False, processes=self.processes, index=self.index, **options)[0]
+
+        log.debug(f"Drew highlighter tile {file_name}")
+
+        return file_name
+
+    def draw_mismatches(self, *, levels: Union[int, list[int]]=None, **options) -> list[str]:
+        """ Draw the mismatch tiles for some levels (all of them by default)
+        options are passed to HighlighterPlot.draw_mismatches
+        returns the tile file names """
+
+        if levels is None:
+            levels = range(self.levels)
+        elif isinstance(levels, int):
+            levels = [levels]
+
+        file_names: list[str] = []
+
+        for level in levels:
+            if not 0 <= level < self.levels:
+                raise ValueError(f"Level {level} is not between 0 and {self.levels-1}")
+
+            file_names.extend(self._plot(level).draw_mismatches(self.level_directory(level), output_format=self.output_format, sequence_labels=False, processes=self.processes, index=self.index, **options))
+
+            log.debug(f"Drew highlighter tile level {level} in {self.level_directory(level)}")
+
+        return file_names
+
+    def _plot(self, level: int, *, tile: tuple[int, int]=None) -> HighlighterTilePlot:
+        """ Returns the plot for a level, drawing every tile or just one """
+
+        side: int = self.tiles_per_side(level) * self.tile_size
+
+        return HighlighterTilePlot(self.alignment, width=side, height=side, tile_size=self.tile_size, tile=tile, seq_type=self.seq_type, tree=self.tree, codon_offset=self.codon_offset)
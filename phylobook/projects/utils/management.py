@@ -67,14 +67,10 @@ def merge_projects(*, project1: Project, project2: Project, new_project_name: st
         GroupObjectPermission.objects.create(group_id=permission["group_id"], permission_id=permission["permission_id"], content_object=new_project)
 
     for tree in trees1:
-        tree.project=new_project
-        tree.id=None
-        tree.save()
+        tree.copy_to(new_project)
 
     for tree in trees2:
-        tree.project=new_project
-        tree.id=None
-        tree.save()
+        tree.copy_to(new_project)
 
     project1.copy_files(name=new_project.name, overwrite=True)
     project2.copy_files(name=new_project.name, overwrite=True)
@@ -0,0 +1,94 @@
+""" An index of the files in a project directory, listed in one scan and kept until the directory changes """
+
+import os, time
+
+from phylobook.projects.utils.cache import approximate_size, project_manifests_cache
+
+# The roles a project file can play, by the ending of its name
+ROLES: dict[str: str] = {
+    "svg": ".svg",
+    "fasta": ".fasta",
+    "nexus": "nexus.tre",
+    "newick": "newick.tre",
+    "dist": "pwcoldist.txt",
+    "text": ".txt",
+}
+
+# Seconds a manifest is trusted for, even when the directory's modification time hasn't changed
+# (network file systems cache directory attributes, so a new file may not show up in the mtime straight away)
+MAX_AGE: float = 30
+
+
+class ProjectManifest:
+    """ The entries of a directory from one os.scandir, grouped by role in directory order
+    a directory that doesn't exist has an empty manifest """
+
+    def __init__(self, path: str):
+        """ Scan the directory """
+
+        self.path: str = path
+        self.mtime: int = directory_mtime(path)
+        self.scanned: float = time.monotonic()
+
+        self.names: list[str] = []
+        self.directories: list[str] = []
+        self.roles: dict[str: list[str]] = {role: [] for role in ROLES}
+
+        if self.mtime is None:
+            return
+
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+
+                self.names.append(entry.name)
+
+                if entry.is_dir():
+                    self.directories.append(entry.name)
+
+                for role, ending in ROLES.items():
+                    if entry.name.endswith(ending):
+                        self.roles[role].append(entry.name)
+
+    def files(self, role: str, *, starts_with: str) -> list[str]:
+        """ Returns the paths of the entries with a role whose names start with starts_with, as glob(f"{starts_with}*{ending}") would """
+
+        ending: str = ROLES[role]
+
+        return [os.path.join(self.path, name) for name in self.roles[role] if name.startswith(starts_with) and len(name) >= len(starts_with) + len(ending)]
+
+    def first(self, role: str, *, starts_with: str) -> str:
+        """ Returns the path of the first entry with a role whose name starts with starts_with, or None """
+
+        files: list[str] = self.files(role, starts_with=starts_with)
+
+        return files[0] if files else None
+
+    def __sizeof__(self) -> int:
+        """ Returns the approximate memory used by the manifest and its lists of names, so project_manifests_cache can measure it """
+
+        return object.__sizeof__(self) + approximate_size(self.names) + approximate_size(self.directories) + approximate_size(self.roles)
+
+
+def directory_mtime(path: str) -> int:
+    """ Returns the modification time of a directory in nanoseconds, or None if it doesn't exist """
+
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def project_manifest(path: str) -> ProjectManifest:
+    """ Returns the manifest of a directory, scanning it again when its modification time has changed or it is older than MAX_AGE """
+
+    found, manifest = project_manifests_cache.lookup(path)
+
+    if found and manifest.mtime == directory_mtime(path) and time.monotonic() - manifest.scanned < MAX_AGE:
+        return manifest
+
+    manifest = ProjectManifest(path)
+    project_manifests_cache.store(path, manifest)
+
+    return manifest
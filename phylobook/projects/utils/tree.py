@@ -1,16 +1,125 @@
 import logging
 log = logging.getLogger('app')
 
-import re
+import os, re, shutil, sys
 import xml.etree.ElementTree as ET
 
 from multiprocessing import Pool, cpu_count
-from typing import Union
+from typing import Union, ValuesView
+from xml.sax.saxutils import escape
 
 from django.conf import settings
 
 from phylobook.projects.models import Tree, Project
-from phylobook.projects.utils.general import color_hex_to_rgb_string, color_by_short
+from phylobook.projects.utils.general import color_hex_to_rgb_string
+
+STROKE_PATTERN = re.compile(r"stroke: (.*?);")
+
+# The prefixes ElementTree gives well known namespaces, with SVG as the default namespace
+NAMESPACE_PREFIXES: dict[str: str] = {
+    "http://www.w3.org/2000/svg": "",
+    "http://www.w3.org/XML/1998/namespace": "xml",
+    "http://www.w3.org/1999/xhtml": "html",
+    "http://www.w3.org/1999/02/22-rdf-syntax-ns#": "rdf",
+    "http://schemas.xmlsoap.org/wsdl/": "wsdl",
+    "http://www.w3.org/2001/XMLSchema": "xs",
+    "http://www.w3.org/2001/XMLSchema-instance": "xsi",
+    "http://purl.org/dc/elements/1.1/": "dc",
+}
+
+# Attribute value escapes beyond &, < and >, matching ElementTree.write
+ATTRIBUTE_ENTITIES: dict[str: str] = {'"': "&quot;", "\r": "&#13;", "\n": "&#10;", "\t": "&#09;"}
+
+
+class TreeFileChanged(Exception):
+    """ Raised when saving a tree whose file no longer has the labels and boxes it had when the tree was loaded """
+
+
+class TreeSequence(object):
+    """ A sequence in a Phylobook tree: its label and box elements, lineage color, timepoint and multiplicity
+    fields can also be read and set like a dict, as sequence["color"], and a field that isn't set is not in the sequence """
+
+    __slots__ = ("name", "text", "box", "color", "timepoint", "multiplicity")
+
+    def __init__(self, name: str):
+        """ Set up an empty sequence """
+
+        self.name: str = name
+        self.text: ET.Element = None
+        self.box: ET.Element = None
+        self.color: str = None
+        self.timepoint: str = None
+        self.multiplicity: int = 1
+
+    def __getitem__(self, key: str):
+        """ Returns a field """
+
+        if key not in self.__slots__:
+            raise KeyError(key)
+
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value) -> None:
+        """ Sets a field """
+
+        if key not in self.__slots__:
+            raise KeyError(key)
+
+        setattr(self, key, value)
+
+    def __contains__(self, key: str) -> bool:
+        """ Returns True if a field is set """
+
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def get(self, key: str, default=None):
+        """ Returns a field, or default if it isn't set """
+
+        return self[key] if key in self else default
+
+
+def _is_label(element: ET.Element) -> bool:
+    """ Returns True if an element is a sequence label (a text element with a box class) """
+
+    return element.tag == "{http://www.w3.org/2000/svg}text" and element.attrib.get("class", "").startswith("box")
+
+
+def _is_box(element: ET.Element) -> bool:
+    """ Returns True if an element is a sequence box (a path element with an id) """
+
+    return element.tag == "{http://www.w3.org/2000/svg}path" and bool(element.attrib.get("id"))
+
+
+def _qualified_names(names) -> tuple[dict[str: str], dict[str: str]]:
+    """ Returns the prefixed name for each tag and attribute name, and the namespace declarations they need, as ElementTree.write does
+    namespaces without a known prefix are numbered ns0, ns1, ... in the order they are first used """
+
+    qnames: dict[str: str] = {}
+    namespaces: dict[str: str] = {}
+
+    for name in names:
+        if not name.startswith("{"):
+            qnames[name] = name
+            continue
+
+        uri, local = name[1:].rsplit("}", 1)
+        prefix: str = namespaces.get(uri)
+
+        if prefix is None:
+            prefix = NAMESPACE_PREFIXES.get(uri, f"ns{len(namespaces)}")
+
+            if prefix != "xml":
+                namespaces[uri] = prefix
+
+        qnames[name] = f"{prefix}:{local}" if prefix else local
+
+    return qnames, namespaces
+
+
+def _copy_counts(counts: dict) -> dict:
+    """ Returns a copy of the counts of a lineage, without anything else that has been added to them """
+
+    return {key: dict(value) if isinstance(value, dict) else value for key, value in counts.items() if key in ("count", "total", "timepoints")}
 
 
 class PhyloTree(object):
@@ -21,12 +130,17 @@ class PhyloTree(object):
 
         self.file_name = file_name
 
-        self.sequences: dict[str: dict[str: ET.Element]] = {}
+        self.sequences: dict[str: TreeSequence] = {}
+        self._by_color: dict[str: set[str]] = {}
+        self._colors: dict[str: dict] = {color["short"]: color for color in settings.ANNOTATION_COLORS}
         self.unassigned_sequences: int = 0
         self.lineage_counts: dict[str: dict] = {}
         self.timepoints: list[int] = []
-        self.svg = None
-        self.root: ET.Element = None
+
+        self._loaded_file_name: str = None
+        self._texts: list[ET.Element] = []
+        self._boxes: list[ET.Element] = []
+        self._names: dict[str: None] = {}
 
         self.load()
 
@@ -34,25 +148,133 @@ class PhyloTree(object):
         self._prep_tree_lineage_counts()
 
     def load(self, *, file_name: str = None):
-        """ Load a new tree """
+        """ Load a new tree in one streaming pass, keeping only the sequence label and box elements
+        everything else is cleared as it is parsed, and streamed from the file again when the tree is saved """
 
         if file_name:
             self.file_name = file_name
 
-        self.svg = ET.parse(self.file_name)
-        self.root = self.svg.getroot()
+        self._loaded_file_name = self.file_name
+        self._texts = []
+        self._boxes = []
+        self._names = {}
+        self.unassigned_sequences = 0
+
+        for event, element in ET.iterparse(self.file_name, events=("start", "end")):
+            if event == "start":
+                # Tag and attribute names in document order, which decide the namespace prefixes when saving
+                for name in (element.tag, *element.attrib):
+                    self._names.setdefault(name)
+
+                continue
+
+            if _is_label(element):
+                self._texts.append(element)
+                continue
+
+            elif element.tag == "{http://www.w3.org/2000/svg}text" and element.attrib.get("x") == "0":
+                self.unassigned_sequences += 1
+
+            elif _is_box(element):
+                self._boxes.append(element)
+                continue
+
+            element.clear()
 
     def save(self, *, file_name: str = None):
-        """ Save the tree """
+        """ Save the tree in one streaming pass over the loaded file, writing the kept label and box elements in place of the file's own
+        the output is the same as ElementTree.write of the whole document, and replaces the file only once it is complete
+        raises TreeFileChanged (leaving the file alone) if the loaded file's labels or boxes have changed since it was loaded """
 
         if file_name:
             self.file_name = file_name
 
-        ET.register_namespace("", "http://www.w3.org/2000/svg")
-        self.svg.write(self.file_name)
-        # remove_string_from_file(file_name=self.file_name, string="ns0:")
+        qnames, namespaces = _qualified_names(self._names)
+
+        texts = iter(self._texts)
+        boxes = iter(self._boxes)
+        partial_file_name: str = f"{self.file_name}.partial"
+
+        try:
+            with open(partial_file_name, "w", encoding="us-ascii", errors="xmlcharrefreplace") as svg_file:
+                write = svg_file.write
+                open_elements: list[list] = []
+                closed: ET.Element = None
+
+                for event, element in ET.iterparse(self._loaded_file_name, events=("start", "end")):
+                    if event == "start":
+                        if open_elements:
+                            parent: list = open_elements[-1]
+
+                            if not parent[1]:
+                                write(">" + escape(parent[0].text or ""))
+                                parent[1] = True
+
+                            elif closed is not None:
+                                write(escape(closed.tail or ""))
+                                closed.clear()
+
+                        kept: ET.Element = element
+
+                        if _is_label(element):
+                            kept = next(texts, None)
+
+                        elif _is_box(element):
+                            kept = next(boxes, None)
+
+                            if kept is None or kept.attrib["id"] != element.attrib["id"]:
+                                raise TreeFileChanged(f"Tree file {self._loaded_file_name} changed since it was loaded")
+
+                        if kept is None:
+                            raise TreeFileChanged(f"Tree file {self._loaded_file_name} changed since it was loaded")
+
+                        write("<" + qnames[element.tag])
+
+                        if not open_elements:
+                            for uri, prefix in sorted(namespaces.items(), key=lambda namespace: namespace[1]):
+                                write(f' xmlns{":" + prefix if prefix else ""}="{escape(uri, ATTRIBUTE_ENTITIES)}"')
+
+                        for key, value in kept.attrib.items():
+                            write(f' {qnames[key]}="{escape(value, ATTRIBUTE_ENTITIES)}"')
+
+                        open_elements.append([element, False, kept])
+                        closed = None
+
+                    else:
+                        _, has_children, kept = open_elements.pop()
+
+                        if kept is not element and kept.text != element.text:
+                            raise TreeFileChanged(f"Tree file {self._loaded_file_name} changed since it was loaded")
+
+                        if has_children:
+                            if closed is not None:
+                                write(escape(closed.tail or ""))
+                                closed.clear()
+
+                            write(f"</{qnames[element.tag]}>")
+
+                        elif element.text:
+                            write(f">{escape(element.text)}</{qnames[element.tag]}>")
+
+                        else:
+                            write(" />")
+
+                        # Cleared once its tail has been written, which the parser may not have read yet
+                        closed = element
+
+            if next(texts, None) is not None or next(boxes, None) is not None:
+                raise TreeFileChanged(f"Tree file {self._loaded_file_name} changed since it was loaded")
+
+            if os.path.exists(self.file_name):
+                shutil.copymode(self.file_name, partial_file_name)
+
+            os.replace(partial_file_name, self.file_name)
+
+        finally:
+            if os.path.exists(partial_file_name):
+                os.remove(partial_file_name)
     
-    def change_lineage(self, *, sequence: Union[str, dict]=None, color: str=None) -> None:
+    def change_lineage(self, *, sequence: Union[str, TreeSequence]=None, color: str=None) -> None:
         """ Change the lineage of a sequence """
 
         if isinstance(sequence, str):
@@ -60,40 +282,41 @@ class PhyloTree(object):
                 raise ValueError(f"Sequence {sequence} not found in tree")
             else:
                 sequence_object = self.sequences[sequence]
-        elif type(sequence) is dict:
+        elif isinstance(sequence, TreeSequence):
             sequence_object = sequence
         else:
-            raise ValueError(f"Sequence must be a string or a dictionary, not {type(sequence)}")
+            raise ValueError(f"Sequence must be a string or a TreeSequence, not {type(sequence)}")
 
-        color_object = color_by_short(color=color)
+        color_object = self._color_by_short(color)
 
-        sequence_object["text"].attrib["class"] = f"box{color_object['short']}"
-        self._set_color_in_box(sequence=sequence_object["name"], hex_value=color_object["value"])
-        sequence_object["color"] = color_object["short"]
+        self._by_color.get(sequence_object.color, set()).discard(sequence_object.name)
+        self._count_sequence(sequence_object, -1)
 
-    def swap_lineages(self, color1: str, color2: str) -> None:
-        """ Swap two lineages """
+        self._by_color.setdefault(color_object["short"], set()).add(sequence_object.name)
+        self._recolor(sequence_object, color_object)
+        self._count_sequence(sequence_object, 1)
 
-        color1_object = color_by_short(color1)
-        color2_object = color_by_short(color2)
+    def swap_lineages(self, color1: str, color2: str) -> None:
+        """ Swap two lineages, touching only the sequences in them """
 
-        for sequence in self.sequences.values():
-            if sequence["color"] == color1_object["short"]:
-                self.change_lineage(sequence=sequence, color=color2_object["short"])
-            elif sequence["color"] == color2_object["short"]:
-                self.change_lineage(sequence=sequence, color=color1_object["short"])
+        color1_object = self._color_by_short(color1)
+        color2_object = self._color_by_short(color2)
 
-        self._prep_tree_lineage_counts()
+        self._relabel({color1_object["short"]: color2_object["short"], color2_object["short"]: color1_object["short"]})
 
     def swap_by_counts(self) -> Union[None, str]:
-        """ Swap lineages that have lower counts than lineages later in the list """
+        """ Swap lineages that have lower counts than lineages later in the list
+        the swaps are worked out on the lineage counts alone, then the sequences are relabeled once """
 
+        counts: dict[str: tuple] = {color: self._count_vector(color) for color in self._colors}
+        holders: dict[str: str] = {color: color for color in self._colors}
         safety = 0
         colors: list = []
 
-        while swap := self.need_swaps():
-            self.swap_lineages(swap[0], swap[1])
-            
+        while swap := self._needed_swap(counts):
+            counts[swap[0]], counts[swap[1]] = counts[swap[1]], counts[swap[0]]
+            holders[swap[0]], holders[swap[1]] = holders[swap[1]], holders[swap[0]]
+
             if swap[0] not in colors:
                 colors.append(swap[0])
             
@@ -102,111 +325,158 @@ class PhyloTree(object):
 
             safety += 1
             if safety > 100:
+                self._relabel({holders[color]: color for color in colors})
                 return "Safety limit reached"
-            
+
         if colors:
-            return ', '.join([color_by_short(color)['name'] for color in colors])
+            # Every swapped lineage is relabeled, even one swapped back to its own color, as the swaps one at a time did
+            self._relabel({holders[color]: color for color in colors})
+
+            return ', '.join([self._colors[color]['name'] for color in colors])
         
         return None
 
+    def _count_vector(self, color: str) -> tuple[int]:
+        """ Returns the counts of a lineage at each timepoint, or its total count if the tree has no timepoints """
+
+        counts: dict = self.lineage_counts.get(color, {})
+
+        if self.timepoints:
+            return tuple(counts.get("timepoints", {}).get(timepoint, 0) for timepoint in self.timepoints)
+
+        return (counts.get("count", 0),)
+
     def _prep_sequences(self) -> None:
-        """ Set up the self.elements dictionary """
+        """ Set up the self.sequences dictionary from the kept label and box elements """
 
         rgb_lookup: dict[str, str] = {color_hex_to_rgb_string(hex_value=color["value"]): color["short"] for color in settings.ANNOTATION_COLORS}
         rgb_lookup = rgb_lookup | {key.replace(",", ", "): value for key, value in rgb_lookup.items()}
         
+        self.sequences = {}
+
+        for text_element in self._texts:
+            if text_element.text not in self.sequences:
+                self.sequences[text_element.text] = TreeSequence(text_element.text)
+            self.sequences[text_element.text].text = text_element
+            self.sequences[text_element.text].color = sys.intern(text_element.attrib["class"].replace("box", ""))
+
+        for path_element in self._boxes:
+            if path_element.attrib["id"] not in self.sequences:
+                self.sequences[path_element.attrib["id"]] = TreeSequence(path_element.attrib["id"])
+            self.sequences[path_element.attrib["id"]].box = path_element 
+
+            temp_color = STROKE_PATTERN.search(path_element.attrib["style"]).group(1)
+            if temp_color:
+                if temp_color in rgb_lookup:
+                    self.sequences[path_element.attrib["id"]].color = rgb_lookup[temp_color]
+                else:
+                    self.sequences[path_element.attrib["id"]].color = sys.intern(temp_color)
 
-        for text_element in self.root.iter("{http://www.w3.org/2000/svg}text"):
-            if text_element.attrib.get("class") and text_element.attrib["class"].startswith("box"):
-                if text_element.text not in self.sequences:
-                    self.sequences[text_element.text] = {}
-                self.sequences[text_element.text]["text"] = text_element
-                self.sequences[text_element.text]["color"] = text_element.attrib["class"].replace("box", "")
-                self.sequences[text_element.text]["name"] = text_element.text
+        self._by_color = {}
 
-            elif text_element.attrib.get("x") == "0":
-                self.unassigned_sequences += 1
+        for name, sequence in self.sequences.items():
+            parsed: dict = parse_sequence_name(name)
+            sequence.timepoint = parsed["timepoint"]
+            sequence.multiplicity = parsed["multiplicity"]
 
-        for path_element in self.root.iter("{http://www.w3.org/2000/svg}path"):
-            if path_element.attrib.get("id"):
-                if path_element.attrib["id"] not in self.sequences:
-                    self.sequences[path_element.attrib["id"]] = {}
-                self.sequences[path_element.attrib["id"]]["box"] = path_element 
-
-                # if "rgb" not in path_element.attrib["style"]:
-                #     temp_color = re.search(r"stroke: (.*?);", path_element.attrib["style"]).group(1)
-                #     if temp_color:
-                #         self.sequences[path_element.attrib["id"]]["color"] = temp_color
-
-                temp_color = re.search(r"stroke: (.*?);", path_element.attrib["style"]).group(1)
-                if temp_color:
-                    if temp_color in rgb_lookup:
-                        self.sequences[path_element.attrib["id"]]["color"] = rgb_lookup[temp_color]
-                    else:
-                        self.sequences[path_element.attrib["id"]]["color"] = temp_color
+            self._by_color.setdefault(sequence.color, set()).add(name)
 
-    def _set_color_in_box(self, *, sequence: str, hex_value: str) -> str:
-        """ Replace the color in a d string """
+    def _color_by_short(self, color: str) -> dict[str: str]:
+        """ Returns the color dict for a given short color name """
 
-        element: ET.Element = self.sequences[sequence]["box"]
-        style = element.attrib["style"]
-        new_rgb = color_hex_to_rgb_string(hex_value=hex_value)
+        if color not in self._colors:
+            raise ValueError(f"Color {color} not found in settings.ANNOTATION_COLORS")
 
-        element.attrib["style"] = re.sub(r"stroke: (.*?);", f"stroke: {new_rgb};", style)
+        return self._colors[color]
 
-        # if "rgb" in str(element.attrib["style"]):
-        #     element.attrib["style"] = re.sub(r"rgb\((.*)\)", new_rgb, style)
-        # elif self.sequences[sequence]["color"] in element.attrib["style"]:
-        #     element.attrib["style"] = element.attrib["style"].replace(self.sequences[sequence]["color"], new_rgb)
-        # else:
-        #     raise RuntimeError(f"Could not find color {self.sequences[sequence]['color']} or color code in style '{style}' for sequence {sequence}")
-        
-    def _prep_tree_lineage_counts(self) -> dict[str: dict]:
-        """ Get the counts of each lineage in the tree 
-        Move this whole thing into the PhyloTree object """
+    def _recolor(self, sequence_object: TreeSequence, color_object: dict[str: str]) -> None:
+        """ Set the color of a sequence's label and box """
+
+        sequence_object.text.attrib["class"] = f"box{color_object['short']}"
+        self._set_color_in_box(sequence=sequence_object.name, hex_value=color_object["value"])
+        sequence_object.color = color_object["short"]
+
+    def _relabel(self, colors: dict[str: str]) -> None:
+        """ Move the sequences of each color in colors to the color it maps to, carrying their counts along
+        colors must map a group of colors onto itself, as a swap or reordering does """
+
+        moving: dict[str: list[str]] = {color: list(self._by_color.get(color, ())) for color in colors}
+
+        for color, new_color in colors.items():
+            color_object: dict[str: str] = self._color_by_short(new_color)
+
+            for name in moving[color]:
+                self._recolor(self.sequences[name], color_object)
 
-        sequence_list: list[dict[str: str]] = [{"name": sequence, "color": self.sequences[sequence]["color"]} for sequence in self.sequences.keys()]
-        sequences, timepoints = parse_sequences(sequence_list)
+        entries: dict = {color: self._by_color.pop(color) for color in colors if color in self._by_color}
 
-        self.timepoints = timepoints
+        for color, new_color in colors.items():
+            if color in entries:
+                self._by_color[new_color] = entries[color]
 
-        lineage_counts: dict[str: dict] = {
+        # New counts rather than the old ones edited in place, so counts read before the relabel stay as they were (as when the tree was counted again)
+        self.lineage_counts = {colors.get(color, color): _copy_counts(counts) for color, counts in self.lineage_counts.items()}
+
+    def _set_color_in_box(self, *, sequence: str, hex_value: str) -> str:
+        """ Replace the color in a d string """
+
+        element: ET.Element = self.sequences[sequence].box
+        element.attrib["style"] = STROKE_PATTERN.sub(f"stroke: {color_hex_to_rgb_string(hex_value=hex_value)};", element.attrib["style"])
+
+    def _prep_tree_lineage_counts(self) -> None:
+        """ Count each lineage in the tree from the timepoint and multiplicity parsed when the sequences were prepared
+        after this the counts are kept up to date as lineages change, rather than counted again """
+
+        self.timepoints = tuple(sorted({sequence.timepoint for sequence in self.sequences.values() if sequence.timepoint is not None}))
+
+        self.lineage_counts = {
             "total": {
                 "count": 0,
                 "timepoints": {},
             }
         }
 
-        for sequence in sequences:
-            if timepoints:
-                if sequence["color"] not in lineage_counts:
-                    lineage_counts[sequence["color"]] = {"timepoints": {timepoint: 0 for timepoint in timepoints}, "total": 0}
+        for sequence in self.sequences.values():
+            self._count_sequence(sequence, 1)
 
-                if sequence["timepoint"] not in lineage_counts[sequence["color"]]["timepoints"]:
-                    lineage_counts[sequence["color"]]["timepoints"][sequence["timepoint"]] = 0
+            self.lineage_counts["total"]["count"] += sequence.multiplicity
 
-                lineage_counts[sequence["color"]]["timepoints"][sequence["timepoint"]] += sequence["multiplicity"]
-                lineage_counts[sequence["color"]]["total"] += sequence["multiplicity"]
-                
-                lineage_counts["total"]["count"] += sequence["multiplicity"]
+            if self.timepoints:
+                self.lineage_counts["total"]["timepoints"][sequence.timepoint] = self.lineage_counts["total"]["timepoints"].get(sequence.timepoint, 0) + sequence.multiplicity
 
-                if sequence["timepoint"] not in lineage_counts["total"]["timepoints"]:
-                    lineage_counts["total"]["timepoints"][sequence["timepoint"]] = 0
-                    
-                lineage_counts["total"]["timepoints"][sequence["timepoint"]] += sequence["multiplicity"]
-            
+    def _count_sequence(self, sequence: TreeSequence, sign: int) -> None:
+        """ Add a sequence's multiplicity to the counts of its lineage, or take it away with a sign of -1
+        a lineage is dropped from the counts once it has no sequences left """
+
+        color: str = sequence.color
+
+        if color not in self.lineage_counts:
+            if self.timepoints:
+                self.lineage_counts[color] = {"timepoints": {timepoint: 0 for timepoint in self.timepoints}, "total": 0}
             else:
-                if sequence["color"] not in lineage_counts:
-                    lineage_counts[sequence["color"]] = {"count": 0}
+                self.lineage_counts[color] = {"count": 0}
+
+        counts: dict = self.lineage_counts[color]
 
-                lineage_counts[sequence["color"]]["count"] += sequence["multiplicity"]
-                lineage_counts["total"]["count"] += sequence["multiplicity"]
+        if self.timepoints:
+            counts["timepoints"][sequence.timepoint] = counts["timepoints"].get(sequence.timepoint, 0) + sign * sequence.multiplicity
+            counts["total"] += sign * sequence.multiplicity
+        else:
+            counts["count"] += sign * sequence.multiplicity
 
-        self.lineage_counts = lineage_counts
+        if not self._by_color.get(color):
+            del self.lineage_counts[color]
 
     def need_swaps(self) -> Union[bool, list]:
         """ Returns tuple of swaps to make or None """
 
+        return self._needed_swap({color: self._count_vector(color) for color in self._colors})
+
+    def _needed_swap(self, counts: dict[str: tuple]) -> Union[bool, tuple]:
+        """ Returns the first swap to make given the count vectors of the lineages (see _count_vector), or False
+        a lineage needs swapping with a later one that has a higher count at the first timepoint where their counts differ
+        without timepoints, later lineages are only compared until one has a lower count """
+
         colors = settings.ANNOTATION_COLORS
 
         for index1 in range(len(colors)-1):
@@ -220,58 +490,34 @@ class PhyloTree(object):
 
                 if not color2["swapable"]:
                     continue
-                
-                if self.timepoints:
-                    for timepoint in self.timepoints:
-                        if color1["short"] in self.lineage_counts:
-                            color1_count: int = self.lineage_counts[color1["short"]]["timepoints"][timepoint]
-                        else:
-                            color1_count: int = 0
 
-                        if color2["short"] in self.lineage_counts:
-                            color2_count: int = self.lineage_counts[color2["short"]]["timepoints"][timepoint]
-                        else:
-                            color2_count: int = 0
+                if counts[color1["short"]] < counts[color2["short"]]:
+                    return (color1["short"], color2["short"])
 
-                        if color1_count < color2_count:
-                            return (color1["short"], color2["short"])
-                        elif color1_count > color2_count:
-                            break
-                else:
-                    if color1["short"] in self.lineage_counts:
-                        color1_count: int = self.lineage_counts[color1["short"]]["count"]
-                    else:
-                        color1_count: int = 0
-
-                    if color2["short"] in self.lineage_counts:
-                        color2_count: int = self.lineage_counts[color2["short"]]["count"]
-                    else:
-                        color2_count: int = 0
-
-                    if color1_count < color2_count:
-                        return (color1["short"], color2["short"])
-                    
-                    elif color1_count > color2_count:
-                            break
+                elif not self.timepoints and counts[color1["short"]] > counts[color2["short"]]:
+                    break
 
         return False
     
-    def tree_sequence_names(self) -> list[dict[str: str]]:
-        """ Get all the sequence names from the a specific tree """
+    def tree_sequence_names(self) -> ValuesView[TreeSequence]:
+        """ Get all the sequences in the tree, as a live view of self.sequences
+        each sequence can be read like a dict with "name" and "color" """
 
-        return [{"name": sequence["name"], "color": sequence["color"]} for sequence in self.sequences.values()]
+        return self.sequences.values()
 
 
 def ensure_tree_highlighter_svg(tree: Tree) -> None:
-    """ Makes sure that a particular tree has a highlighter svg file """
+    """ Makes sure that a particular tree has a highlighter svg file, loading its alignment, tree and consensus once for every plot """
+
+    session = tree.highlighter_session()
 
-    if not tree.has_svg_highlighter(width=settings.HIGHLIGHTER_MARK_WIDTH):
+    if not tree.has_svg_highlighter(width=settings.HIGHLIGHTER_MARK_WIDTH, session=session):
         return f"Error generating SVG for {tree.project} - {tree.name}\n\tOrigional Fasta: {tree.original_fasta_file_name}\n\tFasta: {tree.fasta_file_name}\n\tTree: {tree.tree_file_name}"
     
-    if not tree.has_svg_match(width=settings.MATCH_MARK_WIDTH):
+    if not tree.has_svg_match(width=settings.MATCH_MARK_WIDTH, session=session):
         return f"Error generating Match for {tree.project} - {tree.name}\n\tOrigional Fasta: {tree.original_fasta_file_name}\n\tFasta: {tree.fasta_file_name}\n\tTree: {tree.tree_file_name}"
 
-    if not tree.has_svg_match(width=settings.MATCH_MARK_WIDTH, show_multiple=False):
+    if not tree.has_svg_match(width=settings.MATCH_MARK_WIDTH, show_multiple=False, session=session):
         return f"Error generating Match for {tree.project} - {tree.name}\n\tOrigional Fasta: {tree.original_fasta_file_name}\n\tFasta: {tree.fasta_file_name}\n\tTree: {tree.tree_file_name}"
 
 
@@ -4,20 +4,21 @@ log = logging.getLogger('app')
 import os, tarfile, time, json, glob, time, zipfile
 from io import StringIO
 from datetime import datetime
-from pathlib import Path
 from Bio import SeqIO
 from Bio.SeqIO.FastaIO import SimpleFastaParser
 
 from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotFound, JsonResponse, FileResponse, HttpResponseBadRequest
 from django.shortcuts import render, redirect
+from django.urls import reverse
 from django.conf import settings
 from django.views.generic.base import View, TemplateView
-from django.db.models import QuerySet
 from django.contrib.auth.mixins import LoginRequiredMixin
 
 from phylobook.projects.mixins import LoginRequredSimpleErrorMixin
 from phylobook.projects.models import Project, ProjectCategory, Tree, Process
-from phylobook.projects.utils import fasta_type, get_lineage_dict, svg_dimensions, save_django_file_object, handle_import_file
+from phylobook.projects.utils import fasta_type, get_lineage_dict, svg_dimensions, save_django_file_object, handle_import_file, tree_svg_pairs, TreeFileChanged
+from phylobook.projects.utils.cache import highlighter_cache
+from phylobook.projects.utils.highlighter_tiles import TILE_FORMATS, TILE_SIZE
 
 PROJECT_PATH = settings.PROJECT_PATH
 
@@ -37,78 +38,94 @@ def displayProject(request, name, width: int=None, start: int=None, end: int=Non
         entries = []
         projectPath = os.path.join(PROJECT_PATH, name)
 
-        #file: list = []
-        tree_count: int = 0
+        timings: dict[str: float] = {}
+        stage_start: float = time.perf_counter()
 
+        # Scan the project directory once, pairing each highlighter PNG with the tree SVGs named after it
         try:
-            files = os.listdir(projectPath)
+            manifest = project.manifest()
+
+            if manifest.mtime is None:
+                raise FileNotFoundError(f"No such directory: {projectPath}")
+
         except Exception as e:
             log.warning(f"Error reading project directory: {e}")
             return HttpResponseBadRequest(f"Error reading project directory (probably due to permissions): {projectPath}")
 
+        files: list[str] = sorted(manifest.names)
+        file_set: set[str] = set(files)
+        cluster_files: list[str] = [file for file in files if ".cluster." in file]
+        found: list[tuple[str, str]] = tree_svg_pairs(files)
+
+        tree_count: int = len(found)
+
+        timings["scan"] = time.perf_counter() - stage_start
+        stage_start = time.perf_counter()
+
+        # Fetch every tree in one query (creating any that are new), and the trees on the requested page
+        project_trees: dict[str: Tree] = {tree.name: tree for tree in project.trees.filter(name__in={uniquesvg for uniquesvg, _ in found}).prefetch_related("files")}
+
+        for uniquesvg in sorted({uniquesvg for uniquesvg, _ in found if uniquesvg not in project_trees}):
+            project_trees[uniquesvg] = project.trees.create(name=uniquesvg)
+
         if start is None and end is None:
             start = 1
             end = settings.TREES_PER_PAGE
             
         if start > 0 and end >= start:
-            if end > project.trees.all().count():
-                end = project.trees.all().count()
-            trees: QuerySet = project.trees.all()[start-1:end]
+            total_trees: int = project.trees.count()
+            if end > total_trees:
+                end = total_trees
+            trees: set[int] = set(project.trees.values_list("pk", flat=True)[start-1:end])
         else:
             trees: bool = False
 
-        for file in sorted(files):
-            if file.endswith("_highlighter.png"):
-                uniquesvg = file[0:file.index("_highlighter.png")]
-                                        
-                for svg in os.listdir(projectPath):
-                    if svg.endswith(".svg") and "_highlighter." not in svg and "_match." not in svg and "_match_no_multiple." not in svg:
-                        if uniquesvg in svg:
-                            filePath = Path(os.path.join(projectPath, uniquesvg + ".json"))
-
-                            # prefix = uniquesvg + ".cluster"
-
-                            try:
-                                tree = project.trees.get(name=uniquesvg)
-                            except Tree.DoesNotExist:
-                                tree = project.trees.create(name=uniquesvg)
-
-                            tree_count += 1
-
-                            if trees and tree not in trees:
-                                continue
-
-                            if not tree.type:
-                                tree.type = fasta_type(tree=tree)
-                                tree.save()
-
-                            origional_dimensions: str = ""
-
-                            if tree.has_svg_highlighter(width=settings.HIGHLIGHTER_MARK_WIDTH, no_build=True):
-                                file = tree.highlighter_file_name_svg(width=settings.HIGHLIGHTER_MARK_WIDTH, path=False)
-                                (width, height) = svg_dimensions(tree.highlighter_file_name_svg(width=settings.HIGHLIGHTER_MARK_WIDTH))
-                                origional_dimensions = f"data-origional-width={width} data-origional-height={height} "
-                            data = None
-
-                            if filePath.is_file():
-                                try:
-                                    with open(filePath, 'r') as json_file:
-                                        data = json.load(json_file)
-                                except:
-                                    pass
-
-                            if data:      
-                                minval = data["minval"] if (data["minval"] != "None" and data["minval"] != None and data["minval"] != "") else ""
-                                maxval = data["maxval"] if (data["maxval"] != "None" and data["maxval"] != None and data["maxval"] != "") else ""
-                                colorlowval = data["colorlowval"] if (data["colorlowval"] != "None" and data["colorlowval"] != None and data["colorlowval"] != "") else ""
-                                colorhighval = data["colorhighval"] if (data["colorhighval"] != "None" and data["colorhighval"] != None and data["colorhighval"] != "") else ""
-                                iscolored = data["iscolored"] if (data["iscolored"] != "None" and data["iscolored"] != None and data["iscolored"] != "") else "false"
-                                entries.append({"uniquesvg": uniquesvg, "svg":os.path.join(name, svg), "highlighter":os.path.join(name, file), "minval": minval, \
-                                                "maxval": maxval, "colorlowval": colorlowval, "colorhighval": colorhighval, "iscolored": iscolored, \
-                                                    "clusterfiles": getClusterFiles(projectPath, uniquesvg), "tree": tree, "origional_dimensions": origional_dimensions})
-                            else:
-                                entries.append({"uniquesvg": uniquesvg, "svg": os.path.join(name, svg), "highlighter": os.path.join(name, file), "minval": "", \
-                                                "maxval": "", "colorlowval": "", "colorhighval": "", "iscolored": "false", "clusterfiles": getClusterFiles(projectPath, uniquesvg), "tree": tree})
+        timings["trees"] = time.perf_counter() - stage_start
+        stage_start = time.perf_counter()
+
+        # Read the metadata of only the trees on the page
+        for uniquesvg, svg in found:
+            tree: Tree = project_trees[uniquesvg]
+            file: str = f"{uniquesvg}_highlighter.png"
+
+            if trees and tree.pk not in trees:
+                continue
+
+            if not tree.type:
+                tree.type = fasta_type(tree=tree)
+                tree.save()
+
+            origional_dimensions: str = ""
+
+            if tree.has_svg_highlighter(width=settings.HIGHLIGHTER_MARK_WIDTH, no_build=True):
+                file = tree.highlighter_file_name_svg(width=settings.HIGHLIGHTER_MARK_WIDTH, path=False)
+                (width, height) = svg_dimensions(tree.highlighter_file_name_svg(width=settings.HIGHLIGHTER_MARK_WIDTH))
+                origional_dimensions = f"data-origional-width={width} data-origional-height={height} "
+            data = None
+
+            if f"{uniquesvg}.json" in file_set:
+                try:
+                    with open(os.path.join(projectPath, f"{uniquesvg}.json"), 'r') as json_file:
+                        data = json.load(json_file)
+                except:
+                    pass
+
+            if data:      
+                minval = data["minval"] if (data["minval"] != "None" and data["minval"] != None and data["minval"] != "") else ""
+                maxval = data["maxval"] if (data["maxval"] != "None" and data["maxval"] != None and data["maxval"] != "") else ""
+                colorlowval = data["colorlowval"] if (data["colorlowval"] != "None" and data["colorlowval"] != None and data["colorlowval"] != "") else ""
+                colorhighval = data["colorhighval"] if (data["colorhighval"] != "None" and data["colorhighval"] != None and data["colorhighval"] != "") else ""
+                iscolored = data["iscolored"] if (data["iscolored"] != "None" and data["iscolored"] != None and data["iscolored"] != "") else "false"
+                entries.append({"uniquesvg": uniquesvg, "svg":os.path.join(name, svg), "highlighter":os.path.join(name, file), "minval": minval, \
+                                "maxval": maxval, "colorlowval": colorlowval, "colorhighval": colorhighval, "iscolored": iscolored, \
+                                    "clusterfiles": getClusterFiles(projectPath, uniquesvg, files=cluster_files), "tree": tree, "origional_dimensions": origional_dimensions})
+            else:
+                entries.append({"uniquesvg": uniquesvg, "svg": os.path.join(name, svg), "highlighter": os.path.join(name, file), "minval": "", \
+                                "maxval": "", "colorlowval": "", "colorhighval": "", "iscolored": "false", "clusterfiles": getClusterFiles(projectPath, uniquesvg, files=cluster_files), "tree": tree})
+
+        timings["metadata"] = time.perf_counter() - stage_start
+
+        log.debug(f"Assembled project page {name} ({len(entries)} of {tree_count} trees): " + ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in timings.items()))
 
         pages: list = project.pages()
 
@@ -161,8 +178,9 @@ def displayProject(request, name, width: int=None, start: int=None, end: int=Non
         return render(request, "projects.html", { "noaccess": name, "projects": get_user_project_tree(request.user) })
 
 
-def getClusterFiles(projectPath, prefix):
-    """ Get all the cluster names and file paths """
+def getClusterFiles(projectPath, prefix, files: list[str]=None):
+    """ Get all the cluster names and file paths
+    pass the sorted names of the files in the project directory to skip listing it again """
 
     clusters: list = []
     short_prefix: str = ""
@@ -170,7 +188,10 @@ def getClusterFiles(projectPath, prefix):
     if prefix.count("_") > 3:
         short_prefix = "_".join(prefix.split("_")[:4])
 
-    for file in sorted(os.listdir(projectPath)):
+    if files is None:
+        files = sorted(os.listdir(projectPath))
+
+    for file in files:
         if short_prefix and file.startswith(short_prefix) and ".cluster." in file:
             name = file[file.index(".cluster.") + 9:]
             clusters.append({ "name": name, "file": file})
@@ -232,6 +253,70 @@ class MatchImage(LoginRequredSimpleErrorMixin, View):
         else:
             return FileResponse(open("/phylobook/phylobook/static/images/empty_match.svg", "rb"), content_type="image/svg+xml")
 
+class HighlighterTile(LoginRequredSimpleErrorMixin, View):
+    """ Returns one tile of the zoomable highlighter plot for a tree """
+
+    def get(self, request, *args, **kwargs):
+        """ Return the tile, drawing it first if needed """
+
+        project_name: str = kwargs["project"]
+        project: Project = Project.objects.get(name=project_name)
+
+        if not project or not (request.user.has_perm('projects.change_project', project) or request.user.has_perm('projects.view_project', project)):
+            return render(request, "projects.html", {"noaccess": project_name, "projects": get_user_project_tree(request.user)})
+
+        tree_name: str = kwargs["tree"]
+        tree: Tree = Tree.objects.get(project=project, name=tree_name)
+
+        output_format: str = kwargs.get("format", "svg")
+
+        if output_format not in TILE_FORMATS:
+            return HttpResponseNotFound("Tile not found!")
+
+        tile: dict[str: int] = {"level": kwargs["level"], "column": kwargs["column"], "row": kwargs["row"], "output_format": output_format}
+
+        if tree.has_highlighter_tile(**tile):
+            return FileResponse(open(tree.highlighter_tile_file_name(**tile), "rb"), content_type=TILE_FORMATS[output_format])
+        else:
+            return HttpResponseNotFound("Tile not found!")
+
+class HighlighterZoom(LoginRequredSimpleErrorMixin, View):
+    """ Shows one level of a tree's zoomable highlighter plot as a grid of tiles, each drawn when the browser first asks for it """
+
+    def get(self, request, *args, **kwargs):
+        """ Return the page for a level of tiles """
+
+        project_name: str = kwargs["project"]
+        project: Project = Project.objects.get(name=project_name)
+
+        if not project or not (request.user.has_perm('projects.change_project', project) or request.user.has_perm('projects.view_project', project)):
+            return render(request, "projects.html", {"noaccess": project_name, "projects": get_user_project_tree(request.user)})
+
+        tree_name: str = kwargs["tree"]
+        tree: Tree = Tree.objects.get(project=project, name=tree_name)
+
+        session = tree.highlighter_session()
+
+        if not session.ready:
+            return HttpResponseNotFound("Highlighter plot not found!")
+
+        levels: int = session.tiles(width=settings.HIGHLIGHTER_MARK_WIDTH).levels
+        level: int = min(kwargs.get("level", 0), levels-1)
+        side: int = 2 ** level
+
+        context: dict = {
+            "project": project_name,
+            "tree": tree_name,
+            "level": level,
+            "levels": levels,
+            "tile_size": TILE_SIZE,
+            "rows": [[(column, row) for column in range(side)] for row in range(side)],
+            "zoom_out_url": reverse("highlighter_zoom_level", args=[project_name, tree_name, level-1]) if level > 0 else None,
+            "zoom_in_url": reverse("highlighter_zoom_level", args=[project_name, tree_name, level+1]) if level < levels-1 else None,
+        }
+
+        return render(request, "highlighter_zoom.html", context)
+
 def getFile(request, name, file, **kwargs):
     project = Project.objects.get(name=name)
     if project and (request.user.has_perm('projects.change_project', project) or request.user.has_perm('projects.view_project', project)):
@@ -547,7 +632,10 @@ class TreeLineages(LoginRequredSimpleErrorMixin, View):
         
         if swap_message := tree.swap_by_counts():
             if flag == "recolor":
-                tree.save_file()
+                try:
+                    tree.save_file()
+                except TreeFileChanged:
+                    return JsonResponse({"error": "This tree was changed while it was being recolored.  Please reload the page and try again."})
                 
                 for color in tree_lineage.keys():
                     if color in [setting_color["short"] for setting_color in settings.ANNOTATION_COLORS if setting_color['has_UOLs']]:
@@ -759,3 +847,15 @@ class ProjectNameAvailable(LoginRequiredMixin, View):
             return JsonResponse({"available": True})
         
         return JsonResponse({"available": False})
+
+
+class HighlighterCacheStats(LoginRequredSimpleErrorMixin, View):
+    """ Returns the hit, miss and size counters of this worker's highlighter cache """
+
+    def get(self, request, *args, **kwargs):
+        """ Return the stats as json """
+
+        if not request.user.is_staff:
+            return HttpResponseForbidden("Permission Denied.")
+
+        return JsonResponse(highlighter_cache.stats())
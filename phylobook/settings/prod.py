@@ -350,6 +350,9 @@ logging.config.dictConfig({
 HIGHLIGHTER_MARK_WIDTH = 3
 MATCH_MARK_WIDTH = 6
 
+# Memory budget (in bytes) for each worker's cache of highlighter results
+HIGHLIGHTER_CACHE_BYTES = int(env("HIGHLIGHTER_CACHE_BYTES", default=64 * 1024 * 1024))
+
 TREES_PER_PAGE = 10
 
 # Importer settings